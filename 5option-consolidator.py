@@ -1,6 +1,10 @@
 import pandas as pd
 import os
-from types import MethodType
+
+from consolidator import DNN_COLUMNS, max_score_labels, ntn_label_mapping
+from matched_store import load_matched
+from metrics import Metrics
+from tables import csv_path, load_concurrently, parse_compression, read_table
 
 ##############################################################################################
 #                                       consolidator.py
@@ -20,6 +24,98 @@ class Consolidator:
         self.classif_path = None
         self.matched_path = None
         self.output_file = None
+        self.use_cache = True     # load matched_sim_data from its memory-mapped store (see matched_store.py)
+        self.compression = None   # write the output compressed: a tables.COMPRESSIONS key, None for plain
+        self.metrics = Metrics()  # stage timings and row counts of the run (see metrics.py)
+
+    def consolidate(self):
+        inputs = load_concurrently({'reduced': self.load_reduced, 'matched': self.load_dnn_data})
+        cdf = self.consolidate_frames(inputs['reduced'], inputs['matched'])
+
+        # Save output
+        os.makedirs(self.output_dir, exist_ok=True)
+        csv_name = csv_path(self.output_dir, self.output_file, self.compression)
+        with self.metrics.stage('write', rows_in=len(cdf)):
+            cdf.to_csv(csv_name, index=False)
+        return csv_name
+
+    def load_reduced(self):
+        with self.metrics.load(self.classif_path) as stage:
+            user_data = read_table(self.classif_path, 'reduced')
+            stage.add_rows(rows_out=len(user_data))
+        return self.check_user_data(user_data)
+
+    def load_dnn_data(self):
+        with self.metrics.load(self.matched_path) as stage:
+            dnn_sim_data = load_matched(self.matched_path, columns=DNN_COLUMNS, compact=False, use_cache=self.use_cache)
+            stage.add_rows(rows_out=len(dnn_sim_data))
+        return dnn_sim_data
+
+    def check_user_data(self, user_data):
+        ''' Reduced DataFrame with stripped column names, checked for the required columns '''
+        user_data.columns = user_data.columns.str.strip()
+
+        required_cols = ['subject_id', 'event_id', 'data.num_votes', 'data.most_likely', 'data.agreement']
+        missing = [col for col in required_cols if col not in user_data.columns]
+        if missing:
+            raise KeyError(f"Missing expected columns in classification file: {missing}")
+        return user_data
+
+    def consolidate_frames(self, user_data, dnn_sim_data):
+        ''' Consolidate a reduced DataFrame with the matched simulation DataFrame '''
+        user_data = self.check_user_data(user_data)
+
+        with self.metrics.stage('merge', rows_in=len(user_data) + len(dnn_sim_data)) as stage:
+            dropped_lim = 0
+            subj_user_data = pd.DataFrame({
+                'subject_id': user_data['subject_id'],
+                'filename': None,  # placeholder: dropped after the merge (filename_x)
+                'run': [None] * len(user_data),
+                'event': user_data['event_id'],
+                'data.num_votes': user_data['data.num_votes'],
+                'data.most_likely': user_data['data.most_likely'],
+                'data.agreement': user_data['data.agreement']
+            })
+
+            cdf = pd.merge(subj_user_data, dnn_sim_data[DNN_COLUMNS], on='subject_id', how='outer')
+            cdf.drop(columns=['filename_x', 'run_x', 'event_x', 'run_y', 'event_y'], inplace=True, errors='ignore')
+
+            # === Apply agreement_cut after merge ===
+            merged = len(cdf)
+            if 'data.agreement' in cdf.columns:
+                cdf = cdf[cdf['data.agreement'] >= self.agreement_cut]
+            stage.add_rows(rows_out=len(cdf))
+
+        with self.metrics.stage('derive', rows_in=len(cdf)):
+            # === Begin logic cleanup ===
+
+            # 4. Update idx_max_score robustly
+            label_mapping = {
+                'pred_skim': 'SKIMMING',
+                'pred_cascade': 'CASCADE',
+                'pred_tgtrack': 'THROUGHGOINGTRACK',
+                'pred_starttrack': 'STARTINGTRACK',
+                'pred_stoptrack': 'STOPPINGTRACK'
+            }
+            cdf['idx_max_score'] = max_score_labels(cdf[list(label_mapping)], list(label_mapping.values()))
+
+            # 5. Map ntn_category to strings
+            cdf['ntn_category'] = cdf['ntn_category'].map(ntn_label_mapping)
+
+            # 6. Accuracy calculations
+            cdf['user_accuracy'] = (cdf['data.most_likely'] == cdf['ntn_category']).astype(int)
+            cdf['DNN_accuracy'] = (cdf['idx_max_score'] == cdf['ntn_category']).astype(int)
+
+            # === End logic ===
+
+        self.metrics.count('consolidate', {
+            'reduced_subjects': len(user_data),
+            'matched_subjects': len(dnn_sim_data),
+            'dropped_retirement_lim': dropped_lim,
+            'dropped_agreement_cut': merged - len(cdf),
+            'consolidated_rows': len(cdf),
+        })
+        return cdf
 
 
 if __name__ == '__main__':
@@ -34,6 +130,9 @@ if __name__ == '__main__':
     output_file = input("Enter what you would like the output file to be called: ").strip()
 
     agreement_cut = float(input("Enter agreement cutoff (e.g. 0.6 to keep rows with >=60% agreement): "))
+    compression = parse_compression(input("Compress the output CSV? (gz, bz2, xz or zip, blank for plain): "))
+    metrics_file = input("Metrics JSON filename for stage timings and row counts (blank to skip): ").strip()
+    profile = bool(metrics_file) and input("Also capture a cProfile of the run? (y/n): ").strip().lower() == 'y'
 
     print("\nConsolidating... (this might take a few seconds)\n")
 
@@ -46,94 +145,12 @@ if __name__ == '__main__':
     consolidator.classif_path = classif_path
     consolidator.matched_path = matched_path
     consolidator.output_file = output_file
+    consolidator.compression = compression
+    consolidator.metrics = Metrics('5option-consolidator.py', profile=profile)
+    consolidator.metrics.params = {'retirement_lim': lim, 'agreement_cut': agreement_cut, 'reduced': classif_path}
 
-    # Define the consolidate method to attach dynamically
-    def patched_consolidate(self):
-        user_data = pd.read_csv(self.classif_path)
-        user_data.columns = user_data.columns.str.strip()
-
-        dnn_sim_data = pd.read_csv(self.matched_path)
-
-        required_cols = ['subject_id', 'event_id', 'data.num_votes', 'data.most_likely', 'data.agreement']
-        missing = [col for col in required_cols if col not in user_data.columns]
-        if missing:
-            raise KeyError(f"Missing expected columns in classification file: {missing}")
-
-        subj_user_data = pd.DataFrame({
-            'subject_id': user_data['subject_id'],
-            'filename': [f"subject_{sid}_event_{eid}.txt" for sid, eid in zip(user_data['subject_id'], user_data['event_id'])],
-            'run': [None] * len(user_data),
-            'event': user_data['event_id'],
-            'data.num_votes': user_data['data.num_votes'],
-            'data.most_likely': user_data['data.most_likely'],
-            'data.agreement': user_data['data.agreement']
-        })
-
-        dnn_data = dnn_sim_data[[
-            'subject_id', 'filename', 'run', 'event', 'truth_classification',
-            'pred_skim', 'pred_cascade', 'pred_tgtrack', 'pred_starttrack', 'pred_stoptrack',
-            'energy', 'zenith', 'oneweight', 'signal_charge', 'bg_charge',
-            'qratio', 'qtot', 'max_score_val', 'idx_max_score', 'ntn_category'
-        ]].copy()
-
-        cdf = pd.merge(subj_user_data, dnn_data, on='subject_id', how='outer')
-        cdf.drop(columns=['filename_x', 'run_x', 'event_x', 'run_y', 'event_y'], inplace=True, errors='ignore')
-
-        # === Apply agreement_cut after merge ===
-        if 'data.agreement' in cdf.columns:
-            cdf = cdf[cdf['data.agreement'] >= self.agreement_cut]
-
-        # === Begin logic cleanup ===
-
-        # 4. Update idx_max_score robustly
-        score_columns = ['pred_skim', 'pred_cascade', 'pred_tgtrack','pred_starttrack','pred_stoptrack']
-        label_mapping = {
-            'pred_skim': 'SKIMMING',
-            'pred_cascade': 'CASCADE',
-            'pred_tgtrack': 'THROUGHGOINGTRACK',
-            'pred_starttrack': 'STARTINGTRACK',
-            'pred_stoptrack': 'STOPPINGTRACK'
-        }
-
-        def safe_label(row):
-            vals = {col: row[col] for col in score_columns if pd.notnull(row[col])}
-            if not vals:
-                return None
-            return label_mapping[max(vals, key=vals.get)]
-
-        cdf['idx_max_score'] = cdf.apply(safe_label, axis=1)
-
-        # 5. Map ntn_category to strings
-        ntn_label_mapping = {
-            0: 'SKIMMING',
-            1: 'CASCADE',
-            2: 'THROUGHGOINGTRACK',
-            3: 'STARTINGTRACK',
-            4: 'STOPPINGTRACK'
-        }
-
-        cdf['ntn_category'] = cdf['ntn_category'].map(ntn_label_mapping)
-
-        # 6. Accuracy calculations
-        cdf['user_accuracy'] = cdf.apply(
-            lambda row: int(row['data.most_likely'] == row['ntn_category']),
-            axis=1
-        )
-        cdf['DNN_accuracy'] = cdf.apply(
-            lambda row: int(row['idx_max_score'] == row['ntn_category']),
-            axis=1
-        )
-
-        # === End logic ===
-
-        # Save output
-        os.makedirs(self.output_dir, exist_ok=True)
-        csv_name = os.path.join(self.output_dir, f"{self.output_file}.csv")
-        cdf.to_csv(csv_name, index=False)
-        return csv_name
-
-    # Bind and execute
-    consolidator.consolidate = MethodType(patched_consolidate, consolidator)
-    csv_path = consolidator.consolidate()
+    output_path = consolidator.consolidate()
+    if metrics_file:
+        consolidator.metrics.write(os.path.join(output_dir, metrics_file))
 
-    print(f" Consolidation complete. Output saved at: \n{csv_path}")
+    print(f" Consolidation complete. Output saved at: \n{output_path}")
@@ -1,89 +1,20 @@
 import os
-import pandas as pd
-import seaborn as sns
-import matplotlib.pyplot as plt
+
+from bootstrap import accuracy_summary, bootstrap_intervals, plot_intervals
+from confusion import count_frame, ratio_frame
+from metrics import Metrics
+from render import plot_confusion_matrix
+from tables import read_table
 
 # Specify the order of categories explicitly
 expected_categories = ["SKIMMING", "CASCADE", "TRACK"]
 
-def compute_fraction_matrix_user(df):
-    df = df.dropna(subset=["ntn_category", "data.most_likely"])
-    df = df[df["ntn_category"].isin(expected_categories) & df["data.most_likely"].isin(expected_categories)]
-
-    count_matrix = pd.crosstab(df["data.most_likely"], df["ntn_category"])
-    count_matrix = count_matrix.reindex(index=expected_categories, columns=expected_categories, fill_value=0)
-    column_totals = count_matrix.sum(axis=0)
-
-    fraction_matrix = pd.DataFrame(index=expected_categories, columns=expected_categories)
-    annotation_matrix = pd.DataFrame(index=expected_categories, columns=expected_categories)
-
-    for row_cat in expected_categories:
-        for col_cat in expected_categories:
-            num = count_matrix.loc[row_cat, col_cat]
-            denom = column_totals[col_cat]
-            denom_safe = denom if denom > 0 else 1  # avoid division by zero
-            frac_str = f"{num}/{denom}"
-            pct_str = f"{num / denom_safe * 100:.1f}%"
-            fraction_matrix.loc[row_cat, col_cat] = frac_str
-            annotation_matrix.loc[row_cat, col_cat] = f"{pct_str}\n{frac_str}"  # Percentage on top
-
-    return fraction_matrix, annotation_matrix
-
-def compute_fraction_matrix_dnn(df):
-    df = df.dropna(subset=["ntn_category", "idx_max_score"])
-    df = df[df["ntn_category"].isin(expected_categories) & df["idx_max_score"].isin(expected_categories)]
-
-    count_matrix = pd.crosstab(df["idx_max_score"], df["ntn_category"])
-    count_matrix = count_matrix.reindex(index=expected_categories, columns=expected_categories, fill_value=0)
-    column_totals = count_matrix.sum(axis=0)
+def compute_count_matrix_user(df):
+    # Rows: user prediction, columns: truth (rows outside expected_categories are left out)
+    return count_frame(df["data.most_likely"], df["ntn_category"], expected_categories)
 
-    fraction_matrix = pd.DataFrame(index=expected_categories, columns=expected_categories)
-    annotation_matrix = pd.DataFrame(index=expected_categories, columns=expected_categories)
-
-    for row_cat in expected_categories:
-        for col_cat in expected_categories:
-            num = count_matrix.loc[row_cat, col_cat]
-            denom = column_totals[col_cat]
-            denom_safe = denom if denom > 0 else 1  # avoid division by zero
-            frac_str = f"{num}/{denom}"
-            pct_str = f"{num / denom_safe * 100:.1f}%"
-            fraction_matrix.loc[row_cat, col_cat] = frac_str
-            annotation_matrix.loc[row_cat, col_cat] = f"{pct_str}\n{frac_str}"  # Percentage on top
-
-    return fraction_matrix, annotation_matrix
-
-def convert_to_numeric(fraction_matrix):
-    numeric_matrix = fraction_matrix.copy()
-    for row in numeric_matrix.index:
-        for col in numeric_matrix.columns:
-            num, denom = fraction_matrix.loc[row, col].split('/')
-            denom = int(denom) if int(denom) > 0 else 1
-            numeric_matrix.loc[row, col] = int(num) / denom
-    return numeric_matrix.astype(float)
-
-def plot_confusion_matrix(numeric_matrix, annotation_matrix, title, xlabel, ylabel, output_path):
-    plt.figure(figsize=(10, 8))
-    sns.set(font_scale=1.1)
-    ax = sns.heatmap(
-        numeric_matrix,
-        annot=annotation_matrix,
-        fmt="",
-        cmap="Blues",
-        cbar_kws={'label': 'Fraction of Truth Category'},
-        linewidths=0.5,
-        linecolor='gray',
-        vmin=0, vmax=1
-    )
-    plt.title(title)
-    plt.xlabel(xlabel)
-    plt.ylabel(ylabel)
-    plt.xticks(rotation=45)
-    plt.yticks(rotation=0)
-    plt.tight_layout()
-
-    plt.savefig(output_path)
-    print(f"Saved plot to: {output_path}")
-    plt.close()
+def compute_count_matrix_dnn(df):
+    return count_frame(df["idx_max_score"], df["ntn_category"], expected_categories)
 
 if __name__ == '__main__':
     print("==== Confusion Matrix Generator ====")
@@ -94,33 +25,53 @@ if __name__ == '__main__':
 
     dnn_plot_filename = input("Enter filename for DNN vs MC Truth plot (e.g. dnn_mc_confusion.png): ").strip()
     user_plot_filename = input("Enter filename for User vs MC Truth plot (e.g. user_mc_confusion.png): ").strip()
+    resamples = input("Bootstrap resamples for 95% intervals on the plots (e.g. 1000, blank to skip): ").strip()
+    metrics_file = input("Metrics JSON filename for stage timings (blank to skip): ").strip()
+    profile = bool(metrics_file) and input("Also capture a cProfile of the run? (y/n): ").strip().lower() == 'y'
+    metrics = Metrics('Plotter.py', profile=profile)
 
     input_path = os.path.join(input_dir, classif_file)
     output_path_dnn = os.path.join(output_dir, dnn_plot_filename)
     output_path_user = os.path.join(output_dir, user_plot_filename)
 
-    df = pd.read_csv(input_path)
+    with metrics.stage('load') as stage:
+        df = read_table(input_path, 'consolidated', columns=['data.most_likely', 'idx_max_score', 'ntn_category'])
+        stage.add_rows(rows_out=len(df))
+
+    # Bootstrap intervals of both matrices and accuracies, resampled on all cores
+    intervals = None
+    if resamples:
+        with metrics.stage('bootstrap', rows_in=len(df)):
+            intervals = bootstrap_intervals(df, expected_categories, int(resamples), workers=os.cpu_count() or 1)
+        print(f"\n{accuracy_summary(intervals)}")
 
     # User matrix
-    frac_user, annot_user = compute_fraction_matrix_user(df)
-    num_user = convert_to_numeric(frac_user)
-    print("\nUser Classification Fraction Matrix:\n", frac_user)
-    plot_confusion_matrix(
-        num_user, annot_user,
-        title="User Classification vs. Truth",
-        xlabel="Ground Truth: ntn_category",
-        ylabel="User Prediction: data.most_likely",
-        output_path=output_path_user
-    )
+    with metrics.stage('derive', rows_in=len(df)):
+        counts_user = compute_count_matrix_user(df)
+    print("\nUser Classification Fraction Matrix:\n", ratio_frame(counts_user))
+    with metrics.stage('render'):
+        plot_confusion_matrix(
+            counts_user,
+            title="User Classification vs. Truth",
+            xlabel="Ground Truth: ntn_category",
+            ylabel="User Prediction: data.most_likely",
+            output_path=output_path_user,
+            intervals=plot_intervals(intervals, 'user')
+        )
 
     # DNN matrix
-    frac_dnn, annot_dnn = compute_fraction_matrix_dnn(df)
-    num_dnn = convert_to_numeric(frac_dnn)
-    print("\nDNN Classification Fraction Matrix:\n", frac_dnn)
-    plot_confusion_matrix(
-        num_dnn, annot_dnn,
-        title="DNN Classification vs. Truth",
-        xlabel="Ground Truth: ntn_category",
-        ylabel="DNN Prediction: idx_max_score",
-        output_path=output_path_dnn
-    )
+    with metrics.stage('derive', rows_in=len(df)):
+        counts_dnn = compute_count_matrix_dnn(df)
+    print("\nDNN Classification Fraction Matrix:\n", ratio_frame(counts_dnn))
+    with metrics.stage('render'):
+        plot_confusion_matrix(
+            counts_dnn,
+            title="DNN Classification vs. Truth",
+            xlabel="Ground Truth: ntn_category",
+            ylabel="DNN Prediction: idx_max_score",
+            output_path=output_path_dnn,
+            intervals=plot_intervals(intervals, 'dnn')
+        )
+
+    if metrics_file:
+        metrics.write(os.path.join(output_dir, metrics_file))
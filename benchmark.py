@@ -0,0 +1,269 @@
+import argparse
+import bz2
+import gzip
+import importlib
+import json
+import lzma
+import os, os.path
+import platform
+import shutil
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from multiprocessing import get_context
+
+import numpy as np
+import pandas as pd
+
+from metrics import peak_rss_mb
+from tables import COMPRESSIONS
+
+##############################################################################################
+#                                       benchmark.py
+##############################################################################################
+# Purpose: Times every pipeline stage on synthetic exports of increasing size and writes the
+#          throughput and peak memory of each run to a JSON file
+# Usage: python benchmark.py --data-dir <dir> [--sizes 10000 100000 ...] [--compressions gzip xz]
+#            [--output results.json]
+# Author: Jonathan Berkson
+#
+# The data for each size is made by synthetic.py and kept in <data-dir>/n<size>, so later runs
+# reuse it. Each stage runs in a fresh process, so its peak resident memory is its own and not
+# left over from an earlier stage; baseline_rss_mb is the peak after the imports, before the
+# stage starts. Stages read the files written by the stages before them, as the scripts do.
+# Results are written after every size, so a long run that is stopped still leaves a file.
+# With --compressions, the stages that read the export also run on compressed copies of it
+# (made once per size, as an archived export would be), and each of those results lists its
+# throughput relative to the plain export.
+##############################################################################################
+
+DEFAULT_SIZES = [10**4, 10**5, 10**6, 10**7]
+STAGES = ['generate', 'parse', 'reduce', 'reduce_streaming', 'reduce_parallel',
+          'consolidate', 'consolidate_5', 'confusion_matrices', 'bootstrap', 'plot', 'pipeline']
+
+# Stages that read the classification export, rerun on each compressed copy
+EXPORT_STAGES = ['parse', 'reduce', 'reduce_streaming', 'reduce_parallel', 'pipeline']
+EXPORT_FILE = 'classifications.csv'
+
+RETIREMENT_LIM = 10
+ACCURACY_CUT = 50    # percent
+AGREEMENT_CUT = 0.5
+STREAM_CHUNKSIZE = 100_000
+BOOTSTRAP_RESAMPLES = 1000
+
+
+def compress_export(data_dir, compression):
+    ''' Path of a compressed copy of the export in data_dir (a COMPRESSIONS key), made when missing or older '''
+    plain = os.path.join(data_dir, EXPORT_FILE)
+    path = plain + COMPRESSIONS[compression]
+    if os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(plain):
+        return path
+    tmp = f"{path}.tmp"
+    if compression == 'zip':
+        with zipfile.ZipFile(tmp, 'w', zipfile.ZIP_DEFLATED) as archive:
+            archive.write(plain, arcname=EXPORT_FILE)
+    else:
+        opener = {'gzip': gzip.open, 'bz2': bz2.open, 'xz': lzma.open}[compression]
+        with open(plain, 'rb') as source, opener(tmp, 'wb') as target:
+            shutil.copyfileobj(source, target)
+    os.replace(tmp, path)
+    return path
+
+
+def reducer_for(data_dir, work_dir, export_file=EXPORT_FILE):
+    from reducer import Reducer
+    reducer = Reducer(data_dir, work_dir, RETIREMENT_LIM)
+    reducer.classif_path = os.path.join(data_dir, export_file)
+    reducer.matched_path = os.path.join(data_dir, 'matched_sim_data.csv')
+    reducer.accuracy_cut = ACCURACY_CUT / 100
+    reducer.use_cache = False
+    return reducer
+
+
+def consolidator_for(module, data_dir, work_dir, reduced, output):
+    consolidator = importlib.import_module(module).Consolidator(work_dir, work_dir, RETIREMENT_LIM, AGREEMENT_CUT)
+    consolidator.classif_path = os.path.join(work_dir, f"{reduced}.csv")
+    consolidator.matched_path = os.path.join(data_dir, 'matched_sim_data.csv')
+    consolidator.output_file = output
+    return consolidator
+
+
+def run_stage(stage, size, data_dir, work_dir, workers, export_file=EXPORT_FILE):
+    ''' Run one stage in this (fresh) process, reading the export from export_file in data_dir.
+    Returns (rows processed, seconds, baseline and peak RSS). '''
+    import matplotlib
+    matplotlib.use('Agg')
+    import Plotter
+    from bootstrap import bootstrap_intervals
+    from classifications import EXPORT_COLUMNS, parse_classifications
+    from confusion import fraction_frame
+    from pipeline import Pipeline
+    from synthetic import generate
+    from tables import read_table
+    baseline = peak_rss_mb()
+
+    start = time.perf_counter()
+    if stage == 'generate':
+        generate(data_dir, size)
+        rows = size
+    elif stage == 'parse':
+        rows = len(parse_classifications(read_table(os.path.join(data_dir, export_file),
+                                                    'classification', columns=EXPORT_COLUMNS)))
+    elif stage.startswith('reduce'):
+        reducer = reducer_for(data_dir, work_dir, export_file)
+        reducer.output_file, reducer.output_file_5 = 'reduced-3cat', 'reduced-5cat'
+        if stage == 'reduce_streaming':
+            reducer.chunksize = STREAM_CHUNKSIZE
+        elif stage == 'reduce_parallel':
+            reducer.workers = workers
+            reducer.chunksize = max(STREAM_CHUNKSIZE, size // (4 * workers))
+        reducer.reduce()
+        rows = size
+    elif stage.startswith('consolidate'):
+        n = 5 if stage == 'consolidate_5' else 3
+        module = 'consolidator' if n == 3 else '5option-consolidator'
+        path = consolidator_for(module, data_dir, work_dir, f"reduced-{n}cat", f"consolidated-{n}cat").consolidate()
+        rows = len(pd.read_csv(path, usecols=['subject_id']))
+    elif stage == 'confusion_matrices':
+        cdf = read_table(os.path.join(work_dir, 'consolidated-3cat.csv'), 'consolidated',
+                         columns=['data.most_likely', 'idx_max_score', 'ntn_category'])
+        for compute in (Plotter.compute_count_matrix_user, Plotter.compute_count_matrix_dnn):
+            fraction_frame(compute(cdf))
+        rows = len(cdf)
+    elif stage == 'bootstrap':
+        cdf = read_table(os.path.join(work_dir, 'consolidated-3cat.csv'), 'consolidated',
+                         columns=['data.most_likely', 'idx_max_score', 'ntn_category'])
+        bootstrap_intervals(cdf, Plotter.expected_categories, BOOTSTRAP_RESAMPLES, workers=workers)
+        rows = len(cdf)
+    elif stage == 'plot':
+        cdf = read_table(os.path.join(work_dir, 'consolidated-3cat.csv'), 'consolidated',
+                         columns=['data.most_likely', 'idx_max_score', 'ntn_category'])
+        for who, compute in (('user', Plotter.compute_count_matrix_user), ('dnn', Plotter.compute_count_matrix_dnn)):
+            Plotter.plot_confusion_matrix(compute(cdf), title=f"{who} vs. truth", xlabel="truth", ylabel=who,
+                                          output_path=os.path.join(work_dir, f"{who}.png"))
+        rows = len(cdf)
+    elif stage == 'pipeline':
+        pipeline = Pipeline(data_dir, work_dir, RETIREMENT_LIM, ACCURACY_CUT, AGREEMENT_CUT, categories=(3, 5))
+        pipeline.classif_path = os.path.join(data_dir, export_file)
+        pipeline.matched_path = os.path.join(data_dir, 'matched_sim_data.csv')
+        pipeline.output_file = 'pipeline'
+        pipeline.use_cache = False
+        pipeline.use_stage_cache = False
+        pipeline.force = True  # redraw the plots too, so every run (plain or compressed) does the same work
+        pipeline.run()
+        rows = size
+    else:
+        raise ValueError(f"Unknown stage: {stage}")
+    seconds = time.perf_counter() - start
+
+    return rows, seconds, baseline, peak_rss_mb()
+
+
+class Benchmark:
+    def __init__(self, data_dir, sizes=DEFAULT_SIZES, stages=STAGES):
+        self.data_dir = data_dir
+        self.sizes = list(sizes)
+        self.stages = list(stages)
+        self.output_path = 'benchmark.json'
+        self.workers = min(4, os.cpu_count() or 1)  # processes for the reduce_parallel and bootstrap stages
+        self.regenerate = False                     # remake the synthetic data even if it exists
+        self.compressions = []                      # also run EXPORT_STAGES on the export compressed these ways
+        self.results = []
+
+    def run(self):
+        ''' Run every stage at every size, writing the results file after each size. Returns the results. '''
+        for size in self.sizes:
+            data_dir = os.path.join(self.data_dir, f"n{size}")
+            work_dir = os.path.join(data_dir, 'work')
+            os.makedirs(work_dir, exist_ok=True)
+            stages = [stage for stage in self.stages if stage != 'generate']
+            if self.regenerate or not os.path.exists(os.path.join(data_dir, EXPORT_FILE)):
+                stages.insert(0, 'generate')
+
+            runs = [(stage, None) for stage in stages]
+            runs += [(stage, compression) for compression in self.compressions for stage in stages if stage in EXPORT_STAGES]
+            for stage, compression in runs:
+                export_file = EXPORT_FILE if compression is None else os.path.basename(compress_export(data_dir, compression))
+                self.results.append(self.measure(stage, size, data_dir, work_dir, export_file))
+                result = self.results[-1]
+                result['compression'] = compression
+                label = stage if compression is None else f"{stage} [{compression}]"
+                print(f"{size:>10} {label:<28} {result['seconds']:>9.2f} s {result['classifications_per_second']:>12,.0f} classif/s"
+                      + (f" {result['peak_rss_mb']:>9.1f} MB" if result['peak_rss_mb'] is not None else "")
+                      + (f" {result['relative_to_plain']:>6.2f}x plain" if self.compare_to_plain(result) else ""))
+            self.save()
+        return self.results
+
+    def measure(self, stage, size, data_dir, work_dir, export_file=EXPORT_FILE):
+        # A new single-worker pool per stage: a fresh process, so ru_maxrss is this stage's peak
+        with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as pool:
+            rows, seconds, baseline, peak = pool.submit(run_stage, stage, size, data_dir, work_dir, self.workers, export_file).result()
+        return {
+            'stage': stage,
+            'classifications': size,
+            'export_mb': os.path.getsize(os.path.join(data_dir, export_file)) / 1024**2,
+            'rows': rows,  # rows the stage itself handles (subjects for consolidation and plotting)
+            'seconds': seconds,
+            'classifications_per_second': size / seconds if seconds else None,
+            'rows_per_second': rows / seconds if seconds else None,
+            'baseline_rss_mb': baseline,
+            'peak_rss_mb': peak,
+        }
+
+    def compare_to_plain(self, result):
+        ''' Set result's throughput relative to the plain-export run of the same stage and size.
+        Returns whether there was one to compare with. '''
+        if result['compression'] is None:
+            return False
+        for plain in self.results:
+            if (plain['stage'], plain['classifications'], plain.get('compression')) == (result['stage'], result['classifications'], None):
+                result['relative_to_plain'] = result['classifications_per_second'] / plain['classifications_per_second']
+                return True
+        return False
+
+    def save(self):
+        report = {
+            'created_at': datetime.now(timezone.utc).isoformat(),
+            'environment': {
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpu_count': os.cpu_count(),
+                'numpy': np.__version__,
+                'pandas': pd.__version__,
+            },
+            'parameters': {
+                'retirement_lim': RETIREMENT_LIM,
+                'accuracy_cut': ACCURACY_CUT,
+                'agreement_cut': AGREEMENT_CUT,
+                'stream_chunksize': STREAM_CHUNKSIZE,
+                'bootstrap_resamples': BOOTSTRAP_RESAMPLES,
+                'workers': self.workers,
+                'compressions': self.compressions,
+            },
+            'results': self.results,
+        }
+        with open(self.output_path, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Time every pipeline stage on synthetic exports of increasing size.")
+    parser.add_argument('--data-dir', required=True, help="directory for the synthetic data and stage outputs")
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+                        help="numbers of classifications (default: 10^4 to 10^7)")
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES, help="stages to run (default: all)")
+    parser.add_argument('--output', default='benchmark.json', help="results file (default: %(default)s)")
+    parser.add_argument('--workers', type=int, default=None, help="processes for the reduce_parallel and bootstrap stages")
+    parser.add_argument('--regenerate', action='store_true', help="remake the synthetic data even if it exists")
+    parser.add_argument('--compressions', nargs='+', choices=sorted(COMPRESSIONS), default=[],
+                        help="also run the stages reading the export on copies compressed these ways")
+    args = parser.parse_args()
+
+    benchmark = Benchmark(args.data_dir, args.sizes, args.stages)
+    benchmark.output_path = args.output
+    benchmark.workers = args.workers or benchmark.workers
+    benchmark.regenerate = args.regenerate
+    benchmark.compressions = args.compressions
+    benchmark.run()
+    print(f"\nResults saved to: {benchmark.output_path}")
@@ -0,0 +1,207 @@
+import argparse
+import importlib
+import os, os.path
+
+import numpy as np
+import pandas as pd
+
+from bootstrap import PREDICTIONS, TRUTH
+from confusion import category_codes, cell_codes
+from tables import read_table
+
+##############################################################################################
+#                                       binned.py
+##############################################################################################
+# Purpose: User and DNN confusion matrices and accuracies of consolidated subjects in bins of
+#          log10(energy), cos(zenith) and log10(charge), optionally weighted by oneweight
+# Usage: python binned.py --inputs <consolidated CSVs> --output-dir <dir> [options]
+#        or from binned import binned_performance, curve_frame
+# Author: Jonathan Berkson
+#
+# Every subject gets one flat bin index (np.ravel_multi_index of its three bin numbers) and one
+# matrix cell per prediction (confusion.cell_codes), so all the matrices of all the bins come
+# from a single weighted bincount, not a filter per bin. Results are arrays of shape
+# (energy bins, cos zenith bins, charge bins, n, n); a curve along one axis sums the other two.
+# Bins are closed on the left, [edge, next edge), except the last, which includes its upper
+# edge; subjects outside the edges (or with NaN values) are left out and counted separately.
+# Accuracy is the (weighted) fraction of subjects whose prediction equals ntn_category, as the
+# consolidators' accuracy columns, so subjects without a usable prediction count as wrong.
+##############################################################################################
+
+# Bin edges of each axis: log10(energy / GeV), cos(zenith), log10(charge / PE)
+AXES = ['energy', 'cos_zenith', 'charge']
+DEFAULT_EDGES = {
+    'energy': np.arange(2, 7.01, 0.5),
+    'cos_zenith': np.linspace(-1, 1, 11),
+    'charge': np.arange(0, 6.01, 0.5),
+}
+CHARGE_COLUMN = 'qtot'
+
+# Columns read from a consolidated CSV: the predictions and truth of the matrices, and the physics
+COLUMNS = list(PREDICTIONS.values()) + [TRUTH, 'energy', 'zenith', 'oneweight', 'qtot', 'signal_charge']
+
+
+def bin_numbers(values, edges):
+    ''' Bin of each value in edges ([low, high), the last bin closed), -1 outside or NaN '''
+    edges = np.asarray(edges, dtype=np.float64)
+    bins = np.searchsorted(edges, values, side='right') - 1
+    bins[values == edges[-1]] = len(edges) - 2
+    bins[(bins < 0) | (bins >= len(edges) - 1) | np.isnan(values)] = -1
+    return bins
+
+
+def axis_values(df, charge_column=CHARGE_COLUMN):
+    ''' {axis: value of each subject} of a consolidated DataFrame '''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return {
+            'energy': np.log10(df['energy'].to_numpy(np.float64)),
+            'cos_zenith': np.cos(df['zenith'].to_numpy(np.float64)),
+            'charge': np.log10(df[charge_column].to_numpy(np.float64)),
+        }
+
+
+def event_weights(df, spectral_index=None):
+    ''' oneweight of each subject, times energy^-spectral_index for a power-law flux when given
+    (normalization does not matter, accuracies are ratios) '''
+    weights = df['oneweight'].to_numpy(np.float64)
+    if spectral_index is not None:
+        weights = weights * df['energy'].to_numpy(np.float64) ** -spectral_index
+    return weights
+
+
+def binned_counts(predicted, truth, correct, bins, shape, n_categories, weights=None):
+    ''' One pass over the subjects. predicted and correct are lists (one per matrix) of category
+    codes and 0/1 hits against the truth codes, bins the flat bin of each subject (-1 to leave
+    out) of shape. Returns ((matrices, *shape, n, n) counts, (matrices, *shape) hits,
+    (*shape) totals), weighted when weights is given. '''
+    n, n_bins = n_categories, int(np.prod(shape))
+    inside = bins >= 0
+    # Per bin and matrix: n * n matrix cells, the left-out cell, then the hit count
+    stride = n * n + 2
+    keys, key_weights = [], []
+    for m, (codes, hits) in enumerate(zip(predicted, correct)):
+        key = (m * n_bins + bins) * stride
+        hit = inside & np.asarray(hits, dtype=bool)
+        keys += [key[inside] + cell_codes(codes, truth, n)[inside], key[hit] + n * n + 1]
+        if weights is not None:
+            key_weights += [weights[inside], weights[hit]]
+    counts = np.bincount(np.concatenate(keys), weights=np.concatenate(key_weights) if weights is not None else None,
+                         minlength=len(predicted) * n_bins * stride)
+    counts = counts.reshape(len(predicted), *shape, stride)
+    matrices = counts[..., :n * n].reshape(len(predicted), *shape, n, n)
+    totals = counts[0, ..., :n * n + 1].sum(axis=-1)
+    return matrices, counts[..., n * n + 1], totals
+
+
+def binned_performance(df, categories, edges=None, weights=None, charge_column=CHARGE_COLUMN):
+    ''' Binned matrices and accuracies of a consolidated DataFrame. edges maps each axis of AXES to
+    its bin edges (DEFAULT_EDGES for those missing). Returns {'edges', 'subjects': unweighted
+    (*shape) counts, 'totals': weighted (*shape) totals, 'outside': subjects out of range,
+    'user' / 'dnn': {'counts': (*shape, n, n), 'hits': (*shape)}}. '''
+    edges = {axis: np.asarray((edges or {}).get(axis, DEFAULT_EDGES[axis]), dtype=np.float64) for axis in AXES}
+    shape = tuple(len(edges[axis]) - 1 for axis in AXES)
+    values = axis_values(df, charge_column)
+    numbers = [bin_numbers(values[axis], edges[axis]) for axis in AXES]
+    inside = np.logical_and.reduce([number >= 0 for number in numbers])
+    bins = np.full(len(df), -1, dtype=np.int64)
+    bins[inside] = np.ravel_multi_index([number[inside] for number in numbers], shape)
+
+    truth = category_codes(df[TRUTH], categories)
+    predicted = [category_codes(df[column], categories) for column in PREDICTIONS.values()]
+    correct = [(df[column] == df[TRUTH]).to_numpy() for column in PREDICTIONS.values()]
+    matrices, hits, totals = binned_counts(predicted, truth, correct, bins, shape, len(categories), weights)
+
+    result = {
+        'edges': edges,
+        'subjects': np.bincount(bins[inside], minlength=int(np.prod(shape))).reshape(shape),
+        'totals': totals,
+        'outside': int((~inside).sum()),
+    }
+    for i, who in enumerate(PREDICTIONS):
+        result[who] = {'counts': matrices[i], 'hits': hits[i]}
+    return result
+
+
+def curve_frame(result, axis):
+    ''' Accuracy along one axis (the other two summed): one row per bin with its edges, the
+    subjects and (weighted) total in it, and the user and DNN accuracy '''
+    other = tuple(i for i, name in enumerate(AXES) if name != axis)
+    edges = result['edges'][axis]
+    totals = result['totals'].sum(axis=other)
+    frame = pd.DataFrame({
+        'axis': axis,
+        'low': edges[:-1],
+        'high': edges[1:],
+        'center': (edges[:-1] + edges[1:]) / 2,
+        'subjects': result['subjects'].sum(axis=other),
+        'total': totals,
+    })
+    for who in PREDICTIONS:
+        frame[f'{who}_accuracy'] = result[who]['hits'].sum(axis=other) / np.where(totals > 0, totals, np.nan)
+    return frame
+
+
+def plot_curves(frame, title, output_path):
+    ''' User and DNN accuracy against the bin centers of a curve_frame, saved to output_path '''
+    import matplotlib.pyplot as plt
+
+    labels = {'energy': "log10(Energy / GeV)", 'cos_zenith': "cos(Zenith)", 'charge': "log10(Charge / PE)"}
+    fig, ax = plt.subplots(figsize=(8, 5))
+    for who, style in (('user', 'o-'), ('dnn', 's--')):
+        ax.plot(frame['center'], frame[f'{who}_accuracy'], style, label='User' if who == 'user' else 'DNN')
+    ax.set_xlabel(labels[frame['axis'].iloc[0]])
+    ax.set_ylabel("Accuracy")
+    ax.set_ylim(0, 1)
+    ax.set_title(title)
+    ax.legend()
+    fig.tight_layout()
+    fig.savefig(output_path, dpi=150)
+    plt.close(fig)
+
+
+if __name__ == '__main__':
+    from render import PLOTTERS, use_agg
+
+    parser = argparse.ArgumentParser(description="User and DNN accuracy in bins of energy, zenith and charge of consolidated CSVs.")
+    parser.add_argument('--inputs', nargs='+', required=True, help="consolidated CSV files")
+    parser.add_argument('--output-dir', required=True, help="directory for the curves, arrays and images")
+    parser.add_argument('--categories', type=int, choices=sorted(PLOTTERS), default=3,
+                        help="3- or 5-category consolidated files (default: 3)")
+    parser.add_argument('--energy-edges', type=float, nargs='+', default=DEFAULT_EDGES['energy'],
+                        help="log10(energy / GeV) bin edges (default: 2 to 7 in steps of 0.5)")
+    parser.add_argument('--cos-zenith-edges', type=float, nargs='+', default=DEFAULT_EDGES['cos_zenith'],
+                        help="cos(zenith) bin edges (default: -1 to 1 in steps of 0.2)")
+    parser.add_argument('--charge-edges', type=float, nargs='+', default=DEFAULT_EDGES['charge'],
+                        help="log10(charge / PE) bin edges (default: 0 to 6 in steps of 0.5)")
+    parser.add_argument('--charge-column', choices=['qtot', 'signal_charge'], default=CHARGE_COLUMN,
+                        help="charge to bin in (default: %(default)s)")
+    parser.add_argument('--weighted', action='store_true', help="weight subjects by oneweight")
+    parser.add_argument('--spectral-index', type=float, default=None,
+                        help="with --weighted, also weight by energy^-index (e.g. 2.5)")
+    parser.add_argument('--no-plots', action='store_true', help="only write the CSVs and arrays")
+    args = parser.parse_args()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    categories = importlib.import_module(PLOTTERS[args.categories][0]).expected_categories
+    edges = {'energy': sorted(args.energy_edges), 'cos_zenith': sorted(args.cos_zenith_edges), 'charge': sorted(args.charge_edges)}
+    if not args.no_plots:
+        use_agg()
+    for path in args.inputs:
+        name = os.path.splitext(os.path.basename(path))[0]
+        df = read_table(path, 'consolidated', columns=COLUMNS)
+        weights = event_weights(df, args.spectral_index) if args.weighted else None
+        result = binned_performance(df, categories, edges, weights, args.charge_column)
+
+        curves = pd.concat([curve_frame(result, axis) for axis in AXES], ignore_index=True)
+        csv_name = os.path.join(args.output_dir, f"{name}-binned.csv")
+        curves.to_csv(csv_name, index=False)
+        arrays_name = os.path.join(args.output_dir, f"{name}-binned.npz")
+        np.savez_compressed(arrays_name, categories=np.array(categories), subjects=result['subjects'], totals=result['totals'],
+                            **{f'{axis}_edges': result['edges'][axis] for axis in AXES},
+                            **{f'{who}_{key}': result[who][key] for who in PREDICTIONS for key in ('counts', 'hits')})
+        print(f"{name}: {result['outside']} subjects outside the bins\nSaved curves to: {csv_name}\nSaved arrays to: {arrays_name}")
+
+        if not args.no_plots:
+            for axis in AXES:
+                plot_curves(curves[curves['axis'] == axis], f"Accuracy vs. {axis.replace('_', ' ')}: {name}",
+                            os.path.join(args.output_dir, f"{name}-accuracy-{axis}.png"))
@@ -0,0 +1,191 @@
+import argparse
+import importlib
+import os, os.path
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from confusion import category_codes, cell_codes, count_matrices, fractions
+from tables import read_table
+
+##############################################################################################
+#                                       bootstrap.py
+##############################################################################################
+# Purpose: Bootstrap percentile intervals of the user and DNN confusion matrix fractions and
+#          accuracies of consolidated subjects, resampled in batches on a process pool
+# Usage: python bootstrap.py --inputs <consolidated CSVs> --output-dir <dir> [options]
+#        or from bootstrap import bootstrap_intervals
+# Author: Jonathan Berkson
+#
+# A resample draws as many subjects as there are, with replacement, as an array of subject
+# indices. Resamples are drawn in chunks of at most CHUNK_ROWS indices, so memory stays
+# bounded however many are asked for. Each subject's matrix cell is worked out once
+# (confusion.cell_codes), so a chunk's matrices are one gather and one bincount of the cells,
+# offset per resample. The user and DNN matrices of a resample come from the same subjects.
+# Every chunk has its own seed spawned from the run's seed, so the intervals do not depend on
+# the number of workers.
+##############################################################################################
+
+DEFAULT_RESAMPLES = 1000
+DEFAULT_LEVEL = 0.95   # central percentile interval
+DEFAULT_SEED = 0
+CHUNK_ROWS = 1 << 20   # resampled subjects per chunk (all its resamples together)
+
+# Prediction column of each matrix and the truth column they are compared with
+PREDICTIONS = {'user': 'data.most_likely', 'dnn': 'idx_max_score'}
+TRUTH = 'ntn_category'
+
+# Per-process state of a bootstrap worker, set once by init_bootstrap_worker
+_bootstrap_context = None
+
+
+def init_bootstrap_worker(cells, correct, n_categories):
+    global _bootstrap_context
+    _bootstrap_context = (cells, correct, n_categories)
+
+
+def resample_chunk(task):
+    ''' Count matrices and accuracies of n_resamples resamples drawn with seed. Returns
+    ((matrices, n_resamples, n, n) counts, (matrices, n_resamples) accuracies). '''
+    seed, n_resamples = task
+    cells, correct, n = _bootstrap_context
+    n_subjects = len(cells[0])
+    index = np.random.default_rng(seed).integers(0, n_subjects, size=(n_resamples, n_subjects))
+    # n * n cells plus the left-out one per resample
+    offsets = np.arange(n_resamples)[:, None] * (n * n + 1)
+    counts = np.stack([np.bincount((subject_cells[index] + offsets).ravel(), minlength=n_resamples * (n * n + 1))
+                       .reshape(n_resamples, n * n + 1)[:, :n * n].reshape(n_resamples, n, n)
+                       for subject_cells in cells])
+    accuracy = np.stack([hits[index].sum(axis=1) for hits in correct]) / n_subjects
+    return counts, accuracy
+
+
+def bootstrap_resamples(predicted, truth, correct, n_categories, n_resamples=DEFAULT_RESAMPLES, seed=DEFAULT_SEED, workers=1):
+    ''' Bootstrap resamples of subjects. predicted is a list of category code arrays (one per
+    matrix) against the truth codes, and correct a list of 0/1 arrays whose resampled means are
+    the accuracies. Returns ((matrices, n_resamples, n, n) counts, (matrices, n_resamples) accuracies). '''
+    predicted = [np.asarray(codes) for codes in predicted]
+    correct = [np.asarray(hits, dtype=np.int64) for hits in correct]
+    n_subjects = len(truth)
+    if n_subjects == 0:
+        return (np.zeros((len(predicted), n_resamples, n_categories, n_categories), dtype=np.int64),
+                np.full((len(predicted), n_resamples), np.nan))
+
+    per_chunk = max(1, CHUNK_ROWS // n_subjects)
+    sizes = [min(per_chunk, n_resamples - start) for start in range(0, n_resamples, per_chunk)]
+    tasks = list(zip(np.random.SeedSequence(seed).spawn(len(sizes)), sizes))
+    context = ([cell_codes(codes, np.asarray(truth), n_categories) for codes in predicted], correct, n_categories)
+
+    if workers > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(tasks)), initializer=init_bootstrap_worker,
+                                 initargs=context) as pool:
+            results = list(pool.map(resample_chunk, tasks))
+    else:
+        init_bootstrap_worker(*context)
+        results = [resample_chunk(task) for task in tasks]
+    counts, accuracy = zip(*results)
+    return np.concatenate(counts, axis=1), np.concatenate(accuracy, axis=1)
+
+
+def percentile_interval(samples, level=DEFAULT_LEVEL):
+    ''' (low, high) central percentile interval over the first axis of samples '''
+    tail = 50 * (1 - level)
+    return tuple(np.percentile(samples, [tail, 100 - tail], axis=0))
+
+
+def bootstrap_intervals(df, categories, n_resamples=DEFAULT_RESAMPLES, level=DEFAULT_LEVEL, seed=DEFAULT_SEED, workers=1):
+    ''' Intervals of the user and DNN matrices of a consolidated DataFrame. Returns {'user' / 'dnn':
+    {'counts', 'low', 'high': DataFrames (fractions of the truth column), 'correct', 'subjects':
+    ints, 'accuracy', 'accuracy_low', 'accuracy_high': floats}}. Accuracy is the fraction of subjects whose
+    prediction equals ntn_category, as the consolidators' accuracy columns. '''
+    truth = category_codes(df[TRUTH], categories)
+    predicted = [category_codes(df[column], categories) for column in PREDICTIONS.values()]
+    correct = [(df[column] == df[TRUTH]).to_numpy() for column in PREDICTIONS.values()]
+    counts, accuracy = bootstrap_resamples(predicted, truth, correct, len(categories), n_resamples, seed, workers)
+
+    intervals = {}
+    for i, (who, codes) in enumerate(zip(PREDICTIONS, predicted)):
+        low, high = percentile_interval(fractions(counts[i]), level)
+        accuracy_low, accuracy_high = percentile_interval(accuracy[i], level)
+        intervals[who] = {
+            'counts': pd.DataFrame(count_matrices(codes, truth, len(categories))[0], index=categories, columns=categories),
+            'low': pd.DataFrame(low, index=categories, columns=categories),
+            'high': pd.DataFrame(high, index=categories, columns=categories),
+            'correct': int(correct[i].sum()),
+            'subjects': len(df),
+            'accuracy': correct[i].mean() if len(df) else np.nan,
+            'accuracy_low': accuracy_low,
+            'accuracy_high': accuracy_high,
+        }
+    return intervals
+
+
+def plot_intervals(intervals, who):
+    ''' (low, high) fraction DataFrames of one matrix for render's Plot, None without intervals '''
+    return None if intervals is None else (intervals[who]['low'], intervals[who]['high'])
+
+
+def summary_frame(intervals):
+    ''' One row per matrix cell (fraction of its truth column) and per matrix accuracy, with the
+    count, total, value and interval '''
+    rows = []
+    for who, result in intervals.items():
+        counts = result['counts']
+        totals = counts.sum(axis=0)
+        for truth in counts.columns:
+            for predicted in counts.index:
+                rows.append({'matrix': who, 'statistic': 'fraction', 'predicted': predicted, 'truth': truth,
+                             'count': counts.at[predicted, truth], 'total': totals[truth],
+                             'value': counts.at[predicted, truth] / max(totals[truth], 1),
+                             'low': result['low'].at[predicted, truth], 'high': result['high'].at[predicted, truth]})
+        rows.append({'matrix': who, 'statistic': 'accuracy', 'predicted': None, 'truth': None,
+                     'count': result['correct'], 'total': result['subjects'], 'value': result['accuracy'],
+                     'low': result['accuracy_low'], 'high': result['accuracy_high']})
+    return pd.DataFrame(rows)
+
+
+def accuracy_summary(intervals, level=DEFAULT_LEVEL):
+    ''' "user accuracy: 0.612 [0.588, 0.637], DNN accuracy: ..." for printing '''
+    return ", ".join(f"{'user' if who == 'user' else 'DNN'} accuracy: {result['accuracy']:.3f} "
+                     f"[{result['accuracy_low']:.3f}, {result['accuracy_high']:.3f}]"
+                     for who, result in intervals.items()) + f" ({level:.0%} intervals)"
+
+
+if __name__ == '__main__':
+    from render import PLOTTERS, Panel, consolidated_plots, render_plots
+
+    parser = argparse.ArgumentParser(description="Bootstrap intervals of the user and DNN confusion matrices of consolidated CSVs.")
+    parser.add_argument('--inputs', nargs='+', required=True, help="consolidated CSV files")
+    parser.add_argument('--output-dir', required=True, help="directory for the summaries and images")
+    parser.add_argument('--categories', type=int, choices=sorted(PLOTTERS), default=3,
+                        help="3- or 5-category consolidated files (default: 3)")
+    parser.add_argument('--resamples', type=int, default=DEFAULT_RESAMPLES, help="bootstrap resamples (default: %(default)s)")
+    parser.add_argument('--level', type=float, default=DEFAULT_LEVEL, help="interval coverage (default: %(default)s)")
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED, help="random seed (default: %(default)s)")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="processes (default: all CPUs)")
+    parser.add_argument('--no-plots', action='store_true', help="only write the summary CSVs")
+    parser.add_argument('--panels', action='store_true', help="one figure per input with the user and DNN matrices side by side")
+    parser.add_argument('--force', action='store_true', help="redraw images even if unchanged")
+    args = parser.parse_args()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    categories = importlib.import_module(PLOTTERS[args.categories][0]).expected_categories
+    plots = []
+    for path in args.inputs:
+        name = os.path.splitext(os.path.basename(path))[0]
+        df = read_table(path, 'consolidated', columns=list(PREDICTIONS.values()) + [TRUTH])
+        intervals = bootstrap_intervals(df, categories, args.resamples, args.level, args.seed, args.workers)
+        csv_name = os.path.join(args.output_dir, f"{name}-bootstrap.csv")
+        summary_frame(intervals).to_csv(csv_name, index=False)
+        print(f"{name}: {accuracy_summary(intervals, args.level)}\nSaved summary to: {csv_name}")
+
+        if not args.no_plots:
+            user, dnn = consolidated_plots(path, args.output_dir, args.categories)
+            user.intervals, dnn.intervals = plot_intervals(intervals, 'user'), plot_intervals(intervals, 'dnn')
+            if args.panels:
+                plots.append(Panel([user, dnn], os.path.join(args.output_dir, f"{name}-panels.png"), title=name))
+            else:
+                plots += [user, dnn]
+
+    render_plots(plots, workers=args.workers, skip_unchanged=not args.force)
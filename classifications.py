@@ -0,0 +1,321 @@
+import json
+import re
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+import pandas as pd
+
+##############################################################################################
+#                                       classifications.py
+##############################################################################################
+# Purpose: Decodes the JSON columns of a Zooniverse classification export once, into a typed
+#          per-classification table shared by the user accuracy and vote counting stages
+# Usage: from classifications import parse_classifications
+# Author: Jonathan Berkson
+#
+# Only a few fields of each JSON column are needed, so they are pulled out of the raw text by
+# regular expressions instead of decoding every row: the rows of a column are joined into one
+# string and matched in a single findall. The expressions accept only well-formed JSON whose
+# strings have no escapes, nested up to JSON_DEPTH levels, and give what json.loads would
+# (None for a missing key). Rows they do not accept (escapes, repeated keys, several survey
+# answers, broken JSON, ...) are decoded with json.loads as before and counted as fallback
+# rows in the metrics. Likewise, timestamps in the usual ISO layout are read for the whole
+# column at once from a character array, and only other layouts go through datetime.
+##############################################################################################
+
+# Columns of the classification export that parse_classifications reads
+EXPORT_COLUMNS = ['user_name', 'subject_ids', 'metadata', 'subject_data', 'annotations']
+
+# Columns of the parsed per-classification table, in order
+PARSED_COLUMNS = [
+    'user_name',     # Zooniverse user name
+    'subject_ids',   # subject id column of the export (used for user accuracy)
+    'subject_key',   # first key of subject_data (used for vote counting), <NA> if unreadable
+    'choice',        # top-level answer, e.g. TRACK / CASCADE / SKIMMING, None if unreadable
+    'track_type',    # WHATTYPEOFTRACKISIT answer, None if not given
+    'started_at',    # metadata.started_at string, None if missing
+    'finished_at',   # metadata.finished_at string, None if missing
+    'time_spent',    # finished_at - started_at in seconds, NaN if unreadable
+]
+
+JSON_DEPTH = 4  # nesting of the other members accepted by the fast path
+
+# === Fast path: regular expressions of JSON without escapes ===
+_WS = r'[ \t\n\r]*'
+_STRING = r'"[^"\\\x00-\x1f]*"'
+_NUMBER = r'-?(?:0|[1-9][0-9]*)(?:\.[0-9]+)?(?:[eE][+-]?[0-9]+)?'
+
+
+def _capture(name):
+    # A string member value, captured with its quotes (so "" is told from a missing key)
+    return rf'(?P<{name}>"[^"\\\x00-\x1f]*")'
+
+
+def _items(item, close):
+    # Zero or more items separated by commas, up to the closing bracket
+    return rf'(?:{item}{_WS}(?:,{_WS}(?!\{close})|(?=\{close})))*\{close}'
+
+
+def _json_value(depth):
+    value = rf'(?:{_STRING}|{_NUMBER}|true|false|null)'
+    for _ in range(depth):
+        value = (rf'(?:{_STRING}|{_NUMBER}|true|false|null'
+                 rf'|\[{_WS}{_items(value, "]")}'
+                 rf'|\{{{_WS}{_items(rf"{_STRING}{_WS}:{_WS}{value}", "}")})')
+    return value
+
+
+_VALUE = _json_value(JSON_DEPTH)
+
+
+def _json_object(fields, unique=()):
+    # Object whose members named in fields ({key: pattern}) match their pattern and the others
+    # any value. Of repeated keys the last one counts, as in json.loads; a unique key (an object
+    # with captures inside) found again later in the string is left to the fallback instead.
+    members = [rf'"{key}"{_WS}:{_WS}{pattern}' + (rf'(?![^\x00]*"{key}"{_WS}:)' if key in unique else '')
+               for key, pattern in fields.items()]
+    members.append(''.join(f'(?!"{key}")' for key in fields) + rf'{_STRING}{_WS}:{_WS}{_VALUE}')
+    return rf'\{{{_WS}{_items("(?:" + "|".join(members) + ")", "}")}'
+
+
+def _json_array(first):
+    # Array whose first item matches first
+    return rf'\[{_WS}{first}{_WS}(?:,{_WS}(?!\])|(?=\])){_items(_VALUE, "]")}'
+
+
+def _column_pattern(pattern):
+    # One row of a column joined by NUL characters (which JSON only has escaped): the fields of
+    # a row matching pattern, with its opening bracket as 'matched', or else nothing
+    return re.compile(rf'(?:{_WS}(?=(?P<matched>[\[{{])){pattern}{_WS}(?=\x00)|[^\x00]*)\x00')
+
+
+# annotations[0]['value'][0]: 'choice' and answers.WHATTYPEOFTRACKISIT
+ANNOTATIONS_PATTERN = _column_pattern(_json_array(_json_object({
+    'value': _json_array(_json_object({
+        'choice': _capture('choice'),
+        'answers': _json_object({'WHATTYPEOFTRACKISIT': _capture('track_type')}),
+    }, unique=('answers',))),
+}, unique=('value',))))
+# metadata.started_at and metadata.finished_at
+METADATA_PATTERN = _column_pattern(_json_object({
+    'started_at': _capture('started_at'),
+    'finished_at': _capture('finished_at'),
+}))
+# First key of subject_data, when it is a number
+SUBJECT_DATA_PATTERN = _column_pattern(
+    rf'\{{{_WS}(?P<subject_key>"[0-9]+"){_WS}:{_WS}{_VALUE}{_WS}(?:,{_WS}(?!\}})|(?=\}}))'
+    rf'{_items(rf"{_STRING}{_WS}:{_WS}{_VALUE}", "}")}')
+
+
+# === Fallback: json.loads of the rows the fast path does not match ===
+def _decode_annotations(annot_str):
+    try:
+        value = json.loads(annot_str)[0]['value'][0]
+        return {'choice': value['choice'], 'track_type': value.get('answers', {}).get('WHATTYPEOFTRACKISIT')}
+    except Exception:
+        return {'choice': None, 'track_type': None}
+
+
+def _decode_metadata(meta_str):
+    try:
+        meta = json.loads(meta_str)
+        return {'started_at': meta.get('started_at'), 'finished_at': meta.get('finished_at')}
+    except Exception:
+        return {'started_at': None, 'finished_at': None}
+
+
+def _decode_subject_data(subj_str):
+    try:
+        return {'subject_key': int(list(json.loads(subj_str).keys())[0])}
+    except Exception:
+        return {'subject_key': None}
+
+
+# Layout of the timestamps parsed in bulk (e.g. 2025-06-01T12:00:00.000Z): YYYY-MM-DDTHH:MM:SS,
+# then optionally 1 to 6 fraction digits, then optionally Z or +HH:MM / -HH:MM
+STAMP_WIDTH = 32  # longest such stamp
+STAMP_DIGITS = [0, 1, 2, 3, 5, 6, 8, 9, 11, 12, 14, 15, 17, 18]
+STAMP_SEPARATORS = {4: '-', 7: '-', 10: 'T', 13: ':', 16: ':'}
+DAYS_IN_MONTH = np.array([0, 31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])
+EPOCH = datetime(1970, 1, 1)
+EPOCH_UTC = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def _parse_time(stamp):
+    return datetime.fromisoformat(stamp.replace('Z', '+00:00'))
+
+
+def _column(classif, name):
+    # Columns left out of a pruned read (e.g. usecols=...) come back as all-missing
+    if name in classif.columns:
+        return classif[name].to_numpy()
+    return np.full(len(classif), None, dtype=object)
+
+
+def _extract(pattern, values, decode):
+    ''' Fields of a JSON column: the groups of pattern on the rows it matches, decode() on the
+    other strings, None for missing values. Returns {field: list}, the matched rows and the
+    positions of the fallback rows. '''
+    try:
+        text = '\x00'.join(values)
+    except TypeError:  # missing values
+        text = '\x00'.join(value if isinstance(value, str) else '' for value in values)
+    if text.count('\x00') != max(len(values) - 1, 0):
+        # NULs inside a row would split it; those rows are left to the fallback
+        text = '\x00'.join(value if isinstance(value, str) and '\x00' not in value else '' for value in values)
+
+    # All rows in one pass; groups a row does not have come back as ''
+    columns = list(zip(*pattern.findall(text + '\x00'))) if len(values) else [()] * pattern.groups
+    matched = np.array(columns[pattern.groupindex['matched'] - 1], dtype=str) != ''
+    fields = {name: [value[1:-1] if value else None for value in columns[number - 1]]
+              for name, number in pattern.groupindex.items() if name != 'matched'}
+
+    fallback = np.array([i for i in np.flatnonzero(~matched) if isinstance(values[i], str)], dtype=np.int64)
+    for i in fallback:
+        for name, value in decode(values[i]).items():
+            fields[name][i] = value
+    return fields, matched, fallback
+
+
+def _civil_days(year, month, day):
+    ''' Days from 1970-01-01 to each proleptic Gregorian date (arrays of year >= 1) '''
+    year = year - (month <= 2)
+    era, year_of_era = np.divmod(year, 400)
+    day_of_year = (153 * ((month + 9) % 12) + 2) // 5 + day - 1
+    day_of_era = year_of_era * 365 + year_of_era // 4 - year_of_era // 100 + day_of_year
+    return era * 146097 + day_of_era - 719468
+
+
+def _bulk_timestamps(stamps):
+    ''' (microseconds, has offset, parsed) of the stamps in the bulk layout, read as digits of
+    one character array. Stamps in any other layout, or with an impossible date, are not parsed. '''
+    stamps = pd.Series(stamps, dtype=object).to_numpy()  # 1-D even if the values are lists
+    n = len(stamps)
+    # Only strings without NULs (which the fixed-width array would drop) are candidates
+    try:
+        plain = '\x00'.join(stamps).count('\x00') == n - 1
+    except TypeError:
+        plain = False
+    if plain:
+        ok = np.ones(n, dtype=bool)
+    else:
+        ok = np.fromiter((isinstance(stamp, str) and '\x00' not in stamp for stamp in stamps), dtype=bool, count=n)
+        stamps = np.where(ok, stamps, '')
+    text = stamps.astype(f'U{STAMP_WIDTH + 1}')  # longer stamps are cut to STAMP_WIDTH + 1 and fail below
+    lengths = np.char.str_len(text)
+    raw = text.view(np.uint32).reshape(n, STAMP_WIDTH + 1)
+    rows = np.arange(n)
+
+    def number(columns):
+        value = np.zeros(n, dtype=np.int64)
+        for column in columns:
+            value = value * 10 + raw[:, column] - ord('0')
+        return value
+
+    ok &= (raw[:, STAMP_DIGITS] - ord('0') < 10).all(axis=1)  # characters below '0' wrap around
+    for column, separator in STAMP_SEPARATORS.items():
+        ok &= raw[:, column] == ord(separator)
+    year, month, day = number([0, 1, 2, 3]), number([5, 6]), number([8, 9])
+    hour, minute, second = number([11, 12]), number([14, 15]), number([17, 18])
+
+    # Fraction: the run of digits after the '.', 1 to 6 of them, scaled to microseconds
+    has_fraction = raw[:, 19] == ord('.')
+    n_fraction = np.where(has_fraction, np.argmin(raw[:, 20:27] - ord('0') < 10, axis=1), 0)  # 0 if none or 7
+    ok &= ~has_fraction | (n_fraction > 0)
+    fraction = np.zeros(n, dtype=np.int64)
+    for place in range(6):
+        fraction += np.where(place < n_fraction, raw[:, 20 + place].astype(np.int64) - ord('0'), 0) * 10 ** (5 - place)
+
+    # Suffix: nothing, Z or a +HH:MM / -HH:MM offset, which must end the stamp
+    suffix_at = np.where(has_fraction, 20 + n_fraction, 19)
+    sign = raw[rows, suffix_at]
+    zulu = sign == ord('Z')
+    offset = (sign == ord('+')) | (sign == ord('-'))
+    offset_seconds = np.zeros(n, dtype=np.int64)
+    signed = np.flatnonzero(offset)
+    suffix = raw[signed[:, None], suffix_at[signed, None] + np.arange(6)].astype(np.int64) - ord('0')
+    hours, minutes = suffix[:, 1] * 10 + suffix[:, 2], suffix[:, 4] * 10 + suffix[:, 5]
+    offset[signed] = ((suffix[:, 3] == ord(':') - ord('0')) & (suffix[:, [1, 2, 4, 5]] >= 0).all(axis=1)
+                      & (suffix[:, [1, 2, 4, 5]] <= 9).all(axis=1) & (hours <= 23) & (minutes <= 59))
+    offset_seconds[signed] = np.where(sign[signed] == ord('-'), -1, 1) * (hours * 3600 + minutes * 60)
+    ok &= lengths == suffix_at + np.select([zulu, offset], [1, 6], 0)
+
+    leap = (year % 4 == 0) & ((year % 100 != 0) | (year % 400 == 0))
+    ok &= (year >= 1) & (month >= 1) & (month <= 12) & (hour <= 23) & (minute <= 59) & (second <= 59)
+    ok &= (day >= 1) & (day <= DAYS_IN_MONTH[np.clip(month, 0, 12)] + (leap & (month == 2)))
+
+    seconds = _civil_days(year, month, day) * 86400 + hour * 3600 + minute * 60 + second - offset_seconds
+    return np.where(ok, seconds * 10**6 + fraction, 0), ok & (zulu | offset), ok
+
+
+def _timestamps(stamps):
+    ''' Microseconds since 1970 (UTC when the stamp has an offset), whether each stamp has an
+    offset, and whether it could be read. Stamps in the layout exports use are parsed in bulk;
+    any other is parsed on its own with _parse_time. '''
+    micros, aware, readable = _bulk_timestamps(stamps)
+    for i in np.flatnonzero(~readable):
+        try:
+            stamp = _parse_time(stamps[i])
+        except Exception:
+            continue
+        aware[i] = stamp.tzinfo is not None
+        micros[i] = (stamp - (EPOCH_UTC if aware[i] else EPOCH)) // timedelta(microseconds=1)
+        readable[i] = True
+    return micros, aware, readable
+
+
+def time_spent_seconds(started_at, finished_at):
+    ''' finished_at - started_at in seconds for every row at once, NaN where either stamp is
+    missing or unreadable (or only one of them has an offset), as _parse_time would give '''
+    started, started_aware, started_ok = _timestamps(started_at)
+    finished, finished_aware, finished_ok = _timestamps(finished_at)
+    readable = started_ok & finished_ok & (started_aware == finished_aware)
+    micros = finished - started
+    seconds = np.where(readable, micros / 1e6, np.nan)
+    # Spans over 2^53 microseconds (centuries) are not exact as floats; divide them as Python ints
+    for i in np.flatnonzero(readable & (np.abs(micros) >= 2**53)):
+        seconds[i] = int(micros[i]) / 10**6
+    return seconds
+
+
+def parse_classifications(classif, metrics=None, counted=()):
+    ''' Decode annotations, metadata and subject_data of every classification exactly once.
+    Any of these columns may be absent from classif; their parsed fields are then left missing.
+    The rows that needed the json.loads fallback are counted under 'parse' in metrics. Rows
+    parsed again for more columns (the second streaming pass) name the columns already counted
+    in counted, so each classification and each fallback is counted once. '''
+    annotations, matched, annotations_fallback = _extract(
+        ANNOTATIONS_PATTERN, _column(classif, 'annotations'), _decode_annotations)
+    metadata, _, metadata_fallback = _extract(METADATA_PATTERN, _column(classif, 'metadata'), _decode_metadata)
+    subject_data, _, subject_data_fallback = _extract(
+        SUBJECT_DATA_PATTERN, _column(classif, 'subject_data'), _decode_subject_data)
+
+    # Without a choice, json.loads stops at value['choice'] and the track type is not read either
+    # (fallback values can be lists, so the arrays go through Series to stay 1-D)
+    track_type = pd.Series(annotations['track_type'], dtype=object).to_numpy(copy=True)
+    track_type[matched & pd.isna(pd.Series(annotations['choice'], dtype=object).to_numpy())] = None
+
+    if metrics is not None:
+        fallbacks = {'annotations': annotations_fallback, 'metadata': metadata_fallback, 'subject_data': subject_data_fallback}
+        new = np.array([], dtype=np.int64)
+        for column, fallback in fallbacks.items():
+            if column not in counted:
+                new = np.union1d(new, fallback)
+        for column in counted:
+            new = np.setdiff1d(new, fallbacks[column])  # those rows were counted as fallback rows already
+        metrics.add('parse', {
+            'rows': 0 if counted else len(classif),
+            'fallback_rows': len(new),
+            **{f'fallback_{column}': len(fallback) for column, fallback in fallbacks.items() if column not in counted},
+        })
+
+    return pd.DataFrame({
+        'user_name': _column(classif, 'user_name'),
+        'subject_ids': _column(classif, 'subject_ids'),
+        'subject_key': pd.array([None if key is None else int(key) for key in subject_data['subject_key']], dtype='Int64'),
+        'choice': pd.Series(annotations['choice'], dtype=object),
+        'track_type': pd.Series(track_type, dtype=object),
+        'started_at': pd.Series(metadata['started_at'], dtype=object),
+        'finished_at': pd.Series(metadata['finished_at'], dtype=object),
+        'time_spent': time_spent_seconds(metadata['started_at'], metadata['finished_at']),
+    }, columns=PARSED_COLUMNS)
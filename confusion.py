@@ -0,0 +1,82 @@
+import numpy as np
+import pandas as pd
+
+##############################################################################################
+#                                       confusion.py
+##############################################################################################
+# Purpose: Confusion matrices of predicted vs. true categories, counted with one bincount and
+#          normalized per truth column, for any list of categories
+# Usage: from confusion import count_frame, fraction_frame, annotation_frame
+# Author: Jonathan Berkson
+#
+# Rows are the predicted category and columns the true one, in the order of the category list.
+# Labels outside the list (or missing) are left out, as in the original plotters. Matrices are
+# kept as integer counts; fractions and the "12.5%\n3/24" heatmap annotations are derived from
+# the counts when needed. count_matrices counts many matrices at once (e.g. one per bootstrap
+# resample or per cut) from a group code per row, and bootstrap.py counts resamples from the
+# cell codes of the rows.
+##############################################################################################
+
+
+def category_codes(labels, categories):
+    ''' Position of each label in categories, -1 if missing or not in the list '''
+    return pd.Index(categories).get_indexer(pd.Series(labels, dtype=object)).astype(np.int64)
+
+
+def count_matrices(predicted, truth, n_categories, groups=None, n_groups=1):
+    ''' (n_groups, n, n) counts of category codes, rows predicted and columns true.
+    groups gives each row's matrix (0..n_groups-1); rows with a negative code are skipped. '''
+    n = n_categories
+    keep = (predicted >= 0) & (truth >= 0)
+    cells = predicted[keep] * n + truth[keep]
+    if groups is not None:
+        cells = cells + groups[keep] * (n * n)
+    return np.bincount(cells, minlength=n_groups * n * n).reshape(n_groups, n, n)
+
+
+def cell_codes(predicted, truth, n_categories):
+    ''' Matrix cell of each row (predicted * n + true code), n * n for rows left out; counting
+    gathers of these is cheaper than re-pairing predicted and true codes (see bootstrap.py) '''
+    n = n_categories
+    return np.where((predicted >= 0) & (truth >= 0), predicted * n + truth, n * n)
+
+
+def count_matrix(predicted, truth, categories):
+    ''' Counts of predicted (rows) vs. true (columns) labels, as an n x n array '''
+    return count_matrices(category_codes(predicted, categories), category_codes(truth, categories), len(categories))[0]
+
+
+def fractions(counts):
+    ''' Counts divided by their truth column's total (columns with no entries stay 0) '''
+    totals = counts.sum(axis=-2, keepdims=True)
+    return counts / np.maximum(totals, 1)
+
+
+def count_frame(predicted, truth, categories):
+    ''' Count matrix as a DataFrame labelled by categories '''
+    return pd.DataFrame(count_matrix(predicted, truth, categories), index=categories, columns=categories)
+
+
+def fraction_frame(counts):
+    ''' Column fractions of a count DataFrame '''
+    return pd.DataFrame(fractions(counts.to_numpy()), index=counts.index, columns=counts.columns)
+
+
+def ratio_frame(counts):
+    ''' "count/column total" strings of a count DataFrame, for printing '''
+    totals = counts.sum(axis=0)
+    return counts.apply(lambda column: column.astype(str) + f"/{totals[column.name]}")
+
+
+def annotation_frame(counts):
+    ''' Heatmap annotations of a count DataFrame: percentage of the column over "count/total" '''
+    percent = fraction_frame(counts) * 100
+    return percent.map(lambda value: f"{value:.1f}%") + "\n" + ratio_frame(counts)
+
+
+def interval_annotation_frame(counts, low, high):
+    ''' annotation_frame with each fraction's interval (low and high fraction DataFrames) under
+    the percentage '''
+    percent = fraction_frame(counts) * 100
+    interval = (low * 100).map(lambda value: f"[{value:.1f}") + (high * 100).map(lambda value: f", {value:.1f}]")
+    return percent.map(lambda value: f"{value:.1f}%") + "\n" + interval + "\n" + ratio_frame(counts)
@@ -0,0 +1,95 @@
+import numpy as np
+
+##############################################################################################
+#                                       consensus.py
+##############################################################################################
+# Purpose: Skill-weighted consensus of the votes of each subject (Dawid–Skene EM), an
+#          alternative to the plain majority of reducer.py
+# Usage: from consensus import DawidSkene
+# Author: Jonathan Berkson
+#
+# Every user gets a confusion matrix, the probability of voting each category for a subject
+# of each true class, and every subject a posterior over the classes. The two are estimated in
+# turn: the E-step scores each subject's classes with the log probabilities of its votes, and the
+# M-step re-counts each user's votes weighted by the posteriors of their subjects. Votes are
+# sparse (user, subject row, category, weight) entries, so both steps are one bincount per class
+# over the entries, never a loop over votes. User matrices start from the users' accuracy against
+# the truth labels (the reducers' user stats): the accuracy on the diagonal, the rest spread
+# evenly. A small pseudo-count keeps every probability above zero. Entries are sorted by subject
+# once, so the per-subject gathers and bincounts walk memory in order.
+##############################################################################################
+
+DEFAULT_TOLERANCE = 1e-4      # stop once no posterior moves by more than this
+DEFAULT_MAX_ITERATIONS = 500
+PSEUDO_COUNT = 0.01           # added to every user matrix cell and class count
+
+
+class DawidSkene:
+    def __init__(self, n_subjects, n_categories):
+        self.n_subjects = n_subjects
+        self.n_categories = n_categories
+        self.tolerance = DEFAULT_TOLERANCE
+        self.max_iterations = DEFAULT_MAX_ITERATIONS
+        self.iterations = 0       # EM iterations of the last fit
+        self.converged = False
+
+    def seed_matrices(self, accuracy):
+        ''' (n_users, n, n) user matrices [user, true class, vote] from each user's accuracy
+        (NaN for users without truth-labelled votes takes the mean of the others) '''
+        n = self.n_categories
+        accuracy = np.asarray(accuracy, dtype=np.float64)
+        known = ~np.isnan(accuracy)
+        accuracy = np.where(known, accuracy, accuracy[known].mean() if known.any() else 1 / n)
+        accuracy = np.clip(accuracy, PSEUDO_COUNT, 1 - PSEUDO_COUNT)
+        off_diagonal = (1 - accuracy) / max(n - 1, 1)
+        matrices = np.repeat(off_diagonal[:, None, None], n, axis=1).repeat(n, axis=2)
+        matrices[:, np.arange(n), np.arange(n)] = accuracy[:, None]
+        return matrices
+
+    def fit(self, users, rows, codes, weights, accuracy):
+        ''' Posteriors (n_subjects, n) of the sparse votes (user codes, subject rows, category codes,
+        vote counts), seeded from the accuracy of each user code. Subjects without votes keep the
+        class priors. '''
+        n, n_subjects = self.n_categories, self.n_subjects
+        order = np.argsort(rows, kind='stable')
+        users, rows, codes = np.asarray(users)[order], np.asarray(rows)[order], np.asarray(codes)[order]
+        weights = np.asarray(weights, dtype=np.float64)[order]
+        log_matrices = np.log(self.seed_matrices(accuracy))
+        n_users = len(log_matrices)
+        # Flat index of each entry's [user, class 0, vote] matrix cell, and of its (user, vote) count
+        cells = users * n * n + codes
+        user_votes = users * n + codes
+        voted = np.bincount(rows, weights=weights, minlength=n_subjects) > 0
+        # Start the class priors from the vote shares
+        priors = np.bincount(codes, weights=weights, minlength=n) + PSEUDO_COUNT
+        priors /= priors.sum()
+        posteriors = np.tile(priors, (n_subjects, 1))
+
+        self.iterations, self.converged = 0, False
+        while self.iterations < self.max_iterations:
+            self.iterations += 1
+            # E-step: log prior plus the log probability of every vote, per class
+            flat = log_matrices.ravel()
+            scores = np.log(priors) + np.stack([
+                np.bincount(rows, weights=weights * flat[cells + k * n], minlength=n_subjects)
+                for k in range(n)], axis=1)
+            scores -= scores.max(axis=1, keepdims=True)
+            updated = np.exp(scores)
+            updated /= updated.sum(axis=1, keepdims=True)
+            updated[~voted] = priors
+
+            change = np.abs(updated - posteriors).max(initial=0)
+            posteriors = updated
+            if change < self.tolerance:
+                self.converged = True
+                break
+
+            # M-step: each user's votes weighted by the class posteriors of their subjects
+            weighted = posteriors.take(rows, axis=0) * weights[:, None]
+            counts = np.stack([
+                np.bincount(user_votes, weights=weighted[:, k], minlength=n_users * n).reshape(n_users, n)
+                for k in range(n)], axis=1) + PSEUDO_COUNT
+            log_matrices = np.log(counts / counts.sum(axis=2, keepdims=True))
+            priors = posteriors[voted].sum(axis=0) + PSEUDO_COUNT
+            priors /= priors.sum()
+        return posteriors
@@ -1,6 +1,10 @@
 import os
+import numpy as np
 import pandas as pd
-from types import MethodType
+
+from matched_store import load_matched
+from metrics import Metrics
+from tables import csv_path, load_concurrently, parse_compression, read_table
 
 ##############################################################################################
 #                                       consolidator.py
@@ -10,6 +14,35 @@ from types import MethodType
 # Author: Jonathan Berkson (updated 1/14/26)
 ##############################################################################################
 
+# ntn_category codes of the DNN classifier
+ntn_label_mapping = {
+    0: 'SKIMMING',
+    1: 'CASCADE',
+    2: 'THROUGHGOINGTRACK',
+    3: 'STARTINGTRACK',
+    4: 'STOPPINGTRACK'
+}
+track_types = {"THROUGHGOINGTRACK", "STARTINGTRACK", "STOPPINGTRACK"}
+
+# Columns of matched_sim_data carried into the consolidated file
+DNN_COLUMNS = [
+    'subject_id', 'filename', 'run', 'event', 'truth_classification',
+    'pred_skim', 'pred_cascade', 'pred_tgtrack', 'pred_starttrack', 'pred_stoptrack',
+    'energy', 'zenith', 'oneweight', 'signal_charge', 'bg_charge',
+    'qratio', 'qtot', 'max_score_val', 'idx_max_score', 'ntn_category'
+]
+
+
+def max_score_labels(scores, labels):
+    ''' Label of each row's highest score column, ignoring NaN (first column wins ties, None if all NaN) '''
+    values = scores.to_numpy(dtype=float)
+    missing = np.isnan(values)
+    filled = np.where(missing, -np.inf, values)
+    is_max = (filled == filled.max(axis=1, keepdims=True, initial=-np.inf)) & ~missing
+    best = np.where(is_max.any(axis=1), is_max.argmax(axis=1), len(labels))
+    return pd.Series(np.array(list(labels) + [None], dtype=object)[best], index=scores.index, dtype=object)
+
+
 class Consolidator:
     def __init__(self, input_dir, output_dir, retirement_lim, agreement_cut):
         self.input_dir = input_dir
@@ -19,6 +52,116 @@ class Consolidator:
         self.classif_path = None
         self.matched_path = None
         self.output_file = None
+        self.use_cache = True     # load matched_sim_data from its memory-mapped store (see matched_store.py)
+        self.compression = None   # write the output compressed: a tables.COMPRESSIONS key, None for plain
+        self.metrics = Metrics()  # stage timings and row counts of the run (see metrics.py)
+
+    def consolidate(self):
+        # Load both inputs at the same time (physics columns at full precision, since they are written back out)
+        inputs = load_concurrently({'reduced': self.load_reduced, 'matched': self.load_dnn_data})
+        cdf = self.consolidate_frames(inputs['reduced'], inputs['matched'])
+
+        # === Save output ===
+        os.makedirs(self.output_dir, exist_ok=True)
+        csv_name = csv_path(self.output_dir, self.output_file, self.compression)
+        with self.metrics.stage('write', rows_in=len(cdf)):
+            cdf.to_csv(csv_name, index=False)
+
+        return csv_name
+
+    def load_reduced(self):
+        with self.metrics.load(self.classif_path) as stage:
+            user_data = read_table(self.classif_path, 'reduced')
+            stage.add_rows(rows_out=len(user_data))
+        return self.check_user_data(user_data)
+
+    def load_dnn_data(self):
+        with self.metrics.load(self.matched_path) as stage:
+            dnn_sim_data = load_matched(self.matched_path, columns=DNN_COLUMNS, compact=False, use_cache=self.use_cache)
+            stage.add_rows(rows_out=len(dnn_sim_data))
+        return dnn_sim_data
+
+    def check_user_data(self, user_data):
+        ''' Reduced DataFrame with stripped column names, checked for the required columns '''
+        user_data.columns = user_data.columns.str.strip()
+
+        # Check required columns
+        required_cols = ['subject_id', 'event_id', 'data.num_votes', 'data.most_likely', 'data.agreement']
+        missing = [col for col in required_cols if col not in user_data.columns]
+        if missing:
+            raise KeyError(f"Missing expected columns in classification file: {missing}")
+        return user_data
+
+    def consolidate_frames(self, user_data, dnn_sim_data):
+        ''' Consolidate a reduced DataFrame with the matched simulation DataFrame '''
+        user_data = self.check_user_data(user_data)
+
+        with self.metrics.stage('merge', rows_in=len(user_data) + len(dnn_sim_data)) as stage:
+            # === Prepare user DataFrame ===
+            subj_user_data = pd.DataFrame({
+                'subject_id': user_data['subject_id'],
+                'filename': None,  # placeholder: dropped after the merge (filename_x)
+                'run': [None] * len(user_data),
+                'event': user_data['event_id'],
+                'data.num_votes': user_data['data.num_votes'],
+                'data.most_likely': user_data['data.most_likely'],
+                'data.agreement': user_data['data.agreement']
+            })
+
+            # === Apply retirement limit: keep only subjects with enough votes ===
+            if self.retirement_lim is not None and self.retirement_lim > 0:
+                subj_user_data = subj_user_data[subj_user_data['data.num_votes'] >= self.retirement_lim]
+            dropped_lim = len(user_data) - len(subj_user_data)
+
+            # === Merge with DNN simulation data ===
+            cdf = pd.merge(subj_user_data, dnn_sim_data[DNN_COLUMNS], on='subject_id', how='outer')
+            cdf.drop(columns=['filename_x', 'run_x', 'event_x', 'run_y', 'event_y'], inplace=True, errors='ignore')
+
+            # === Apply agreement_cut after merge ===
+            merged = len(cdf)
+            if 'data.agreement' in cdf.columns:
+                cdf = cdf[cdf['data.agreement'] >= self.agreement_cut]
+            stage.add_rows(rows_out=len(cdf))
+
+        with self.metrics.stage('derive', rows_in=len(cdf)):
+            # === Unify track labels ===
+            most_likely = cdf['data.most_likely']
+            cdf['data.most_likely'] = most_likely.mask(most_likely.astype(str).str.upper().isin(track_types), 'TRACK')
+
+            # === Consolidate DNN track predictions ===
+            cdf['pred_track'] = cdf[['pred_tgtrack', 'pred_starttrack', 'pred_stoptrack']].sum(axis=1)
+            cdf.drop(columns=['pred_tgtrack', 'pred_starttrack', 'pred_stoptrack'], inplace=True)
+            insert_at = cdf.columns.get_loc('pred_cascade') + 1
+            cdf.insert(insert_at, 'pred_track', cdf.pop('pred_track'))
+
+            # === Update max_score_val ===
+            cdf['max_score_val'] = cdf[['pred_skim', 'pred_cascade', 'pred_track']].max(axis=1)
+
+            # === Update idx_max_score robustly ===
+            label_mapping = {
+                'pred_skim': 'SKIMMING',
+                'pred_cascade': 'CASCADE',
+                'pred_track': 'TRACK'
+            }
+            cdf['idx_max_score'] = max_score_labels(cdf[list(label_mapping)], list(label_mapping.values()))
+
+            # === Map ntn_category and collapse track types ===
+            cdf['ntn_category'] = cdf['ntn_category'].map(
+                {code: 'TRACK' if label in track_types else label for code, label in ntn_label_mapping.items()}
+            )
+
+            # === Compute accuracies ===
+            cdf['user_accuracy'] = (cdf['data.most_likely'] == cdf['ntn_category']).astype(int)
+            cdf['DNN_accuracy'] = (cdf['idx_max_score'] == cdf['ntn_category']).astype(int)
+
+        self.metrics.count('consolidate', {
+            'reduced_subjects': len(user_data),
+            'matched_subjects': len(dnn_sim_data),
+            'dropped_retirement_lim': dropped_lim,
+            'dropped_agreement_cut': merged - len(cdf),
+            'consolidated_rows': len(cdf),
+        })
+        return cdf
 
 
 if __name__ == '__main__':
@@ -30,6 +173,9 @@ if __name__ == '__main__':
     matched_file = input("Enter matched_sim_data CSV filename: ").strip()
     output_file = input("Enter output filename (without .csv): ").strip()
     agreement_cut = float(input("Enter agreement cutoff (e.g. 0.6 to keep rows with >=60% agreement): "))
+    compression = parse_compression(input("Compress the output CSV? (gz, bz2, xz or zip, blank for plain): "))
+    metrics_file = input("Metrics JSON filename for stage timings and row counts (blank to skip): ").strip()
+    profile = bool(metrics_file) and input("Also capture a cProfile of the run? (y/n): ").strip().lower() == 'y'
 
     print("\nConsolidating... (this might take a few seconds)\n")
 
@@ -42,113 +188,12 @@ if __name__ == '__main__':
     consolidator.classif_path = classif_path
     consolidator.matched_path = matched_path
     consolidator.output_file = output_file
+    consolidator.compression = compression
+    consolidator.metrics = Metrics('consolidator.py', profile=profile)
+    consolidator.metrics.params = {'retirement_lim': lim, 'agreement_cut': agreement_cut, 'reduced': classif_path}
 
-    # === Define consolidate method dynamically ===
-    def patched_consolidate(self):
-        # Load CSVs
-        user_data = pd.read_csv(self.classif_path)
-        user_data.columns = user_data.columns.str.strip()
-        dnn_sim_data = pd.read_csv(self.matched_path)
-
-        # Check required columns
-        required_cols = ['subject_id', 'event_id', 'data.num_votes', 'data.most_likely', 'data.agreement']
-        missing = [col for col in required_cols if col not in user_data.columns]
-        if missing:
-            raise KeyError(f"Missing expected columns in classification file: {missing}")
-
-        # === Prepare user DataFrame ===
-        subj_user_data = pd.DataFrame({
-            'subject_id': user_data['subject_id'],
-            'filename': [f"subject_{sid}_event_{eid}.txt" for sid, eid in zip(user_data['subject_id'], user_data['event_id'])],
-            'run': [None] * len(user_data),
-            'event': user_data['event_id'],
-            'data.num_votes': user_data['data.num_votes'],
-            'data.most_likely': user_data['data.most_likely'],
-            'data.agreement': user_data['data.agreement']
-        })
-
-        # === Apply retirement limit: keep only subjects with enough votes ===
-        if self.retirement_lim is not None and self.retirement_lim > 0:
-            subj_user_data = subj_user_data[subj_user_data['data.num_votes'] >= self.retirement_lim]
-
-        # === Merge with DNN simulation data ===
-        dnn_data = dnn_sim_data[[
-            'subject_id', 'filename', 'run', 'event', 'truth_classification',
-            'pred_skim', 'pred_cascade', 'pred_tgtrack', 'pred_starttrack', 'pred_stoptrack',
-            'energy', 'zenith', 'oneweight', 'signal_charge', 'bg_charge',
-            'qratio', 'qtot', 'max_score_val', 'idx_max_score', 'ntn_category'
-        ]].copy()
-
-        cdf = pd.merge(subj_user_data, dnn_data, on='subject_id', how='outer')
-        cdf.drop(columns=['filename_x', 'run_x', 'event_x', 'run_y', 'event_y'], inplace=True, errors='ignore')
-
-        # === Apply agreement_cut after merge ===
-        if 'data.agreement' in cdf.columns:
-            cdf = cdf[cdf['data.agreement'] >= self.agreement_cut]
-
-        # === Unify track labels ===
-        track_types = {"THROUGHGOINGTRACK", "STARTINGTRACK", "STOPPINGTRACK"}
-        cdf['data.most_likely'] = cdf['data.most_likely'].apply(
-            lambda x: 'TRACK' if isinstance(x, str) and x.upper() in track_types else x
-        )
-
-        # === Consolidate DNN track predictions ===
-        cdf['pred_track'] = cdf[['pred_tgtrack', 'pred_starttrack', 'pred_stoptrack']].sum(axis=1)
-        cdf.drop(columns=['pred_tgtrack', 'pred_starttrack', 'pred_stoptrack'], inplace=True)
-        insert_at = cdf.columns.get_loc('pred_cascade') + 1
-        cdf.insert(insert_at, 'pred_track', cdf.pop('pred_track'))
-
-        # === Update max_score_val ===
-        cdf['max_score_val'] = cdf[['pred_skim', 'pred_cascade', 'pred_track']].max(axis=1)
-
-        # === Update idx_max_score robustly ===
-        score_columns = ['pred_skim', 'pred_cascade', 'pred_track']
-        label_mapping = {
-            'pred_skim': 'SKIMMING',
-            'pred_cascade': 'CASCADE',
-            'pred_track': 'TRACK'
-        }
-
-        def safe_label(row):
-            vals = {col: row[col] for col in score_columns if pd.notnull(row[col])}
-            if not vals:
-                return None
-            return label_mapping[max(vals, key=vals.get)]
-
-        cdf['idx_max_score'] = cdf.apply(safe_label, axis=1)
-
-        # === Map ntn_category and collapse track types ===
-        ntn_label_mapping = {
-            0: 'SKIMMING',
-            1: 'CASCADE',
-            2: 'THROUGHGOINGTRACK',
-            3: 'STARTINGTRACK',
-            4: 'STOPPINGTRACK'
-        }
-        cdf['ntn_category'] = cdf['ntn_category'].map(ntn_label_mapping)
-        cdf['ntn_category'] = cdf['ntn_category'].apply(
-            lambda x: 'TRACK' if isinstance(x, str) and x in track_types else x
-        )
-
-        # === Compute accuracies ===
-        cdf['user_accuracy'] = cdf.apply(
-            lambda row: int(row['data.most_likely'] == row['ntn_category']),
-            axis=1
-        )
-        cdf['DNN_accuracy'] = cdf.apply(
-            lambda row: int(row['idx_max_score'] == row['ntn_category']),
-            axis=1
-        )
-
-        # === Save output ===
-        os.makedirs(self.output_dir, exist_ok=True)
-        csv_name = os.path.join(self.output_dir, f"{self.output_file}.csv")
-        cdf.to_csv(csv_name, index=False)
-
-        return csv_name
-
-    # === Bind and execute the patched method ===
-    consolidator.consolidate = MethodType(patched_consolidate, consolidator)
-    csv_path = consolidator.consolidate()
+    output_path = consolidator.consolidate()
+    if metrics_file:
+        consolidator.metrics.write(os.path.join(output_dir, metrics_file))
 
-    print(f"Consolidation complete. Output saved at:\n{csv_path}")
+    print(f"Consolidation complete. Output saved at:\n{output_path}")
@@ -0,0 +1,139 @@
+import json
+import os, os.path
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from parse_cache import evict, file_digest
+from tables import SCHEMAS, read_table
+
+##############################################################################################
+#                                       matched_store.py
+##############################################################################################
+# Purpose: One-time conversion of matched_sim_data into a memory-mapped columnar store,
+#          shared by the reducers, consolidators, pipeline and sweep
+# Usage: from matched_store import load_matched, open_matched_store
+# Author: Jonathan Berkson
+#
+# Each entry is a directory of .npy files, one per column: numbers as they are (float32 physics
+# columns at full precision, so compact and full reads both match read_table), nullable integers
+# as values + mask, and labels dictionary encoded as integer codes + the distinct values. The
+# files are opened with mmap_mode='r', so loading is a few page mappings, and analyses running
+# at once on the same node share the pages through the page cache. Entries are keyed by a
+# content hash of the CSV and STORE_VERSION, written atomically, and the least recently used
+# ones are evicted above max_bytes (see parse_cache.py).
+##############################################################################################
+
+# Bump whenever the stored format changes so old entries are rebuilt
+STORE_VERSION = 1
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'icecube-phase3', 'matched')
+DEFAULT_MAX_BYTES = 1024**3  # 1 GB
+
+
+def store_key(matched_path):
+    ''' Key of a matched CSV: store version + content hash of the file '''
+    return f"v{STORE_VERSION}-{file_digest(matched_path)}"
+
+
+class MatchedStore:
+    def __init__(self, entry):
+        self.entry = entry
+        with open(os.path.join(entry, 'meta.json')) as f:
+            meta = json.load(f)
+        self.columns = meta['columns']  # in file order
+        self.dtypes = meta['dtypes']    # dtype of each column as read_table(compact=False) gives it
+        self.kinds = meta['kinds']      # 'plain', 'masked' or 'encoded'
+
+    def load(self, name):
+        return np.load(os.path.join(self.entry, name), mmap_mode='r')
+
+    def __len__(self):
+        return len(self.load('subject_id.npy'))  # always a plain column (see write_store)
+
+    def column(self, name, compact=True):
+        kind = self.kinds[name]
+        if kind == 'masked':
+            return pd.arrays.IntegerArray(np.asarray(self.load(f"{name}.npy")), np.asarray(self.load(f"{name}.mask.npy")))
+        if kind == 'encoded':
+            codes = self.load(f"{name}.codes.npy")
+            values = self.load(f"{name}.values.npy")
+            if self.dtypes[name] == 'category':
+                return pd.Categorical.from_codes(codes, categories=pd.Index(values.tolist()))
+            # Index an object array of the distinct values (plus None for code -1) by the codes
+            labels = np.array(values.tolist() + [None], dtype=object)
+            return pd.array(labels[codes], dtype=self.dtypes[name])
+        values = self.load(f"{name}.npy")
+        if compact and SCHEMAS['matched'].get(name) == 'float32':
+            return values.astype(np.float32)
+        return values
+
+    def frame(self, columns=None, compact=True):
+        ''' DataFrame of columns (in file order, as read_table returns them), with read_table's dtypes '''
+        names = [name for name in self.columns if columns is None or name in columns]
+        missing = set(columns or []) - set(self.columns)
+        if missing:
+            raise ValueError(f"Columns not in the matched data: {sorted(missing)}")
+        return pd.DataFrame({name: self.column(name, compact) for name in names}, columns=names)
+
+
+def write_store(entry, matched_path):
+    matched = read_table(matched_path, 'matched', compact=False)
+    cache_dir = os.path.dirname(entry)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp = tempfile.mkdtemp(dir=cache_dir, prefix='.tmp-')
+    try:
+        kinds = {}
+        for name in matched.columns:
+            column = matched[name]
+            if isinstance(column.dtype, pd.CategoricalDtype):
+                kinds[name] = 'encoded'
+                np.save(os.path.join(tmp, f"{name}.codes.npy"), column.cat.codes.to_numpy(np.int32))
+                np.save(os.path.join(tmp, f"{name}.values.npy"), np.asarray(column.cat.categories, dtype=str))
+            elif column.dtype == object or isinstance(column.dtype, pd.StringDtype):
+                # Dictionary encode: codes into the distinct values, -1 for missing
+                kinds[name] = 'encoded'
+                codes, values = pd.factorize(column, use_na_sentinel=True)
+                np.save(os.path.join(tmp, f"{name}.codes.npy"), codes.astype(np.int32))
+                np.save(os.path.join(tmp, f"{name}.values.npy"), np.asarray(values, dtype=str))
+            elif isinstance(column.dtype, pd.api.extensions.ExtensionDtype):
+                kinds[name] = 'masked'
+                np.save(os.path.join(tmp, f"{name}.npy"), column.fillna(0).to_numpy(column.dtype.numpy_dtype))
+                np.save(os.path.join(tmp, f"{name}.mask.npy"), column.isna().to_numpy())
+            else:
+                kinds[name] = 'plain'
+                np.save(os.path.join(tmp, f"{name}.npy"), column.to_numpy())
+        if kinds.get('subject_id') != 'plain':
+            raise ValueError("matched data needs an integer subject_id column without missing values")
+        with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+            json.dump({'columns': list(matched.columns), 'dtypes': {name: str(matched[name].dtype) for name in matched.columns},
+                       'kinds': kinds}, f)
+        # Another process may have written the same entry meanwhile; either copy is valid
+        try:
+            os.rename(tmp, entry)
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+
+
+def open_matched_store(matched_path, cache_dir=None, max_bytes=DEFAULT_MAX_BYTES):
+    ''' MatchedStore of a matched CSV, converting it on first use '''
+    cache_dir = cache_dir or DEFAULT_CACHE_DIR
+    entry = os.path.join(cache_dir, store_key(matched_path))
+    if os.path.isdir(entry):
+        os.utime(entry)  # mark as recently used for eviction
+    else:
+        write_store(entry, matched_path)
+        evict(cache_dir, max_bytes, keep=entry, prefix=f"v{STORE_VERSION}-")
+    return MatchedStore(entry)
+
+
+def load_matched(matched_path, columns=None, compact=True, use_cache=True, cache_dir=None):
+    ''' read_table(matched_path, 'matched', columns, compact), from the store when use_cache is set '''
+    if not use_cache:
+        return read_table(matched_path, 'matched', columns=columns, compact=compact)
+    return open_matched_store(matched_path, cache_dir).frame(columns, compact)
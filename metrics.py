@@ -0,0 +1,191 @@
+import cProfile
+import io
+import json
+import os, os.path
+import pstats
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+try:
+    import resource  # not available on Windows, where memory is reported as null
+except ImportError:
+    resource = None
+
+##############################################################################################
+#                                       metrics.py
+##############################################################################################
+# Purpose: Records wall time, peak memory and rows in/out of each sub-stage of a script
+#          (load, parse, accuracy, vote, aggregate, merge, derive, write, render) and writes
+#          them, with the skip counts, to a JSON metrics file
+# Usage: from metrics import Metrics
+# Author: Jonathan Berkson
+#
+# A stage that runs more than once (e.g. once per streamed chunk) is summed into one entry,
+# with the number of calls. Memory is the process's resident high-water mark: peak_rss_mb is
+# the mark when the stage last finished, and rss_growth_mb how far the stage itself raised it.
+# With profile=True the whole run is also captured with cProfile; the stats are saved next to
+# the metrics file (<metrics>.prof, for snakeviz or pstats) and the top functions are listed in
+# the JSON. Input files are also timed one by one (load), with when each started and finished,
+# since they may be read at the same time on threads; stages are safe to record from threads,
+# but the profile only covers the main thread.
+##############################################################################################
+
+PROFILE_TOP = 25  # functions by cumulative time listed in the metrics file
+
+
+def peak_rss_mb():
+    ''' Peak resident memory of this process in MB, None where unavailable '''
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024**2 if sys.platform == 'darwin' else peak / 1024  # bytes on macOS, KB elsewhere
+
+
+class Stage:
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.seconds = 0.0
+        self.rows_in = None
+        self.rows_out = None
+        self.peak_rss_mb = None
+        self.rss_growth_mb = None
+
+    def add_rows(self, rows_in=None, rows_out=None):
+        ''' Count rows into / out of the stage (summed over calls) '''
+        if rows_in is not None:
+            self.rows_in = (self.rows_in or 0) + int(rows_in)
+        if rows_out is not None:
+            self.rows_out = (self.rows_out or 0) + int(rows_out)
+
+    def as_dict(self):
+        return {
+            'calls': self.calls,
+            'seconds': self.seconds,
+            'rows_in': self.rows_in,
+            'rows_out': self.rows_out,
+            'rows_per_second': self.rows_in / self.seconds if self.rows_in and self.seconds else None,
+            'peak_rss_mb': self.peak_rss_mb,
+            'rss_growth_mb': self.rss_growth_mb,
+        }
+
+
+class Metrics:
+    def __init__(self, script=None, profile=False):
+        self.script = script      # name recorded in the file, e.g. 'reducer.py'
+        self.stages = {}          # stage name → Stage, in the order first run
+        self.counts = {}          # named counters, e.g. {'reduce': {'votes': ..., 'skipped_time': ...}}
+        self.files = {}           # input file name → its load time, rows and start/finish in the run
+        self.params = {}          # settings of the run, recorded as given
+        self.started = time.perf_counter()
+        self.lock = threading.Lock()
+        self.profiler = None
+        if profile:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    def __getstate__(self):
+        # Copies sent to worker processes leave the profiler behind (it cannot be pickled)
+        state = self.__dict__.copy()
+        state['profiler'] = None
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name, rows_in=None):
+        ''' Time a block as (one call of) a stage. Yields the Stage, for add_rows. '''
+        with self.lock:
+            stage = self.stages.setdefault(name, Stage(name))
+            stage.add_rows(rows_in)
+        before = peak_rss_mb()
+        start = time.perf_counter()
+        try:
+            yield stage
+        finally:
+            seconds = time.perf_counter() - start
+            after = peak_rss_mb()
+            with self.lock:
+                stage.seconds += seconds
+                stage.calls += 1
+                if after is not None:
+                    stage.peak_rss_mb = after
+                    stage.rss_growth_mb = (stage.rss_growth_mb or 0) + after - before
+
+    @contextmanager
+    def load(self, path, stage='load'):
+        ''' Time reading one input file, as a call of stage and under files with its start and
+        finish (seconds into the run). Yields the file's Stage, for add_rows(rows_out=...). '''
+        record = Stage(os.path.basename(path))
+        start = time.perf_counter()
+        with self.stage(stage) as total:
+            try:
+                yield record
+            finally:
+                finished = time.perf_counter()
+                record.seconds, record.calls = finished - start, 1
+                with self.lock:
+                    total.add_rows(rows_out=record.rows_out)
+                    self.files[record.name] = {'stage': stage, 'seconds': record.seconds, 'rows': record.rows_out,
+                                               'started': start - self.started, 'finished': finished - self.started}
+
+    def iterate(self, name, iterable, rows=len):
+        ''' Yield from iterable, timing each step as a call of stage name (e.g. reading chunks).
+        rows(item) is counted as the stage's rows out. '''
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name) as stage:
+                item = next(iterator, None)
+                if item is not None:
+                    stage.add_rows(rows_out=rows(item))
+            if item is None:
+                return
+            yield item
+
+    def count(self, group, counts):
+        ''' Record a dict of counters under group (replacing any earlier values) '''
+        self.counts[group] = {key: int(value) for key, value in counts.items()}
+
+    def add(self, group, counts):
+        ''' Add a dict of counters to those already under group (e.g. once per chunk) '''
+        totals = self.counts.setdefault(group, {})
+        for key, value in counts.items():
+            totals[key] = totals.get(key, 0) + int(value)
+
+    def report(self):
+        report = {
+            'script': self.script,
+            'created_at': datetime.now(timezone.utc).isoformat(),
+            'wall_seconds': time.perf_counter() - self.started,
+            'peak_rss_mb': peak_rss_mb(),
+            'params': self.params,
+            'stages': {name: stage.as_dict() for name, stage in self.stages.items()},
+            'counts': self.counts,
+            'files': self.files,
+        }
+        if self.profiler is not None:
+            stats = pstats.Stats(self.profiler, stream=io.StringIO()).sort_stats('cumulative')
+            report['profile'] = [
+                {'function': f"{os.path.basename(file)}:{line}({function})", 'calls': calls,
+                 'total_seconds': total, 'cumulative_seconds': cumulative}
+                for (file, line, function), (_, calls, total, cumulative, _) in
+                sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:PROFILE_TOP]
+            ]
+        return report
+
+    def write(self, path):
+        ''' Write the metrics JSON (and <path>.prof when profiling). Returns path. '''
+        if self.profiler is not None:
+            self.profiler.disable()
+            self.profiler.dump_stats(f"{path}.prof")
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2, default=str)
+        print(f"Metrics saved to: {path}")
+        return path
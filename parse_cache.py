@@ -0,0 +1,178 @@
+import hashlib
+import os, os.path
+import shutil
+import tempfile
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+from classifications import EXPORT_COLUMNS, PARSED_COLUMNS, parse_classifications
+from metrics import Metrics
+from tables import read_table
+
+##############################################################################################
+#                                       parse_cache.py
+##############################################################################################
+# Purpose: Persistent on-disk cache of the parsed per-classification table, so reruns of the
+#          reducers with different cuts skip reading and parsing the classification export
+# Usage: from parse_cache import load_parsed_classifications
+# Author: Jonathan Berkson
+#
+# Each entry is a directory of memory-mappable .npy files, one per column (string columns are
+# dictionary encoded as integer codes + a fixed-width array of distinct values; the rare object
+# column holding other values, such as lists decoded by the json.loads fallback, is pickled).
+# Entries are keyed by a content hash of the export and PARSER_VERSION, so a changed export or
+# parser never hits a stale entry. The least recently used entries are evicted above max_bytes.
+##############################################################################################
+
+# Bump whenever parse_classifications output or the entry layout changes so old entries are invalidated
+PARSER_VERSION = 2
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'icecube-phase3', 'parsed')
+DEFAULT_MAX_BYTES = 4 * 1024**3  # 4 GB
+
+HASH_BLOCK = 1 << 20  # read the export 1 MB at a time while hashing
+
+
+def file_digest(path):
+    ''' Content hash of a file, remembered while its size and modification time are unchanged '''
+    stat = os.stat(path)
+    return _file_digest(os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+
+@lru_cache(maxsize=256)
+def _file_digest(path, size, mtime_ns):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def cache_key(classif_path):
+    ''' Key of a classification export: parser version + content hash of the file '''
+    return f"v{PARSER_VERSION}-{file_digest(classif_path)}"
+
+
+def load_parsed_classifications(classif_path, use_cache=True, cache_dir=None, max_bytes=DEFAULT_MAX_BYTES, metrics=None):
+    ''' Parsed table of a classification export, from the cache when possible.
+    With use_cache=False the export is always read and parsed and nothing is written.
+    Reading, parsing and cache access are timed as stages of metrics when given. '''
+    metrics = metrics or Metrics()
+    if not use_cache:
+        return read_and_parse(classif_path, metrics)
+
+    cache_dir = cache_dir or DEFAULT_CACHE_DIR
+    entry = os.path.join(cache_dir, cache_key(classif_path))
+    if os.path.isdir(entry):
+        os.utime(entry)  # mark as recently used for eviction
+        with metrics.load(classif_path, 'load_cached') as stage:
+            parsed = read_entry(entry)
+            stage.add_rows(rows_out=len(parsed))
+        return parsed
+
+    parsed = read_and_parse(classif_path, metrics)
+    with metrics.stage('write_cache', rows_in=len(parsed)):
+        write_entry(entry, parsed)
+        evict(cache_dir, max_bytes, keep=entry)
+    return parsed
+
+
+def read_and_parse(classif_path, metrics):
+    with metrics.load(classif_path) as stage:
+        classif = read_table(classif_path, 'classification', columns=EXPORT_COLUMNS)
+        stage.add_rows(rows_out=len(classif))
+    with metrics.stage('parse', rows_in=len(classif)):
+        return parse_classifications(classif, metrics)
+
+
+def write_entry(entry, parsed):
+    cache_dir = os.path.dirname(entry)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp = tempfile.mkdtemp(dir=cache_dir, prefix='.tmp-')
+    try:
+        for name in PARSED_COLUMNS:
+            column = parsed[name]
+            if column.dtype == object or isinstance(column.dtype, pd.StringDtype):
+                encoded = dictionary_encode(column)
+                if encoded is None:
+                    np.save(os.path.join(tmp, f"{name}.object.npy"), column.to_numpy(dtype=object), allow_pickle=True)
+                    continue
+                codes, values = encoded
+                np.save(os.path.join(tmp, f"{name}.codes.npy"), codes.astype(np.int32))
+                np.save(os.path.join(tmp, f"{name}.values.npy"), np.asarray(values, dtype=str))
+            elif isinstance(column.dtype, pd.Int64Dtype):
+                np.save(os.path.join(tmp, f"{name}.npy"), column.fillna(0).to_numpy(np.int64))
+                np.save(os.path.join(tmp, f"{name}.mask.npy"), column.isna().to_numpy())
+            else:
+                np.save(os.path.join(tmp, f"{name}.npy"), column.to_numpy())
+        # Another process may have written the same entry meanwhile; either copy is valid
+        try:
+            os.rename(tmp, entry)
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+
+
+def dictionary_encode(column):
+    ''' (codes into the distinct values, -1 for missing, distinct values) of a column whose values
+    are all strings, None when some are not (numbers, booleans, lists or dicts decoded by the
+    json.loads fallback would not come back as they were from a string array) '''
+    try:
+        codes, values = pd.factorize(column, use_na_sentinel=True)
+    except TypeError:  # unhashable values
+        return None
+    if not all(isinstance(value, str) for value in values):
+        return None
+    return codes, values
+
+
+def read_entry(entry):
+    def load(name):
+        return np.load(os.path.join(entry, name), mmap_mode='r')
+
+    columns = {}
+    for name in PARSED_COLUMNS:
+        if os.path.exists(os.path.join(entry, f"{name}.object.npy")):
+            columns[name] = pd.Series(np.load(os.path.join(entry, f"{name}.object.npy"), allow_pickle=True), dtype=object)
+        elif os.path.exists(os.path.join(entry, f"{name}.codes.npy")):
+            # Index an object array of the distinct values (plus None for code -1) by the codes
+            values = np.array(load(f"{name}.values.npy").tolist() + [None], dtype=object)
+            columns[name] = pd.Series(values[load(f"{name}.codes.npy")], dtype=object)
+        elif os.path.exists(os.path.join(entry, f"{name}.mask.npy")):
+            columns[name] = pd.arrays.IntegerArray(np.asarray(load(f"{name}.npy")),
+                                                   np.asarray(load(f"{name}.mask.npy")))
+        else:
+            columns[name] = load(f"{name}.npy")
+    return pd.DataFrame(columns, columns=PARSED_COLUMNS)
+
+
+def entry_size(entry):
+    return sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+
+
+def evict(cache_dir, max_bytes, keep=None, prefix=None):
+    ''' Remove stale-version entries (not starting with prefix), then least recently used entries
+    until under max_bytes '''
+    prefix = prefix or f"v{PARSER_VERSION}-"
+    entries = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if name.startswith('.') or not os.path.isdir(path):
+            continue
+        if not name.startswith(prefix):
+            shutil.rmtree(path, ignore_errors=True)
+            continue
+        entries.append((os.path.getmtime(path), entry_size(path), path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        if path == keep:
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
@@ -0,0 +1,295 @@
+import argparse
+import importlib
+import os, os.path
+
+from bootstrap import DEFAULT_LEVEL, accuracy_summary, bootstrap_intervals, plot_intervals, summary_frame
+from confusion import fraction_frame
+from consolidator import DNN_COLUMNS
+from matched_store import load_matched
+from metrics import Metrics
+from reducer import AGGREGATIONS, MATCHED_COLUMNS, TIME_CUT, Reducer
+from render import Panel, Plot, render_plots
+from stage_cache import DEFAULT_MAX_BYTES, StageCache
+from tables import COMPRESSIONS, csv_path
+
+##############################################################################################
+#                                       pipeline.py
+##############################################################################################
+# Purpose: Runs reduce → consolidate → confusion matrices in one process, passing DataFrames
+#          between the stages instead of writing and re-reading CSVs
+# Usage: python pipeline.py --input-dir <dir> --output-dir <dir> --classifications <csv>
+#            --matched <csv> --output <name> [options]   (python pipeline.py -h for all options)
+#        or from pipeline import Pipeline
+# Author: Jonathan Berkson
+#
+# The matched data is read once and shared by every stage. Both the 3-category and the
+# 5-category flavours can be run together, in which case the export is also reduced once.
+# Reduced and consolidated CSVs are only written when asked for. Each stage's output is kept
+# in the stage cache (stage_cache.py), so a rerun only recomputes what its changes affect.
+##############################################################################################
+
+# Modules whose source is part of the reduce stage's cache key
+REDUCE_MODULES = ['reducer', 'classifications', 'tally', 'consensus', 'tables', 'parse_cache', 'matched_store']
+
+# Consolidator and plotter module of each flavour (number of categories)
+FLAVOURS = {
+    3: ('consolidator', 'Plotter'),
+    5: ('5option-consolidator', '5option-Plotter'),
+}
+
+
+class Pipeline:
+    def __init__(self, input_dir, output_dir, retirement_lim, accuracy_cut, agreement_cut, categories=(3,)):
+        self.input_dir = input_dir
+        self.output_dir = output_dir
+        self.retirement_lim = retirement_lim  # minimum votes per subject
+        self.accuracy_cut = accuracy_cut      # minimum user accuracy, in percent
+        self.agreement_cut = agreement_cut    # minimum agreement fraction
+        self.categories = list(categories)    # flavours to run: 3 and/or 5
+        self.classif_path = None
+        self.matched_path = None
+        self.output_file = None               # prefix of every file written
+        self.apply_time_cut = True
+        self.time_cut = TIME_CUT              # seconds a classification must take
+        self.aggregation = 'votes'            # plain majority or 'dawid-skene' skill-weighted consensus
+        self.write_reduced = False            # also write <output>-reduced-<n>cat.csv
+        self.write_consolidated = False       # also write <output>-consolidated-<n>cat.csv
+        self.compression = None               # compress those CSVs: a tables.COMPRESSIONS key, None for plain
+        self.plot = True                      # save the user and DNN confusion matrix plots
+        self.panels = False                   # one figure per flavour, user and DNN side by side
+        self.bootstrap = 0                    # bootstrap resamples for intervals, 0 for none
+        self.bootstrap_level = DEFAULT_LEVEL  # coverage of the bootstrap intervals
+        self.use_cache = True                 # reducer options, see reducer.py
+        self.cache_dir = None
+        self.chunksize = None
+        self.workers = 1
+        self.use_stage_cache = True           # reuse stage outputs whose inputs did not change
+        self.stage_cache_dir = None           # stage cache location, None for the default
+        self.stage_cache_max_bytes = DEFAULT_MAX_BYTES
+        self.force = False                    # rerun every stage even when cached
+        self.stage_cache = None               # StageCache of the last run, with its hit/miss report
+        self.metrics = Metrics()              # stage timings, row and skip counts (see metrics.py)
+
+    def run(self):
+        ''' Run every requested flavour. Returns {n_categories: results}, where results holds the
+        reduced and consolidated DataFrames, the user/DNN confusion matrices (column fractions and
+        counts) and the paths of any files written. Stages whose inputs did not change come from the stage cache. '''
+        cache = self.stage_cache = StageCache(self.stage_cache_dir, self.stage_cache_max_bytes,
+                                              force=self.force, enabled=self.use_stage_cache)
+
+        matched = None
+        def matched_data():
+            # Only read when a stage actually has to run
+            nonlocal matched
+            if matched is None:
+                matched = load_matched(self.matched_path, columns=list(dict.fromkeys(MATCHED_COLUMNS + DNN_COLUMNS)),
+                                       compact=False, use_cache=self.use_cache)
+            return matched
+
+        # === REDUCE (one pass for both flavours) ===
+        reduce_key = cache.key('reduce', inputs=[self.classif_path, self.matched_path], code=REDUCE_MODULES,
+                               params={'accuracy_cut': self.accuracy_cut, 'apply_time_cut': self.apply_time_cut,
+                                       'time_cut': self.time_cut, 'aggregation': self.aggregation})
+        reduced_3, reduced_5, counts = cache.run(reduce_key, lambda: self.reduce(matched_data()))
+        reduced = {3: reduced_3, 5: reduced_5}
+        print(f"Votes counted (3-category): {counts['votes']}")
+        self.metrics.count('reduce', counts)
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        results = {}
+        plots = []
+        for n in self.categories:
+            consolidator_module, plotter_module = FLAVOURS[n]
+            files = []
+
+            # === CONSOLIDATE ===
+            consolidate_key = cache.key(f'consolidate-{n}cat', inputs=[self.matched_path], upstream=[reduce_key],
+                                        code=['consolidator', consolidator_module, 'tables', 'matched_store'],
+                                        params={'retirement_lim': self.retirement_lim, 'agreement_cut': self.agreement_cut})
+            consolidator = importlib.import_module(consolidator_module).Consolidator(
+                self.input_dir, self.output_dir, self.retirement_lim, self.agreement_cut)
+            consolidator.metrics = self.metrics
+            cdf = cache.run(consolidate_key, lambda: consolidator.consolidate_frames(reduced[n].copy(), matched_data()))
+            if 'consolidate' in self.metrics.counts:
+                self.metrics.counts[f'consolidate-{n}cat'] = self.metrics.counts.pop('consolidate')
+
+            if self.write_reduced:
+                files.append(csv_path(self.output_dir, f"{self.output_file}-reduced-{n}cat", self.compression))
+                with self.metrics.stage('write', rows_in=len(reduced[n])):
+                    reduced[n].to_csv(files[-1], index=False)
+                print(f"Saved reduced CSV to: {files[-1]}")
+            if self.write_consolidated:
+                files.append(csv_path(self.output_dir, f"{self.output_file}-consolidated-{n}cat", self.compression))
+                with self.metrics.stage('write', rows_in=len(cdf)):
+                    cdf.to_csv(files[-1], index=False)
+                print(f"Saved consolidated CSV to: {files[-1]}")
+
+            # === CONFUSION MATRICES ===
+            plotter = self.load_plotter(plotter_module)
+            matrices_key = cache.key(f'matrices-{n}cat', upstream=[consolidate_key], code=[plotter_module, 'confusion'])
+            matrices = cache.run(matrices_key, lambda: self.confusion_matrices(plotter, cdf))
+
+            # === BOOTSTRAP INTERVALS (optional) ===
+            intervals = None
+            if self.bootstrap:
+                bootstrap_key = cache.key(f'bootstrap-{n}cat', upstream=[consolidate_key], code=['bootstrap', 'confusion', plotter_module],
+                                          params={'resamples': self.bootstrap, 'level': self.bootstrap_level})
+                intervals = cache.run(bootstrap_key, lambda: self.bootstrap_intervals(plotter, cdf))
+                files.append(self.output_path(f"bootstrap-{n}cat.csv"))
+                summary_frame(intervals).to_csv(files[-1], index=False)
+                print(f"Saved bootstrap intervals to: {files[-1]}")
+
+            if self.plot:
+                flavour_plots = [
+                    Plot(matrices[who],
+                         title=f"{'User' if who == 'user' else 'DNN'} Classification vs. Truth ({n} Categories)",
+                         xlabel="Ground Truth: ntn_category",
+                         ylabel=f"{'User' if who == 'user' else 'DNN'} Prediction: {prediction}",
+                         output_path=self.output_path(f"{who}-{n}cat.png"),
+                         intervals=plot_intervals(intervals, who))
+                    for who, prediction in (('user', 'data.most_likely'), ('dnn', 'idx_max_score'))
+                ]
+                if self.panels:
+                    flavour_plots = [Panel(flavour_plots, self.output_path(f"{n}cat.png"))]
+                plots += flavour_plots
+                files += [plot.output_path for plot in flavour_plots]
+
+            results[n] = {
+                'reduced': reduced[n],
+                'consolidated': cdf,
+                'user_matrix': fraction_frame(matrices['user']),
+                'dnn_matrix': fraction_frame(matrices['dnn']),
+                'user_counts': matrices['user'],
+                'dnn_counts': matrices['dnn'],
+                'intervals': intervals,
+                'files': files,
+            }
+
+        # === PLOTS, rendered together on the worker pool; unchanged images are kept ===
+        with self.metrics.stage('render'):
+            render_plots(plots, workers=self.workers, skip_unchanged=not self.force)
+
+        self.metrics.count('stage_cache', {outcome: sum(o == outcome for _, o in cache.report)
+                                           for outcome in dict.fromkeys(o for _, o in cache.report)})
+        return results
+
+    def reduce(self, matched):
+        reducer = Reducer(self.input_dir, self.output_dir, self.retirement_lim)
+        reducer.classif_path = self.classif_path
+        reducer.accuracy_cut = self.accuracy_cut / 100
+        reducer.apply_time_cut = self.apply_time_cut
+        reducer.time_cut = self.time_cut
+        reducer.aggregation = self.aggregation
+        reducer.use_cache = self.use_cache
+        reducer.cache_dir = self.cache_dir
+        reducer.chunksize = self.chunksize
+        reducer.workers = self.workers
+        reducer.metrics = self.metrics
+        tallies, counts = reducer.tally_votes(matched)
+        with self.metrics.stage('aggregate') as stage:
+            reduced_3, reduced_5 = reducer.reduced_frames(tallies)
+            stage.add_rows(rows_out=len(reduced_3))
+        return reduced_3, reduced_5, counts
+
+    def confusion_matrices(self, plotter, cdf):
+        ''' {'user' / 'dnn': count matrix} '''
+        matrices = {}
+        for who, compute in (('user', plotter.compute_count_matrix_user), ('dnn', plotter.compute_count_matrix_dnn)):
+            with self.metrics.stage('derive', rows_in=len(cdf)):
+                matrices[who] = compute(cdf)
+        return matrices
+
+    def bootstrap_intervals(self, plotter, cdf):
+        with self.metrics.stage('bootstrap', rows_in=len(cdf)):
+            return bootstrap_intervals(cdf, plotter.expected_categories, self.bootstrap, self.bootstrap_level,
+                                       workers=self.workers)
+
+    def output_path(self, suffix):
+        return os.path.join(self.output_dir, f"{self.output_file}-{suffix}")
+
+    def load_plotter(self, module):
+        # Plots are only saved to files, so batch jobs without a display use the Agg backend
+        import matplotlib
+        matplotlib.use('Agg')
+        return importlib.import_module(module)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Reduce, consolidate and plot a classification export in one run.")
+    parser.add_argument('--input-dir', required=True, help="directory of the input CSVs")
+    parser.add_argument('--output-dir', required=True, help="directory for the output files")
+    parser.add_argument('--classifications', required=True, help="classification export CSV filename (may be .gz, .bz2, .xz or .zip)")
+    parser.add_argument('--matched', required=True, help="matched_sim_data CSV filename")
+    parser.add_argument('--output', required=True, help="prefix of the output filenames")
+    parser.add_argument('--categories', type=int, nargs='+', choices=sorted(FLAVOURS), default=[3],
+                        help="flavours to run: 3, 5 or both (default: 3)")
+    parser.add_argument('--retirement-lim', type=int, default=0, help="minimum votes per subject (default: 0)")
+    parser.add_argument('--accuracy-cut', type=int, default=0, help="minimum user accuracy in percent (default: 0)")
+    parser.add_argument('--agreement-cut', type=float, default=0, help="minimum agreement fraction (default: 0)")
+    parser.add_argument('--time-cut', type=float, default=TIME_CUT,
+                        help="seconds a classification must take to count (default: %(default)s)")
+    parser.add_argument('--no-time-cut', action='store_true', help="do not apply the time cutoff")
+    parser.add_argument('--aggregation', choices=AGGREGATIONS, default='votes',
+                        help="most_likely and agreement from the plain vote majority or from skill-weighted "
+                             "Dawid-Skene consensus (default: %(default)s)")
+    parser.add_argument('--write-reduced', action='store_true', help="also write the reduced CSVs")
+    parser.add_argument('--write-consolidated', action='store_true', help="also write the consolidated CSVs")
+    parser.add_argument('--compress', choices=sorted(COMPRESSIONS), default=None,
+                        help="write the reduced and consolidated CSVs compressed (.gz, .bz2, .xz or .zip)")
+    parser.add_argument('--no-plots', action='store_true', help="skip the confusion matrix plots")
+    parser.add_argument('--panels', action='store_true', help="one plot per flavour with the user and DNN matrices side by side")
+    parser.add_argument('--bootstrap', type=int, default=0, metavar='RESAMPLES',
+                        help="add bootstrap intervals from this many resamples to the plots and summary")
+    parser.add_argument('--bootstrap-level', type=float, default=DEFAULT_LEVEL,
+                        help="coverage of the bootstrap intervals (default: %(default)s)")
+    parser.add_argument('--no-cache', action='store_true', help="do not use the parsed-classification cache or matched store")
+    parser.add_argument('--chunksize', type=int, default=None, help="stream the export in chunks of this many rows")
+    parser.add_argument('--workers', type=int, default=1, help="worker processes for the reduction, bootstrap and plots (default: 1)")
+    parser.add_argument('--force', action='store_true', help="rerun every stage even if its output is cached")
+    parser.add_argument('--no-stage-cache', action='store_true', help="do not read or write the stage cache")
+    parser.add_argument('--stage-cache-max-mb', type=int, default=DEFAULT_MAX_BYTES // 1024**2,
+                        help="stage cache size limit in MB (default: %(default)s)")
+    parser.add_argument('--metrics', default=None, help="write stage timings, row and skip counts to this JSON file")
+    parser.add_argument('--profile', action='store_true', help="also capture a cProfile of the run (with --metrics)")
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    metrics = Metrics('pipeline.py', profile=args.profile and args.metrics is not None)
+    metrics.params = {key: value for key, value in vars(args).items() if key not in ('metrics', 'profile')}
+
+    pipeline = Pipeline(args.input_dir, args.output_dir, args.retirement_lim, args.accuracy_cut, args.agreement_cut,
+                        categories=args.categories)
+    pipeline.classif_path = os.path.join(args.input_dir, args.classifications)
+    pipeline.matched_path = os.path.join(args.input_dir, args.matched)
+    pipeline.output_file = args.output
+    pipeline.apply_time_cut = not args.no_time_cut
+    pipeline.time_cut = args.time_cut
+    pipeline.aggregation = args.aggregation
+    pipeline.write_reduced = args.write_reduced
+    pipeline.write_consolidated = args.write_consolidated
+    pipeline.compression = args.compress
+    pipeline.plot = not args.no_plots
+    pipeline.panels = args.panels
+    pipeline.bootstrap = args.bootstrap
+    pipeline.bootstrap_level = args.bootstrap_level
+    pipeline.use_cache = not args.no_cache
+    pipeline.chunksize = args.chunksize
+    pipeline.workers = args.workers
+    pipeline.force = args.force
+    pipeline.use_stage_cache = not args.no_stage_cache
+    pipeline.stage_cache_max_bytes = args.stage_cache_max_mb * 1024**2
+    pipeline.metrics = metrics
+    results = pipeline.run()
+
+    for n, result in results.items():
+        if result['intervals'] is not None:
+            print(f"\n{n}-category {accuracy_summary(result['intervals'], pipeline.bootstrap_level)}")
+        else:
+            print(f"\n{n}-category user accuracy: {result['consolidated']['user_accuracy'].mean():.3f}, "
+                  f"DNN accuracy: {result['consolidated']['DNN_accuracy'].mean():.3f}")
+    if pipeline.use_stage_cache:
+        print(f"\n{pipeline.stage_cache.summary()}")
+    if args.metrics:
+        metrics.write(os.path.join(args.output_dir, args.metrics))
@@ -2,10 +2,18 @@
 import pandas as pd
 import numpy as np
 import argparse
-import json
 import os, os.path
-from datetime import datetime
-from collections import defaultdict
+import hashlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from classifications import EXPORT_COLUMNS, parse_classifications
+from consensus import DEFAULT_MAX_ITERATIONS, DEFAULT_TOLERANCE, DawidSkene
+from matched_store import load_matched
+from metrics import Metrics
+from parse_cache import PARSER_VERSION, load_parsed_classifications
+from tables import csv_path, load_concurrently, parse_compression, read_table
+from tally import SubjectLabels, VoteTally
 
 ##############################################################################################
 #                                       reducer.py
@@ -20,198 +28,558 @@ from collections import defaultdict
 # 7/8/25
 ##############################################################################################
 
+# Truth labels for user accuracy checking - condensed to 'TRACK'
+track_truth_labels = {"throughgoing_track","starting_track","stopping_track","throughgoing_bundle","stopping_bundle"}
+skimming_truth_labels = {"skimming_track","uncontained_cascade"}
+cascade_truth_labels = {"contained_em_hadr_cascade","contained_hadron_cascade"}
+
+# Truth labels for 5-category user accuracy checking (other labels are compared as they are)
+truth_labels_5 = {
+    'throughgoing_track': 'THROUGHGOINGTRACK', 'throughgoing_bundle': 'THROUGHGOINGTRACK',
+    'stopping_track': 'STOPPINGTRACK', 'stopping_bundle': 'STOPPINGTRACK',
+    'starting_track': 'STARTINGTRACK',
+    'contained_em_hadr_cascade': 'CASCADE', 'contained_hadron_cascade': 'CASCADE',
+    'skimming_track': 'SKIMMING', 'uncontained_cascade': 'SKIMMING',
+}
+
+# Votes are tallied at the finest granularity: the 5 categories, then TRACK votes without a
+# usable subtype (no WHATTYPEOFTRACKISIT answer, or a subtype picked as the top-level choice)
+FINE_CATEGORIES = ['THROUGHGOINGTRACK', 'STOPPINGTRACK', 'STARTINGTRACK', 'CASCADE', 'SKIMMING', 'TRACK']
+TRACK_SUBTYPES = ['THROUGHGOINGTRACK', 'STOPPINGTRACK', 'STARTINGTRACK']
+
+# Vote categories in tally column order (ties go to the first one)
+CATEGORIES = ['TRACK', 'CASCADE', 'SKIMMING']
+CATEGORIES_5 = FINE_CATEGORIES[:5]
+TRACK_CHOICES = ['THROUGHGOINGTRACK', 'STARTINGTRACK', 'STOPPINGTRACK', 'TRACK']
+
+# Column of each fine category in the collapsed tallies (-1: not counted)
+COLLAPSE_3 = [0, 0, 0, 1, 2, 0]    # all track columns are summed into TRACK
+COLLAPSE_5 = [0, 1, 2, 3, 4, -1]   # bare TRACK votes are not counted
+
+# Time flag of a classification: over the time cut, at or under it, unreadable metadata
+TIME_OK, TIME_SHORT, TIME_UNREADABLE = 0, 1, 2
+TIME_CUT = 6  # seconds, the length of an event video
+
+# Outcome codes of 3-category classifications that do not become votes
+SKIP_REASONS = {-1: 'skipped_time', -2: 'skipped_key', -3: 'skipped_unknown_choice'}
+
+# Ways of turning a subject's votes into most_likely and agreement: the plain majority, or
+# skill-weighted consensus (Dawid–Skene EM, see consensus.py) seeded from the user stats
+AGGREGATIONS = ['votes', 'dawid-skene']
+
+# Per-user accuracy counts under both taxonomies
+USER_STAT_COLUMNS = ['correct_3', 'total_3', 'correct_5', 'total_5']
+
+# Columns of the classification export each streaming pass needs
+ACCURACY_COLUMNS = ['user_name', 'subject_ids', 'annotations']
+VOTE_COLUMNS = ['user_name', 'metadata', 'subject_data', 'annotations']
+SHARD_COLUMNS = EXPORT_COLUMNS
+INCREMENTAL_COLUMNS = ['classification_id', 'created_at'] + SHARD_COLUMNS
+
+# Columns of the matched data the reducers need
+MATCHED_COLUMNS = ['subject_id', '#truth_classification_label']
+
+# Bump whenever the saved outcome format changes so old vote states are rebuilt
+STATE_VERSION = 2
+
+# Per-process state of a parallel reduction worker, set once by init_shard_worker
+_shard_context = None
+
+def fine_choices(choice, track_type):
+    ''' (3-category choice, fine category) of each classification: TRACK votes for its
+    WHATTYPEOFTRACKISIT answer; any other track choice is bare TRACK '''
+    condensed = choice.where(~choice.isin(TRACK_CHOICES), 'TRACK')
+    fine = condensed.where(~((choice == 'TRACK') & track_type.isin(TRACK_SUBTYPES)), track_type)
+    return condensed, fine
+
+def parse_time_cut(answer):
+    ''' (apply the time cut, seconds) from a time cutoff prompt answer: y, n or a number of seconds '''
+    answer = answer.strip().lower()
+    try:
+        return True, float(answer)
+    except ValueError:
+        return answer == 'y', TIME_CUT
+
+def init_shard_worker(reducer, truth_lookups, layout):
+    global _shard_context
+    _shard_context = (reducer, truth_lookups, layout)
+
+def reduce_shard(shard):
+    reducer, truth_lookups, layout = _shard_context
+    return reducer.reduce_shard(shard, truth_lookups, layout)
+
 class Reducer:
     def __init__(self, input_dir, output_dir, retirement_lim):
         self.input_dir = input_dir
         self.output_dir = output_dir
         self.retirement_lim = retirement_lim
         self.classif_path = None
-        self.subjects_path = None
         self.matched_path = None
-        self.output_file = None
+        self.output_file = None     # 3-category reduced CSV (without .csv), None to skip it
+        self.output_file_5 = None   # 5-category reduced CSV from the same pass, None to skip it
+        self.accuracy_cut = 0       # minimum user accuracy as a fraction, can be overwritten
         self.apply_time_cut = True  # default, can be overwritten
+        self.time_cut = TIME_CUT    # seconds a classification must take (time_spent > time_cut)
+        self.chunksize = None       # rows per chunk when streaming, None loads the whole export
+        self.workers = 1            # worker processes, more than 1 reduces shards in parallel
+        self.use_cache = True       # reuse the parsed-classification cache for in-memory runs and the matched store
+        self.cache_dir = None       # parsed-classification cache location, None for the default
+        self.state_path = None      # saved vote state file; when set, only new classifications are reduced
+        self.metrics = Metrics()    # stage timings, row and skip counts of the run (see metrics.py)
+        self.aggregation = 'votes'  # one of AGGREGATIONS
+        self.keep_user_votes = False  # also keep who cast each vote (VoteTally.sparse_votes); dawid-skene always does
+        self.em_tolerance = DEFAULT_TOLERANCE            # Dawid–Skene convergence tolerance
+        self.em_max_iterations = DEFAULT_MAX_ITERATIONS  # Dawid–Skene iteration cap
+        self.user_stats = None      # merged user stats of the last tally_votes, the Dawid–Skene seed
+        self.compression = None     # write the reduced CSVs compressed: a tables.COMPRESSIONS key, None for plain
+
+    def reduce(self):
+        # Load the matched data (subject ids and truth labels only) and, when it is reduced in memory,
+        # the parsed export at the same time; the truth lookups are built as soon as the matched data is in
+        loaders = {'matched': self.load_matched_context}
+        if not (self.state_path or self.workers > 1 or self.chunksize):
+            loaders['parsed'] = lambda: load_parsed_classifications(self.classif_path, use_cache=self.use_cache,
+                                                                    cache_dir=self.cache_dir, metrics=self.metrics)
+        inputs = load_concurrently(loaders)
+        matched, context = inputs['matched']
+        tallies, counts = self.tally_votes(matched, parsed=inputs.get('parsed'), context=context)
+        return self.save(tallies, counts)
+
+    def load_matched_context(self):
+        ''' Matched data and its matched_context '''
+        with self.metrics.load(self.matched_path) as stage:
+            matched = load_matched(self.matched_path, columns=MATCHED_COLUMNS, use_cache=self.use_cache)
+            stage.add_rows(rows_out=len(matched))
+        return matched, self.matched_context(matched)
+
+    def matched_context(self, matched):
+        ''' (3-category, 5-category) truth lookups and the tally layout of a matched DataFrame,
+        all sharing the layout's subject index '''
+        layout = VoteTally(matched['subject_id'], FINE_CATEGORIES)
+        truth_lookups = self.build_truth_lookup(matched, layout.index), self.build_truth_lookup_5(matched, layout.index)
+        return truth_lookups, layout
+
+    def tally_votes(self, matched, parsed=None, context=None):
+        ''' Fine (3-category, 5-category) vote tallies of the export and the vote counts,
+        for the subjects of a matched DataFrame (needs MATCHED_COLUMNS). parsed (the parsed
+        export) and context (matched_context(matched)) are used instead of computing them when given. '''
+        truth_lookups, layout = context or self.matched_context(matched)
+
+        # One fine tally per taxonomy: the two accuracy cuts keep different users
+        tallies = VoteTally(layout.subj_ids, FINE_CATEGORIES), VoteTally(layout.subj_ids, FINE_CATEGORIES)
+        if self.keep_user_votes or self.aggregation == 'dawid-skene':
+            for tally in tallies:
+                tally.keep_user_votes()
+        user_stats = self.empty_user_stats()
+        counts = {'votes': 0, 'votes_5': 0, 'skipped_time': 0, 'skipped_user': 0, 'skipped_key': 0, 'skipped_unknown_choice': 0}
+
+        if self.state_path:
+            self.reduce_incremental(matched, truth_lookups, layout, tallies, user_stats, counts)
+        elif self.workers > 1:
+            self.reduce_parallel(truth_lookups, layout, tallies, user_stats, counts)
+        elif self.chunksize:
+            # === STREAMING: two passes over the export, one bounded chunk at a time ===
+            # Pass 1 only needs the annotations; pass 2 only parses rows of users passing either cut.
+            chunks = read_table(self.classif_path, 'classification', columns=ACCURACY_COLUMNS, chunksize=self.chunksize)
+            for chunk in self.metrics.iterate('load', chunks):
+                features = self.parse_features(chunk, truth_lookups, layout)
+                user_stats = self.count_user_accuracy(features, user_stats)
+            passing_users = self.find_passing_users(user_stats)
+            either = passing_users[0].union(passing_users[1])
+
+            chunks = read_table(self.classif_path, 'classification', columns=VOTE_COLUMNS, chunksize=self.chunksize)
+            for chunk in self.metrics.iterate('load', chunks):
+                passing = chunk['user_name'].isin(either)
+                counts['skipped_user'] += int((~passing).sum())
+                # The annotations of these rows were parsed, and counted, in pass 1
+                features = self.parse_features(chunk[passing], truth_lookups, layout, counted=('annotations',))
+                self.count_votes(features, passing_users, tallies, counts)
+        else:
+            # === PARSE CLASSIFICATIONS (each JSON column decoded once, or loaded from the cache) ===
+            if parsed is None:
+                parsed = load_parsed_classifications(self.classif_path, use_cache=self.use_cache, cache_dir=self.cache_dir,
+                                                     metrics=self.metrics)
+
+            with self.metrics.stage('features', rows_in=len(parsed)):
+                features = self.classification_features(parsed, truth_lookups, layout)
+            user_stats = self.count_user_accuracy(features, user_stats)
+            self.count_votes(features, self.find_passing_users(user_stats), tallies, counts)
+
+        self.metrics.count('reduce', counts)
+        return tallies, counts
+
+    def parse_features(self, chunk, truth_lookups, layout, counted=()):
+        with self.metrics.stage('parse', rows_in=len(chunk)):
+            parsed = parse_classifications(chunk, self.metrics, counted)
+        with self.metrics.stage('features', rows_in=len(parsed)):
+            return self.classification_features(parsed, truth_lookups, layout)
+
+    def reduce_parallel(self, truth_lookups, layout, tallies, user_stats, counts):
+        # === PARALLEL: shards of the export are parsed and tallied on a process pool ===
+        outcomes = []
+        results = self.shard_results(self.read_shards(SHARD_COLUMNS), truth_lookups, layout)
+        for result in self.metrics.iterate('shards', results, rows=self.shard_rows):
+            user_stats = self.merge_shard(result, user_stats, outcomes)
+        self.finish_outcomes(outcomes, user_stats, tallies, counts)
+
+    def reduce_incremental(self, matched, truth_lookups, layout, tallies, user_stats, counts):
+        # === INCREMENTAL: only classifications newer than the saved watermark are reduced ===
+        state = self.load_state(self.state_fingerprint(matched))
+        user_stats = self.add_user_stats(user_stats, state['user_stats'])
+        outcomes = [state['outcomes']]
+
+        watermark = state['last_classification_id']
+        def new_classifications():
+            nonlocal watermark
+            for shard in self.read_shards(INCREMENTAL_COLUMNS):
+                shard = shard[shard['classification_id'] > state['last_classification_id']]
+                if len(shard):
+                    newest = shard['classification_id'].idxmax()
+                    if shard['classification_id'][newest] > watermark:
+                        watermark = shard['classification_id'][newest]
+                        state['last_created_at'] = shard['created_at'][newest]
+                    yield shard
+
+        new_rows = 0
+        results = self.shard_results(new_classifications(), truth_lookups, layout)
+        for result in self.metrics.iterate('shards', results, rows=self.shard_rows):
+            new_rows += int(self.shard_rows(result))
+            user_stats = self.merge_shard(result, user_stats, outcomes)
+
+        # Collapse repeated (user, subject, category, time) entries before saving the state again
+        outcomes = pd.concat(outcomes, ignore_index=True)
+        outcomes = outcomes.groupby(['user_name', 'row', 'fine', 'time_flag'], dropna=False)['n'].sum().reset_index()
+        state.update(last_classification_id=int(watermark), user_stats=user_stats, outcomes=outcomes)
+        self.save_state(state)
+        print(f"New classifications reduced: {new_rows} (up to classification_id {watermark})")
+
+        self.finish_outcomes([outcomes], user_stats, tallies, counts)
+
+    def read_shards(self, columns):
+        ''' Export in streaming chunks, or loaded whole and split into a few shards per worker '''
+        if self.chunksize:
+            return read_table(self.classif_path, 'classification', columns=columns, chunksize=self.chunksize)
+        classif = read_table(self.classif_path, 'classification', columns=columns)
+        size = max(1, -(-len(classif) // (self.workers * 4)))  # a few shards per worker to balance load
+        return (classif.iloc[start:start + size] for start in range(0, len(classif), size))
+
+    def shard_results(self, shards, truth_lookups, layout):
+        ''' reduce_shard result of each shard, computed on a process pool when workers > 1 '''
+        if self.workers <= 1:
+            for shard in shards:
+                yield self.reduce_shard(shard, truth_lookups, layout)
+            return
+
+        with ProcessPoolExecutor(max_workers=self.workers, initializer=init_shard_worker,
+                                 initargs=(self, truth_lookups, layout)) as pool:
+            # Keep only a couple of shards per worker in flight so streamed chunks stay bounded
+            pending = deque()
+            for shard in shards:
+                pending.append(pool.submit(reduce_shard, shard))
+                if len(pending) >= self.workers * 2:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    def reduce_shard(self, shard, truth_lookups, layout):
+        ''' Parse one shard of the export and tally user accuracy and per-user vote outcomes.
+        The accuracy cuts need every shard's user stats, so they are applied after merging.
+        The shard's parse counts are returned too, as workers do not share self.metrics. '''
+        metrics = Metrics()
+        features = self.classification_features(parse_classifications(shard, metrics), truth_lookups, layout)
+        user_stats = self.count_user_accuracy(features, self.empty_user_stats())
+        outcomes = features.groupby(['user_name', 'row', 'fine', 'time_flag'], dropna=False).size().reset_index(name='n')
+        return user_stats, outcomes, metrics.counts['parse']
+
+    def shard_rows(self, result):
+        # Classifications in a reduce_shard result
+        return result[0]['total_3'].sum()
+
+    def merge_shard(self, result, user_stats, outcomes):
+        shard_stats, shard_outcomes, parse_counts = result
+        self.metrics.add('parse', parse_counts)
+        with self.metrics.stage('merge', rows_in=len(shard_outcomes)):
+            outcomes.append(shard_outcomes)
+            return self.add_user_stats(user_stats, shard_stats)
+
+    def finish_outcomes(self, outcomes, user_stats, tallies, counts):
+        # Apply the accuracy cuts to the merged user stats, then count the outcomes of passing users
+        passing_users = self.find_passing_users(user_stats)
+        if not outcomes:
+            return
+        outcomes = pd.concat(outcomes, ignore_index=True)
+        self.count_votes(outcomes, passing_users, tallies, counts, outcomes['n'].to_numpy())
+
+    def state_fingerprint(self, matched):
+        # Saved outcomes depend on the parser, the matched subjects/truth labels and the time cut
+        # seconds their time flags were set with (but not on the accuracy cut or on whether the time
+        # cut is applied, which are decided when the outcomes are counted)
+        truth = pd.util.hash_pandas_object(matched[['subject_id', '#truth_classification_label']], index=False)
+        return (f"v{PARSER_VERSION}.{STATE_VERSION}-{hashlib.blake2b(truth.to_numpy().tobytes(), digest_size=16).hexdigest()}"
+                f"-{self.time_cut:g}s")
+
+    def load_state(self, fingerprint):
+        empty = {
+            'fingerprint': fingerprint,
+            'last_classification_id': -1,
+            'last_created_at': None,
+            'user_stats': self.empty_user_stats(),
+            'outcomes': pd.DataFrame({'user_name': pd.Series(dtype=object), 'row': pd.Series(dtype=np.int64),
+                                      'fine': pd.Series(dtype=np.int64), 'time_flag': pd.Series(dtype=np.int64),
+                                      'n': pd.Series(dtype=np.int64)}),
+        }
+        if not os.path.exists(self.state_path):
+            print("No saved vote state found, reducing the full export.")
+            return empty
+        state = pd.read_pickle(self.state_path)
+        if state['fingerprint'] != fingerprint:
+            print("Saved vote state was made with a different parser, matched data or time cut; reducing the full export.")
+            return empty
+        print(f"Resuming from saved vote state (classification_id {state['last_classification_id']}, created {state['last_created_at']}).")
+        return state
+
+    def save_state(self, state):
+        os.makedirs(os.path.dirname(os.path.abspath(self.state_path)), exist_ok=True)
+        tmp_path = f"{self.state_path}.tmp"
+        pd.to_pickle(state, tmp_path)
+        os.replace(tmp_path, self.state_path)
+
+    def build_truth_lookup(self, matched, index=None):
+        # Create subject_id → truth classification lookup (condensed), classifying each distinct label once
+        def condense(truth_label):
+            if truth_label in track_truth_labels:
+                return 'TRACK'
+            elif truth_label in skimming_truth_labels:
+                return 'SKIMMING'
+            elif truth_label in cascade_truth_labels:
+                return 'CASCADE'
+            return None  # Unknown or unclassified
+        return self.label_lookup(matched, condense, None, index)
+
+    def build_truth_lookup_5(self, matched, index=None):
+        # Create subject_id → truth classification lookup (track types kept separate)
+        return self.label_lookup(matched, lambda truth_label: truth_labels_5.get(truth_label, truth_label), np.nan, index)
+
+    def label_lookup(self, matched, convert, missing, index=None):
+        # subject_id → convert(truth label) as SubjectLabels, indexing the converted categories by the
+        # label codes; index is the pd.Index of matched['subject_id'] when already built
+        labels = matched['#truth_classification_label'].astype('category')
+        converted = np.array([convert(label) for label in labels.cat.categories] + [missing], dtype=object)
+        index = pd.Index(matched['subject_id'].to_numpy()) if index is None else index
+        return SubjectLabels(index, converted[labels.cat.codes.to_numpy()], missing)
+
+    def classification_features(self, parsed, truth_lookups, layout):
+        ''' One row per classification: user, tally row, fine category code (-1 if unknown) and
+        time flag, plus its contribution to the user's accuracy under both taxonomies '''
+        truth_lookup, truth_lookup_5 = truth_lookups
+        choice = parsed['choice']
+        track_type = parsed['track_type']
+        condensed, fine = fine_choices(choice, track_type)
+
+        time_spent = parsed['time_spent'].to_numpy()  # NaN when the metadata could not be read
+        time_flag = np.where(time_spent > self.time_cut, TIME_OK, np.where(np.isnan(time_spent), TIME_UNREADABLE, TIME_SHORT))
+
+        # Both lookups index the same matched rows, so each subject's row is found once
+        truth_rows = truth_lookup.rows(parsed['subject_ids'])
+
+        # 3-category accuracy: every classification counts, track subtypes condensed to TRACK
+        truth = pd.Series(truth_lookup.at(truth_rows), index=parsed.index, dtype=object)
+        correct_3 = truth.notna() & (condensed == truth)
+
+        # 5-category accuracy: unreadable annotations are not counted, TRACK is judged by its subtype.
+        # A TRACK without a subtype matches the (missing) truth of a subject not in the matched data.
+        answer = choice.where(choice != 'TRACK', track_type)
+        truth = pd.Series(truth_lookup_5.at(truth_rows), index=parsed.index, dtype=object)
+        unmatched = truth_rows < 0
+        total_5 = choice.notna()
+        correct_5 = total_5 & ((answer == truth) | (answer.isna() & unmatched))
+
+        return pd.DataFrame({
+            'user_name': parsed['user_name'],
+            'row': layout.rows(parsed['subject_key']),
+            'fine': layout.codes(fine),
+            'time_flag': time_flag,
+            'correct_3': correct_3.to_numpy(np.int64),
+            'total_3': np.ones(len(parsed), dtype=np.int64),
+            'correct_5': correct_5.to_numpy(np.int64),
+            'total_5': total_5.to_numpy(np.int64),
+        })
+
+    def empty_user_stats(self):
+        return pd.DataFrame({column: pd.Series(dtype=np.int64) for column in USER_STAT_COLUMNS})
+
+    def add_user_stats(self, user_stats, other):
+        return user_stats.add(other, fill_value=0).astype(np.int64)
+
+    def count_user_accuracy(self, features, user_stats):
+        # === USER ACCURACY CALCULATION (both taxonomies in one pass) ===
+        with self.metrics.stage('accuracy', rows_in=len(features)):
+            stats = features.groupby('user_name', dropna=False, sort=False)[USER_STAT_COLUMNS].sum()
+            return self.add_user_stats(user_stats, stats)
+
+    def find_passing_users(self, user_stats):
+        # Filter users by accuracy cutoff, as (3-category passing users, 5-category passing users)
+        self.user_stats = user_stats
+        passing = []
+        for taxonomy in ('3', '5'):
+            correct, total = user_stats[f'correct_{taxonomy}'], user_stats[f'total_{taxonomy}']
+            passing.append(user_stats.index[(total > 0) & (correct / total.where(total > 0) >= self.accuracy_cut)])
+        return tuple(passing)
+
+    def count_votes(self, features, passing_users, tallies, counts, weights=None):
+        # === VOTE COUNTING into the fine tallies of both taxonomies ===
+        with self.metrics.stage('vote', rows_in=len(features)) as stage:
+            votes_before = counts['votes']
+            passing_3, passing_5 = passing_users
+            tally_3, tally_5 = tallies
+            rows = features['row'].to_numpy()
+            users = features['user_name'].to_numpy()
+            fine = features['fine'].to_numpy()
+            time_flag = features['time_flag'].to_numpy()
+            if weights is None:
+                weights = np.ones(len(features), dtype=np.int64)
+
+            # 3-category: skipped by time, then subject key, then unknown choice
+            passing = features['user_name'].isin(passing_3).to_numpy()
+            counts['skipped_user'] += int(weights[~passing].sum())
+            outcomes = fine.copy()
+            outcomes[fine < 0] = -3
+            outcomes[rows < 0] = -2
+            if self.apply_time_cut:
+                outcomes[time_flag != TIME_OK] = -1
+            for code, reason in SKIP_REASONS.items():
+                counts[reason] += int(weights[passing & (outcomes == code)].sum())
+            votes = passing & (outcomes >= 0)
+            tally_3.add(rows[votes], fine[votes], weights[votes], users[votes])
+            counts['votes'] += int(weights[votes].sum())
+
+            # 5-category: unreadable metadata, subject data or annotations are always skipped,
+            # and TRACK votes without a subtype are not counted
+            votes = (features['user_name'].isin(passing_5).to_numpy() & (time_flag != TIME_UNREADABLE)
+                     & (rows >= 0) & (fine >= 0) & (fine < len(CATEGORIES_5)))
+            if self.apply_time_cut:
+                votes &= time_flag == TIME_OK
+            tally_5.add(rows[votes], fine[votes], weights[votes], users[votes])
+            counts['votes_5'] += int(weights[votes].sum())
+            stage.add_rows(rows_out=counts['votes'] - votes_before)
+
+    def collapsed_tallies(self, tallies):
+        ''' (3-category, 5-category) tallies collapsed from the fine tallies '''
+        tally_3, tally_5 = tallies
+        return tally_3.collapse(CATEGORIES, COLLAPSE_3), tally_5.collapse(CATEGORIES_5, COLLAPSE_5)
+
+    def reduced_frames(self, tallies):
+        ''' (3-category, 5-category) reduced DataFrames, collapsed from the fine tallies '''
+        return tuple(self.reduced_frame(tally, taxonomy) for tally, taxonomy in zip(self.collapsed_tallies(tallies), ('3', '5')))
+
+    def reduced_frame(self, tally, taxonomy):
+        # Reduced DataFrame of a collapsed tally ('3' or '5'), by plain votes or skill-weighted consensus
+        if self.aggregation != 'dawid-skene':
+            return tally.reduced_frame()
+        return tally.reduced_frame(self.consensus(tally, taxonomy))
+
+    def consensus(self, tally, taxonomy):
+        ''' Dawid–Skene posteriors of a collapsed tally's kept user votes, seeded from the users'
+        accuracy under the same taxonomy '''
+        votes = tally.sparse_votes()
+        stats = self.user_stats.reindex(votes.users)
+        accuracy = stats[f'correct_{taxonomy}'] / stats[f'total_{taxonomy}'].where(stats[f'total_{taxonomy}'] > 0)
+        model = DawidSkene(len(tally.subj_ids), len(tally.categories))
+        model.tolerance = self.em_tolerance
+        model.max_iterations = self.em_max_iterations
+        posteriors = model.fit(votes.user_codes, votes.rows, votes.codes, votes.weights, accuracy.to_numpy(np.float64))
+        self.metrics.count(f'dawid_skene_{taxonomy}', {'users': len(votes.users), 'entries': len(votes.rows),
+                                                       'iterations': model.iterations, 'converged': model.converged})
+        if not model.converged:
+            print(f"Dawid–Skene ({taxonomy} categories) stopped at the {model.iterations} iteration cap before converging")
+        return posteriors
+
+    def save(self, tallies, counts):
+        ''' Write the requested reduced CSVs. Returns the output path, or the
+        (3-category, 5-category) paths when both are written. '''
+        # === FINAL AGGREGATION OF RESULTS ===
+        with self.metrics.stage('aggregate') as stage:
+            reduced_3, reduced_5 = self.reduced_frames(tallies)
+            stage.add_rows(rows_out=len(reduced_3))
+        os.makedirs(self.output_dir, exist_ok=True)
+        paths = []
+
+        if self.output_file:
+            df = reduced_3
+            csv_name = csv_path(self.output_dir, self.output_file, self.compression)
+            with self.metrics.stage('write', rows_in=len(df)):
+                df.to_csv(csv_name, index=False)
+            paths.append(csv_name)
+
+            print(f"Reduction complete! Output saved at:\n{csv_name}")
+            print(f"Votes counted: {counts['votes']}")
+            print(f"Skipped due to time ≤ {self.time_cut:g}s or bad metadata: {counts['skipped_time']}")
+            print(f"Skipped due to user accuracy cut: {counts['skipped_user']}")
+            print(f"Skipped due to unreadable subject data: {counts['skipped_key']}")
+            print(f"Skipped due to unknown choice: {counts['skipped_unknown_choice']}")
+
+        if self.output_file_5:
+            df = reduced_5
+            csv_name = csv_path(self.output_dir, self.output_file_5, self.compression)
+            with self.metrics.stage('write', rows_in=len(df)):
+                df.to_csv(csv_name, index=False)
+            paths.append(csv_name)
+
+            print(f"\nReduction complete! Output saved at:\n{csv_name}")
+
+        parse_counts = self.metrics.counts.get('parse')
+        if parse_counts:
+            print(f"Rows decoded with the json.loads fallback: {parse_counts['fallback_rows']} of {parse_counts['rows']} parsed")
+
+        return paths[0] if len(paths) == 1 else tuple(paths)
 
 if __name__ == '__main__':
     # User input prompts
     lim = int(input("Enter retirement limit (e.g. 20): "))
     accuracy_cut = int(input("Enter minimum user accuracy cutoff (as percent, e.g. 20): "))
-    apply_time_cut = input("Apply 6-second time cutoff? (y/n): ").strip().lower() == 'y'
+    apply_time_cut, time_cut = parse_time_cut(input("Apply time cutoff? (y for 6 seconds, n for none, or seconds): "))
 
     input_dir = input("Enter input directory path: ").strip('"')
     output_dir = input("Enter output directory path: ").strip('"')
 
     classif_file = input("Enter classification CSV filename: ").strip()
-    subjects_file = input("Enter subjects CSV filename: ").strip()
     matched_file = input("Enter matched data CSV filename: ").strip()
     output_file = input("Enter output filename (without .csv): ").strip()
+    chunksize = input("Rows per chunk for streaming large exports (blank to load all at once): ").strip()
+    workers = input("Number of worker processes (blank for 1): ").strip()
+    use_cache = input("Use cached parsed classifications and matched data when available? (y/n): ").strip().lower() == 'y'
+    state_file = input("Saved vote state file for incremental runs (blank for a full reduction): ").strip().strip('"')
+    output_file_5 = input("Also write the 5-category reduction from the same pass? Enter its filename (blank to skip): ").strip()
+    skill_weighted = input("Weight votes by user skill (Dawid-Skene)? (y/n, blank for plain votes): ").strip().lower() == 'y'
+    compression = parse_compression(input("Compress the output CSVs? (gz, bz2, xz or zip, blank for plain): "))
+    metrics_file = input("Metrics JSON filename for stage timings and skip counts (blank to skip): ").strip()
+    profile = bool(metrics_file) and input("Also capture a cProfile of the run? (y/n): ").strip().lower() == 'y'
 
     print("\nReducing... (this might take a couple seconds)\n")
 
     # Full file paths
     classif_path = os.path.join(input_dir, classif_file)
-    subjects_path = os.path.join(input_dir, subjects_file)
     matched_path = os.path.join(input_dir, matched_file)
 
     # Create reducer instance and assign paths
     reducer = Reducer(input_dir, output_dir, lim)
     reducer.classif_path = classif_path
-    reducer.subjects_path = subjects_path
     reducer.matched_path = matched_path
     reducer.output_file = output_file
+    reducer.output_file_5 = output_file_5 or None
+    reducer.accuracy_cut = accuracy_cut / 100
     reducer.apply_time_cut = apply_time_cut
-
-    def patched_reduce(self):
-        lim = self.retirement_lim
-        accuracy_threshold = accuracy_cut / 100
-        output_dir = self.output_dir
-
-        # Load CSVs
-        classif = pd.read_csv(self.classif_path)
-        subj = pd.read_csv(self.subjects_path)
-        matched = pd.read_csv(self.matched_path)
-
-        # Truth labels for user accuracy checking - condensed to 'TRACK'
-        track_truth_labels = {"throughgoing_track","starting_track","stopping_track","throughgoing_bundle","stopping_bundle"}
-        skimming_truth_labels = {"skimming_track","uncontained_cascade"}
-        cascade_truth_labels = {"contained_em_hadr_cascade","contained_hadron_cascade"}
-
-        # Create subject_id → truth classification lookup (condensed)
-        truth_lookup = {}
-        for sid, truth_label in zip(matched['subject_id'], matched['#truth_classification_label']):
-            if truth_label in track_truth_labels:
-                truth_lookup[sid] = 'TRACK'
-            elif truth_label in skimming_truth_labels:
-                truth_lookup[sid] = 'SKIMMING'
-            elif truth_label in cascade_truth_labels:
-                truth_lookup[sid] = 'CASCADE'
-            else:
-                truth_lookup[sid] = None  # Unknown or unclassified
-
-        # === USER ACCURACY CALCULATION ===
-        user_stats = defaultdict(lambda: {'correct':0, 'total':0})
-
-        for _, row in classif.iterrows():
-            user_name = row['user_name']
-            subj_id = row['subject_ids']
-            annot = json.loads(row['annotations'])
-            user_choice = annot[0]['value'][0]['choice']
-
-            # Normalize all track types to 'TRACK' for user accuracy
-            if user_choice in ['THROUGHGOINGTRACK', 'STARTINGTRACK', 'STOPPINGTRACK', 'TRACK']:
-                user_choice = 'TRACK'
-
-            correct_answer = truth_lookup.get(subj_id, None)
-
-            user_stats[user_name]['total'] += 1
-            if correct_answer is not None and user_choice == correct_answer:
-                user_stats[user_name]['correct'] += 1
-
-        # Filter users by accuracy cutoff
-        passing_users = {
-            user for user, stats in user_stats.items()
-            if stats['total'] > 0 and (stats['correct'] / stats['total']) >= accuracy_threshold
-        }
-
-        # === VOTE COUNTING ===
-        subj_ids = np.array(matched['subject_id'])
-        subj_dict = {id: {'TRACK':0, 'CASCADE':0, 'SKIMMING':0} for id in subj_ids}
-
-        subj_data = np.array(classif['subject_data'])
-        annotations = np.array(classif['annotations'])
-        metadata_all = np.array(classif['metadata'])
-        user_names = np.array(classif['user_name'])
-
-        count_votes = 0
-        count_skipped_time = 0
-        count_skipped_user = 0
-        count_skipped_key = 0
-        count_skipped_unknown_choice = 0
-
-        for i in range(len(subj_data)):
-            user = user_names[i]
-            if user not in passing_users:
-                count_skipped_user += 1
-                continue
-
-            try:
-                meta = json.loads(metadata_all[i])
-                start = datetime.fromisoformat(meta['started_at'].replace('Z', '+00:00'))
-                end = datetime.fromisoformat(meta['finished_at'].replace('Z', '+00:00'))
-                time_spent = (end - start).total_seconds()
-                if self.apply_time_cut and time_spent <= 6:
-                    count_skipped_time += 1
-                    continue
-            except Exception:
-                if self.apply_time_cut:
-                    count_skipped_time += 1
-                    continue
-
-            try:
-                metadata = json.loads(subj_data[i])
-                key = int(list(metadata.keys())[0])
-            except Exception:
-                count_skipped_key += 1
-                continue
-
-            if key not in subj_dict:
-                count_skipped_key += 1
-                continue
-
-            try:
-                annot = json.loads(annotations[i])
-                user_choice = annot[0]['value'][0]['choice']
-            except Exception:
-                count_skipped_unknown_choice += 1
-                continue
-
-            # Combine all track subtypes into 'TRACK'
-            if user_choice in ['THROUGHGOINGTRACK', 'STARTINGTRACK', 'STOPPINGTRACK', 'TRACK']:
-                user_choice = 'TRACK'
-
-            if user_choice in ['TRACK', 'CASCADE', 'SKIMMING']:
-                subj_dict[key][user_choice] += 1
-                count_votes += 1
-            else:
-                count_skipped_unknown_choice += 1
-
-        # === FINAL AGGREGATION OF RESULTS ===
-        MAX_VOTES = []
-        MOST_LIKELY = []
-        AGREEMENT = []
-
-        for key in subj_dict:
-            votes = subj_dict[key]
-            max_votes = 0
-            most_likely = None
-            for cat, count in votes.items():
-                if count > max_votes:
-                    max_votes = count
-                    most_likely = cat
-            MAX_VOTES.append(max_votes)
-            MOST_LIKELY.append(most_likely)
-            total_votes = sum(votes.values())
-            AGREEMENT.append(max_votes / total_votes if total_votes > 0 else 0)
-
-        # Save output CSV
-        data = {
-            'subject_id': subj_ids,
-            'event_id': subj_ids,  # duplicate subject_id into event_id for now
-            'data.num_votes': MAX_VOTES,
-            'data.most_likely': MOST_LIKELY,
-            'data.agreement': AGREEMENT
-        }
-
-        os.makedirs(output_dir, exist_ok=True)
-        df = pd.DataFrame(data)
-        csv_name = os.path.join(output_dir, f"{self.output_file}.csv")
-        df.to_csv(csv_name, index=False)
-
-        print(f"Reduction complete! Output saved at:\n{csv_name}")
-        print(f"Votes counted: {count_votes}")
-        print(f"Skipped due to time ≤ 6s or bad metadata: {count_skipped_time}")
-
-        return csv_name
-
-    from types import MethodType
-    reducer.reduce = MethodType(patched_reduce, reducer)
+    reducer.time_cut = time_cut
+    reducer.chunksize = int(chunksize) if chunksize else None
+    reducer.workers = int(workers) if workers else 1
+    reducer.use_cache = use_cache
+    reducer.state_path = os.path.join(output_dir, state_file) if state_file else None
+    reducer.aggregation = 'dawid-skene' if skill_weighted else 'votes'
+    reducer.compression = compression
+    reducer.metrics = Metrics('reducer.py', profile=profile)
+    reducer.metrics.params = {'retirement_lim': lim, 'accuracy_cut': accuracy_cut, 'apply_time_cut': apply_time_cut,
+                              'time_cut': time_cut, 'classifications': classif_path, 'chunksize': reducer.chunksize, 'workers': reducer.workers,
+                              'aggregation': reducer.aggregation}
     reducer.reduce()
+    if metrics_file:
+        reducer.metrics.write(os.path.join(output_dir, metrics_file))
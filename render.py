@@ -0,0 +1,224 @@
+import argparse
+import hashlib
+import importlib
+import json
+import os, os.path
+from concurrent.futures import ProcessPoolExecutor
+
+import matplotlib
+import matplotlib.pyplot as plt
+import seaborn as sns
+
+from confusion import annotation_frame, fraction_frame, interval_annotation_frame
+from tables import read_table
+
+##############################################################################################
+#                                       render.py
+##############################################################################################
+# Purpose: Draws confusion matrix heatmaps, one at a time or as a batch rendered on a process
+#          pool, skipping images whose matrix and styling have not changed
+# Usage: python render.py --inputs <consolidated CSVs> --output-dir <dir> [options]
+#        or from render import Plot, Panel, render_plots
+# Author: Jonathan Berkson
+#
+# A Plot is one count matrix with its labels and output path; a Panel puts several Plots side
+# by side in one figure, so a sweep makes fewer (and fewer open) figures. Batch renders use the
+# Agg backend and write a hash of the counts, labels, styling and library versions into each
+# PNG's metadata. If the file already holds the same hash, it is not drawn again. Other image
+# formats are always rendered.
+##############################################################################################
+
+# Styling of every heatmap; part of the hash, so changing it re-renders existing images
+STYLE = {
+    'figsize': (10, 8),
+    'font_scale': 1.1,
+    'cmap': 'Blues',
+    'cbar_label': 'Fraction of Truth Category',
+    'linewidths': 0.5,
+    'linecolor': 'gray',
+    'xtick_rotation': 45,
+}
+HASH_KEY = 'confusion-matrix-hash'  # PNG text chunk holding the render hash
+
+# Plotter module and title suffix of each flavour (number of categories)
+PLOTTERS = {
+    3: ('Plotter', ''),
+    5: ('5option-Plotter', ' (5 Categories)'),
+}
+
+
+def draw_confusion_matrix(ax, count_matrix, title, xlabel, ylabel, intervals=None):
+    # Fractions of each truth column, annotated with the percentage (and its interval) over count/total
+    sns.heatmap(
+        fraction_frame(count_matrix),
+        annot=annotation_frame(count_matrix) if intervals is None else interval_annotation_frame(count_matrix, *intervals),
+        fmt="",
+        cmap=STYLE['cmap'],
+        cbar_kws={'label': STYLE['cbar_label']},
+        linewidths=STYLE['linewidths'],
+        linecolor=STYLE['linecolor'],
+        vmin=0, vmax=1,  # Fix color scale from 0 to 1 (0% to 100%)
+        ax=ax
+    )
+    ax.set_title(title)
+    ax.set_xlabel(xlabel)
+    ax.set_ylabel(ylabel)
+    plt.setp(ax.get_xticklabels(), rotation=STYLE['xtick_rotation'])
+    plt.setp(ax.get_yticklabels(), rotation=0)
+
+
+def plot_confusion_matrix(count_matrix, title, xlabel, ylabel, output_path, metadata=None, intervals=None):
+    plt.figure(figsize=STYLE['figsize'])
+    sns.set(font_scale=STYLE['font_scale'])
+    draw_confusion_matrix(plt.gca(), count_matrix, title, xlabel, ylabel, intervals)
+    plt.tight_layout()
+
+    plt.savefig(output_path, metadata=metadata)
+    print(f"Saved plot to: {output_path}")
+    plt.close()
+
+
+class Plot:
+    def __init__(self, count_matrix, title, xlabel, ylabel, output_path=None, intervals=None):
+        self.count_matrix = count_matrix  # counts, rows predicted and columns true (confusion.count_frame)
+        self.title = title
+        self.xlabel = xlabel
+        self.ylabel = ylabel
+        self.output_path = output_path    # not needed for a Plot inside a Panel
+        self.intervals = intervals        # (low, high) fraction DataFrames shown under each percentage, or None
+
+    def content(self):
+        content = {'counts': self.count_matrix.to_numpy().tolist(), 'categories': list(self.count_matrix.index),
+                   'columns': list(self.count_matrix.columns), 'labels': [self.title, self.xlabel, self.ylabel]}
+        if self.intervals is not None:
+            content['intervals'] = [bound.to_numpy().tolist() for bound in self.intervals]
+        return content
+
+    def draw(self):
+        plot_confusion_matrix(self.count_matrix, self.title, self.xlabel, self.ylabel, self.output_path,
+                              metadata=png_metadata(self), intervals=self.intervals)
+
+
+class Panel:
+    def __init__(self, plots, output_path, title=None, columns=2):
+        self.plots = list(plots)
+        self.output_path = output_path
+        self.title = title      # figure title above the panels
+        self.columns = columns  # panels per row
+
+    def content(self):
+        return {'panels': [plot.content() for plot in self.plots], 'title': self.title, 'columns': self.columns}
+
+    def draw(self):
+        columns = min(self.columns, len(self.plots))
+        rows = -(-len(self.plots) // columns)
+        width, height = STYLE['figsize']
+        sns.set(font_scale=STYLE['font_scale'])
+        fig, axes = plt.subplots(rows, columns, figsize=(width * columns, height * rows), squeeze=False)
+        for ax, plot in zip(axes.flat, self.plots):
+            draw_confusion_matrix(ax, plot.count_matrix, plot.title, plot.xlabel, plot.ylabel, plot.intervals)
+        for ax in axes.flat[len(self.plots):]:
+            ax.set_visible(False)
+        if self.title:
+            fig.suptitle(self.title)
+        fig.tight_layout()
+
+        fig.savefig(self.output_path, metadata=png_metadata(self))
+        print(f"Saved plot to: {self.output_path}")
+        plt.close(fig)
+
+
+def render_hash(plot):
+    ''' Hash of everything that changes how a Plot or Panel looks '''
+    content = {'plot': plot.content(), 'style': STYLE, 'matplotlib': matplotlib.__version__, 'seaborn': sns.__version__}
+    return hashlib.blake2b(json.dumps(content, sort_keys=True, default=str).encode(), digest_size=16).hexdigest()
+
+
+def png_metadata(plot):
+    return {HASH_KEY: render_hash(plot)} if plot.output_path.lower().endswith('.png') else None
+
+
+def is_unchanged(plot):
+    ''' True if plot's output image exists and was rendered from the same content '''
+    if not plot.output_path.lower().endswith('.png') or not os.path.exists(plot.output_path):
+        return False
+    from PIL import Image
+    try:
+        with Image.open(plot.output_path) as image:
+            return image.text.get(HASH_KEY) == render_hash(plot)
+    except (OSError, AttributeError):
+        return False  # unreadable or not a PNG after all
+
+
+def use_agg():
+    matplotlib.use('Agg')
+
+
+def draw(plot):
+    plot.draw()
+    return plot.output_path
+
+
+def render_plots(plots, workers=1, skip_unchanged=True):
+    ''' Render Plots and Panels, on a pool of workers processes when workers > 1, skipping those
+    whose image is unchanged. Returns {output path: 'rendered' / 'unchanged'}. '''
+    outcomes = {}
+    todo = []
+    for plot in plots:
+        if skip_unchanged and is_unchanged(plot):
+            outcomes[plot.output_path] = 'unchanged'
+            print(f"Unchanged, not redrawn: {plot.output_path}")
+        else:
+            todo.append(plot)
+
+    if workers > 1 and len(todo) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(todo)), initializer=use_agg) as pool:
+            for path in pool.map(draw, todo):
+                outcomes[path] = 'rendered'
+    else:
+        use_agg()
+        for plot in todo:
+            outcomes[draw(plot)] = 'rendered'
+    return outcomes
+
+
+def consolidated_plots(path, output_dir, n_categories=3):
+    ''' User and DNN Plots of a consolidated CSV, saved as <output_dir>/<name>-user.png / -dnn.png '''
+    module, suffix = PLOTTERS[n_categories]
+    plotter = importlib.import_module(module)
+    df = read_table(path, 'consolidated', columns=['data.most_likely', 'idx_max_score', 'ntn_category'])
+    name = os.path.splitext(os.path.basename(path))[0]
+    return [
+        Plot(plotter.compute_count_matrix_user(df),
+             f"User Classification vs. Truth{suffix}", "Ground Truth: ntn_category", "User Prediction: data.most_likely",
+             os.path.join(output_dir, f"{name}-user.png")),
+        Plot(plotter.compute_count_matrix_dnn(df),
+             f"DNN Classification vs. Truth{suffix}", "Ground Truth: ntn_category", "DNN Prediction: idx_max_score",
+             os.path.join(output_dir, f"{name}-dnn.png")),
+    ]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Render the user and DNN confusion matrices of many consolidated CSVs.")
+    parser.add_argument('--inputs', nargs='+', required=True, help="consolidated CSV files")
+    parser.add_argument('--output-dir', required=True, help="directory for the images")
+    parser.add_argument('--categories', type=int, choices=sorted(PLOTTERS), default=3,
+                        help="3- or 5-category consolidated files (default: 3)")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="render processes (default: all CPUs)")
+    parser.add_argument('--panels', action='store_true', help="one figure per input with the user and DNN matrices side by side")
+    parser.add_argument('--force', action='store_true', help="redraw images even if unchanged")
+    args = parser.parse_args()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    plots = []
+    for path in args.inputs:
+        user, dnn = consolidated_plots(path, args.output_dir, args.categories)
+        if args.panels:
+            name = os.path.splitext(os.path.basename(path))[0]
+            plots.append(Panel([user, dnn], os.path.join(args.output_dir, f"{name}-panels.png"), title=name))
+        else:
+            plots += [user, dnn]
+
+    outcomes = render_plots(plots, workers=args.workers, skip_unchanged=not args.force)
+    rendered = sum(outcome == 'rendered' for outcome in outcomes.values())
+    print(f"\n{rendered} images rendered, {len(outcomes) - rendered} unchanged")
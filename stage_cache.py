@@ -0,0 +1,108 @@
+import hashlib
+import os, os.path
+import tempfile
+from importlib.util import find_spec
+
+import pandas as pd
+
+from parse_cache import file_digest
+
+##############################################################################################
+#                                       stage_cache.py
+##############################################################################################
+# Purpose: Content-addressed cache of pipeline stage outputs, so a rerun only recomputes the
+#          stages whose input files, parameters or code changed
+# Usage: from stage_cache import StageCache
+# Author: Jonathan Berkson
+#
+# A stage's key hashes the contents of its input files, its parameters, the keys of the
+# stages it consumes and the source of the modules it runs. Changing the agreement cut
+# therefore reruns consolidation but reuses the reduction, and editing consolidator.py
+# invalidates consolidation everywhere. Outputs are pickled, one file per entry, and the
+# least recently used entries are evicted above max_bytes.
+##############################################################################################
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'icecube-phase3', 'stages')
+DEFAULT_MAX_BYTES = 1024**3  # 1 GB
+
+
+def module_digest(module):
+    ''' Content hash of a module's source file, by module name '''
+    return file_digest(find_spec(module).origin)
+
+
+class StageCache:
+    def __init__(self, cache_dir=None, max_bytes=DEFAULT_MAX_BYTES, force=False, enabled=True):
+        self.cache_dir = cache_dir or DEFAULT_CACHE_DIR
+        self.max_bytes = max_bytes
+        self.force = force      # recompute every stage (and refresh its entry) even on a hit
+        self.enabled = enabled  # False: always compute, never read or write entries
+        self.report = []        # (stage, 'hit' / 'miss' / 'forced' / 'off') of every stage run, in order
+
+    def key(self, stage, inputs=(), params=None, upstream=(), code=()):
+        ''' Key of a stage run: input file contents, parameters, upstream keys and module sources '''
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(stage.encode())
+        for path in inputs:
+            digest.update(file_digest(path).encode())
+        digest.update(repr(sorted((params or {}).items())).encode())
+        for key in upstream:
+            digest.update(key.encode())
+        for module in code:
+            digest.update(module_digest(module).encode())
+        return f"{stage}-{digest.hexdigest()}"
+
+    def run(self, key, compute):
+        ''' Stored output of key, or compute() stored under key '''
+        stage = key.rsplit('-', 1)[0]
+        entry = os.path.join(self.cache_dir, f"{key}.pkl")
+        if not self.enabled:
+            self.record(stage, 'off')
+            return compute()
+        if not self.force and os.path.exists(entry):
+            os.utime(entry)  # mark as recently used for eviction
+            self.record(stage, 'hit')
+            return pd.read_pickle(entry)
+
+        value = compute()
+        os.makedirs(self.cache_dir, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir, prefix='.tmp-')
+        os.close(fd)
+        try:
+            pd.to_pickle(value, tmp)
+            os.replace(tmp, entry)
+        except BaseException:
+            os.remove(tmp)
+            raise
+        self.evict(keep=entry)
+        self.record(stage, 'forced' if self.force else 'miss')
+        return value
+
+    def record(self, stage, outcome):
+        self.report.append((stage, outcome))
+        if self.enabled:
+            print(f"[stage cache] {stage}: {outcome}")
+
+    def summary(self):
+        hits = sum(outcome == 'hit' for _, outcome in self.report)
+        return f"{hits} of {len(self.report)} stages reused from the cache"
+
+    def evict(self, keep=None):
+        ''' Remove least recently used entries until the cache is under max_bytes '''
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.endswith('.pkl') and not name.startswith('.'):
+                entries.append((os.path.getmtime(path), os.path.getsize(path), path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                pass  # already evicted by another process
+            total -= size
@@ -0,0 +1,170 @@
+import os, os.path
+from itertools import product
+
+import numpy as np
+import pandas as pd
+
+from binned import AXES, binned_performance, curve_frame, event_weights
+from consolidator import DNN_COLUMNS, Consolidator
+from matched_store import load_matched
+from parse_cache import load_parsed_classifications
+from reducer import CATEGORIES, MATCHED_COLUMNS, TRACK_CHOICES, Reducer
+from tally import VoteTally
+
+##############################################################################################
+#                                       sweep.py
+##############################################################################################
+# Purpose: Reduces and consolidates one classification export for a whole grid of accuracy
+#          cuts, time cuts, retirement limits and agreement cuts, parsing the export only once
+# Usage: python sweep.py (interactive input prompts)
+# Author: Jonathan Berkson
+#
+# Per-user accuracy and per-classification features (user, subject row, voted category,
+# time spent) are computed once. Each (accuracy cut, time cut) pair is then a boolean mask
+# over the classifications followed by one scatter-add, and each (retirement limit, agreement
+# cut) pair is a row mask over the consolidated subjects. Results match running reducer.py
+# and consolidator.py by hand for every grid point. Optionally, accuracy vs. energy, zenith and
+# charge (binned.py) is computed for every grid point too, each in one histogram pass.
+##############################################################################################
+
+def time_cut_label(time_cut):
+    return 'notime' if time_cut is None else f"{time_cut:g}s"
+
+
+class Sweep:
+    def __init__(self, input_dir, output_dir, accuracy_cuts, time_cuts, retirement_lims, agreement_cuts):
+        self.input_dir = input_dir
+        self.output_dir = output_dir
+        self.accuracy_cuts = accuracy_cuts      # minimum user accuracy, in percent
+        self.time_cuts = time_cuts              # seconds; a vote needs time_spent > cut, None for no cut
+        self.retirement_lims = retirement_lims  # minimum votes per subject
+        self.agreement_cuts = agreement_cuts    # minimum agreement fraction
+        self.classif_path = None
+        self.matched_path = None
+        self.output_file = None
+        self.write_outputs = False  # also write the reduced and consolidated CSV of every grid point
+        self.binned = False         # also write <output>-binned.csv, accuracy curves of every grid point
+        self.weighted = False       # weight the binned curves by oneweight
+        self.use_cache = True       # reuse the parsed-classification cache and matched store when available
+        self.cache_dir = None
+
+    def run(self):
+        matched = load_matched(self.matched_path, columns=list(dict.fromkeys(MATCHED_COLUMNS + DNN_COLUMNS)), compact=False,
+                               use_cache=self.use_cache)
+        parsed = load_parsed_classifications(self.classif_path, use_cache=self.use_cache, cache_dir=self.cache_dir)
+        subj_ids = np.array(matched['subject_id'])
+
+        # === PER-CLASSIFICATION FEATURES (computed once) ===
+        truth_lookup = Reducer(self.input_dir, self.output_dir, 0).build_truth_lookup(matched)
+        choice = parsed['choice'].where(~parsed['choice'].isin(TRACK_CHOICES), 'TRACK')
+        truth = pd.Series(truth_lookup.lookup(parsed['subject_ids']), index=parsed.index, dtype=object)
+        correct = (truth.notna() & (choice == truth)).to_numpy()
+
+        user_codes, users = pd.factorize(parsed['user_name'], use_na_sentinel=False)
+        total = np.bincount(user_codes, minlength=len(users))
+        accuracy = np.bincount(user_codes, weights=correct, minlength=len(users)) / total
+
+        layout = VoteTally(subj_ids, CATEGORIES)
+        subject_row = layout.rows(parsed['subject_key'])
+        category = layout.codes(choice)  # -1 for unknown or unreadable choices
+        votable = (subject_row >= 0) & (category >= 0)
+        time_spent = parsed['time_spent'].to_numpy()
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        base = Consolidator(self.input_dir, self.output_dir, 0, -np.inf)
+        rows = []
+        curves = []
+        for accuracy_cut, time_cut in product(self.accuracy_cuts, self.time_cuts):
+            # === REDUCE: one mask + scatter-add per (accuracy cut, time cut) ===
+            passing = accuracy >= accuracy_cut / 100
+            mask = votable & passing[user_codes]
+            if time_cut is not None:
+                mask &= time_spent > time_cut  # NaN (unreadable metadata) fails the cut
+            tally = VoteTally(subj_ids, CATEGORIES)
+            tally.add(subject_row[mask], category[mask])
+            reduced = tally.reduced_frame()
+            if self.write_outputs:
+                self.save_reduced(reduced, accuracy_cut, time_cut)
+
+            # === CONSOLIDATE once without cuts; each (limit, agreement) pair is a row mask ===
+            cdf = base.consolidate_frames(reduced, matched)
+            for lim, agreement_cut in product(self.retirement_lims, self.agreement_cuts):
+                keep = cdf['data.agreement'] >= agreement_cut
+                if lim is not None and lim > 0:
+                    keep = keep & (cdf['data.num_votes'] >= lim)
+                rows.append({
+                    'accuracy_cut': accuracy_cut,
+                    'time_cut': time_cut,
+                    'retirement_lim': lim,
+                    'agreement_cut': agreement_cut,
+                    'passing_users': int(passing.sum()),
+                    'votes': int(mask.sum()),
+                    'subjects': int(keep.sum()),
+                    'user_accuracy': cdf['user_accuracy'][keep].mean(),
+                    'DNN_accuracy': cdf['DNN_accuracy'][keep].mean(),
+                })
+
+                if self.binned:
+                    kept = cdf[keep.to_numpy()]
+                    result = binned_performance(kept, CATEGORIES, weights=event_weights(kept) if self.weighted else None)
+                    for axis in AXES:
+                        curves.append(curve_frame(result, axis).assign(accuracy_cut=accuracy_cut, time_cut=time_cut,
+                                                                       retirement_lim=lim, agreement_cut=agreement_cut))
+
+                if self.write_outputs:
+                    self.save_grid_point(reduced, matched, accuracy_cut, time_cut, lim, agreement_cut)
+
+        summary = pd.DataFrame(rows)
+        csv_name = os.path.join(self.output_dir, f"{self.output_file}.csv")
+        summary.to_csv(csv_name, index=False)
+        if curves:
+            binned = pd.concat(curves, ignore_index=True)
+            grid = ['accuracy_cut', 'time_cut', 'retirement_lim', 'agreement_cut']
+            binned[grid + [c for c in binned.columns if c not in grid]].to_csv(
+                os.path.join(self.output_dir, f"{self.output_file}-binned.csv"), index=False)
+        return csv_name
+
+    def save_reduced(self, reduced, accuracy_cut, time_cut):
+        reduced.to_csv(os.path.join(self.output_dir, f"{self.output_file}-reduced-{accuracy_cut}Ac-{time_cut_label(time_cut)}.csv"),
+                       index=False)
+
+    def save_grid_point(self, reduced, matched, accuracy_cut, time_cut, lim, agreement_cut):
+        # Files are named like the README's plots, e.g. <output>-60Ac90Ag-6s-20lim.csv
+        consolidator = Consolidator(self.input_dir, self.output_dir, lim, agreement_cut)
+        cdf = consolidator.consolidate_frames(reduced.copy(), matched)
+        tag = f"{accuracy_cut}Ac{agreement_cut * 100:g}Ag-{time_cut_label(time_cut)}-{lim}lim"
+        cdf.to_csv(os.path.join(self.output_dir, f"{self.output_file}-{tag}.csv"), index=False)
+
+
+def parse_list(text, cast):
+    return [None if item.strip().lower() == 'none' else cast(item) for item in text.split(',') if item.strip()]
+
+
+if __name__ == '__main__':
+    # User input prompts (comma separated lists)
+    accuracy_cuts = parse_list(input("Enter user accuracy cutoffs (percent, e.g. 60,70): "), int)
+    time_cuts = parse_list(input("Enter time cutoffs in seconds (e.g. 6,10; 'none' for no cut): "), float)
+    retirement_lims = parse_list(input("Enter retirement limits (e.g. 10,20): "), int)
+    agreement_cuts = parse_list(input("Enter agreement cutoffs (e.g. 0.8,0.9): "), float)
+
+    input_dir = input("Enter input directory path: ").strip('"')
+    output_dir = input("Enter output directory path: ").strip('"')
+
+    classif_file = input("Enter classification CSV filename: ").strip()
+    matched_file = input("Enter matched data CSV filename: ").strip()
+    output_file = input("Enter summary output filename (without .csv): ").strip()
+    write_outputs = input("Also write reduced and consolidated CSVs for every grid point? (y/n): ").strip().lower() == 'y'
+    binned = input("Also write accuracy vs. energy/zenith/charge for every grid point? (y/n, or w to weight by oneweight): ").strip().lower()
+
+    print("\nSweeping... (this might take a couple seconds)\n")
+
+    sweep = Sweep(input_dir, output_dir, accuracy_cuts, time_cuts, retirement_lims, agreement_cuts)
+    sweep.classif_path = os.path.join(input_dir, classif_file)
+    sweep.matched_path = os.path.join(input_dir, matched_file)
+    sweep.output_file = output_file
+    sweep.write_outputs = write_outputs
+    sweep.binned = binned in ('y', 'w')
+    sweep.weighted = binned == 'w'
+    summary_path = sweep.run()
+
+    print(f"Sweep complete. Summary saved at:\n{summary_path}")
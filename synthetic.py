@@ -0,0 +1,200 @@
+import argparse
+import os, os.path
+
+import numpy as np
+import pandas as pd
+
+##############################################################################################
+#                                       synthetic.py
+##############################################################################################
+# Purpose: Writes a synthetic Zooniverse classification export, subjects export and
+#          matched_sim_data CSV with the column layouts the reducers and consolidators expect
+# Usage: python synthetic.py --output-dir <dir> --classifications 100000 [options]
+#        or from synthetic import generate
+# Author: Jonathan Berkson
+#
+# Users have a skill drawn from a Beta distribution and an activity that falls off with their
+# rank (a few users make most of the classifications, as in the real project). A user answers
+# a subject's true category with probability equal to their skill and guesses otherwise. The
+# classification export is written in chunks, so 10^7 rows do not need to fit in memory.
+##############################################################################################
+
+# (truth label, ntn_category, top-level choice, WHATTYPEOFTRACKISIT answer, relative frequency)
+TRUTH_LABELS = [
+    ('throughgoing_track', 2, 'TRACK', 'THROUGHGOINGTRACK', 3),
+    ('throughgoing_bundle', 2, 'TRACK', 'THROUGHGOINGTRACK', 1),
+    ('starting_track', 3, 'TRACK', 'STARTINGTRACK', 2),
+    ('stopping_track', 4, 'TRACK', 'STOPPINGTRACK', 2),
+    ('stopping_bundle', 4, 'TRACK', 'STOPPINGTRACK', 1),
+    ('skimming_track', 0, 'SKIMMING', None, 2),
+    ('uncontained_cascade', 0, 'SKIMMING', None, 1),
+    ('contained_em_hadr_cascade', 1, 'CASCADE', None, 3),
+    ('contained_hadron_cascade', 1, 'CASCADE', None, 2),
+]
+CHOICES = ['TRACK', 'CASCADE', 'SKIMMING']
+TRACK_TYPES = ['THROUGHGOINGTRACK', 'STARTINGTRACK', 'STOPPINGTRACK']
+
+PROJECT_ID = 15000
+WORKFLOW_ID = 28000
+START = np.datetime64('2025-06-01T00:00:00', 'ms')
+
+
+def generate(output_dir, n_classifications, n_subjects=None, n_users=None, skill=(4.0, 2.0), activity=1.0,
+             dnn_accuracy=0.8, bad_fraction=0.0, seed=0, chunk_rows=1_000_000):
+    ''' Write classifications.csv, subjects.csv and matched_sim_data.csv to output_dir.
+    By default there are about 20 classifications per subject and 50 per user. skill is the
+    (alpha, beta) of the users' Beta-distributed accuracy, activity the exponent of the
+    power law of classifications per user rank, and bad_fraction the share of classifications
+    with unreadable annotations, metadata or subject_data. Returns the three paths. '''
+    rng = np.random.default_rng(seed)
+    n_subjects = n_subjects or max(1, n_classifications // 20)
+    n_users = n_users or max(1, n_classifications // 50)
+    os.makedirs(output_dir, exist_ok=True)
+    paths = tuple(os.path.join(output_dir, name) for name in ('classifications.csv', 'subjects.csv', 'matched_sim_data.csv'))
+
+    # === SUBJECTS: truth label, DNN scores and physics per subject ===
+    subject_ids = 90_000_000 + np.arange(n_subjects)
+    frequency = np.array([label[4] for label in TRUTH_LABELS], dtype=float)
+    truth = rng.choice(len(TRUTH_LABELS), size=n_subjects, p=frequency / frequency.sum())
+    matched = matched_frame(rng, subject_ids, truth, dnn_accuracy)
+    matched.to_csv(paths[2], index=False)
+    subjects_frame(subject_ids, matched).to_csv(paths[1], index=False)
+
+    # === USERS: skill and share of the classifications ===
+    skills = rng.beta(*skill, size=n_users)
+    weights = np.arange(1, n_users + 1, dtype=float) ** -activity
+    user_names = np.array([f"user{i}" for i in range(n_users)], dtype=object)
+    user_names[rng.random(n_users) < 0.05] = None  # not logged in, named per classification below
+
+    # === CLASSIFICATIONS, written one chunk at a time ===
+    for start in range(0, n_classifications, chunk_rows):
+        n = min(chunk_rows, n_classifications - start)
+        chunk = classification_chunk(rng, start, n, n_classifications, subject_ids, truth, user_names, skills,
+                                     weights / weights.sum(), bad_fraction)
+        chunk.to_csv(paths[0], index=False, mode='w' if start == 0 else 'a', header=start == 0)
+    return paths
+
+
+def matched_frame(rng, subject_ids, truth, dnn_accuracy):
+    n = len(subject_ids)
+    ntn = np.array([TRUTH_LABELS[t][1] for t in truth], dtype=float)
+
+    # DNN scores over (skim, cascade, tgtrack, starttrack, stoptrack), peaked on the truth when right
+    scores = rng.dirichlet(np.full(5, 0.5), size=n)
+    right = rng.random(n) < dnn_accuracy
+    scores[right, ntn[right].astype(int)] += 1
+    scores /= scores.sum(axis=1, keepdims=True)
+    ntn[rng.random(n) < 0.02] = np.nan  # some subjects have no DNN category
+
+    signal = rng.lognormal(4, 1.5, size=n)
+    background = rng.lognormal(1, 1, size=n)
+    return pd.DataFrame({
+        'subject_id': subject_ids,
+        'filename': [f"run{120000 + i // 1000}_event{i}.i3" for i in range(n)],
+        'run': 120000 + np.arange(n) // 1000,
+        'event': np.arange(n),
+        'truth_classification': truth,
+        'pred_skim': scores[:, 0],
+        'pred_cascade': scores[:, 1],
+        'pred_tgtrack': scores[:, 2],
+        'pred_starttrack': scores[:, 3],
+        'pred_stoptrack': scores[:, 4],
+        'energy': 10 ** rng.uniform(2, 7, size=n),
+        'zenith': np.arccos(rng.uniform(-1, 1, size=n)),
+        'oneweight': rng.lognormal(10, 2, size=n),
+        'signal_charge': signal,
+        'bg_charge': background,
+        'qratio': signal / (signal + background),
+        'qtot': signal + background,
+        'log10_max_charge': np.log10(signal) - rng.uniform(0, 1, size=n),
+        '#truth_classification_label': [TRUTH_LABELS[t][0] for t in truth],
+        'max_score_val': scores.max(axis=1),
+        'idx_max_score': scores.argmax(axis=1),
+        'ntn_category': ntn,
+    })
+
+
+def subjects_frame(subject_ids, matched):
+    return pd.DataFrame({
+        'subject_id': subject_ids,
+        'project_id': PROJECT_ID,
+        'workflow_id': WORKFLOW_ID,
+        'subject_set_id': 120000,
+        'metadata': '{"Filename":"' + matched['filename'] + '"}',
+        'locations': '{"0":"https://panoptes-uploads.zooniverse.org/subject_location/' + matched['filename'] + '.mp4"}',
+        'classifications_count': 0,
+    })
+
+
+def classification_chunk(rng, start, n, n_total, subject_ids, truth, user_names, skills, user_p, bad_fraction):
+    users = rng.choice(len(user_names), size=n, p=user_p)
+    subjects = rng.integers(0, len(subject_ids), size=n)
+
+    # Answer: the truth with probability skill, otherwise a guess
+    true_choice = np.array([label[2] for label in TRUTH_LABELS], dtype=object)[truth[subjects]]
+    true_type = np.array([label[3] for label in TRUTH_LABELS], dtype=object)[truth[subjects]]
+    right = rng.random(n) < skills[users]
+    choice = np.where(right, true_choice, np.array(CHOICES, dtype=object)[rng.integers(0, 3, size=n)])
+    track_type = np.where(right & (true_type != None), true_type,
+                          np.array(TRACK_TYPES, dtype=object)[rng.integers(0, 3, size=n)])
+    answers = pd.Series(np.where(choice == 'TRACK', '{"WHATTYPEOFTRACKISIT":"' + track_type + '"}', '{}'))
+    annotations = '[{"task":"T0","task_label":null,"value":[{"choice":"' + pd.Series(choice) + \
+                  '","answers":' + answers + ',"filters":{}}]}]'
+
+    # Timestamps: classifications spread evenly over 30 days, time spent lognormal around 12 s
+    created = START + ((start + np.arange(n)) * (30 * 86400 * 1000) // n_total).astype('timedelta64[ms]')
+    spent = np.round(rng.lognormal(np.log(12), 0.6, size=n) * 1000).astype('timedelta64[ms]')
+    started_at = pd.Series(np.datetime_as_string(created - spent, unit='ms')) + 'Z'
+    finished_at = pd.Series(np.datetime_as_string(created, unit='ms')) + 'Z'
+    metadata = '{"source":"api","started_at":"' + started_at + '","finished_at":"' + finished_at + \
+               '","user_language":"en","utc_offset":"0"}'
+
+    sid = pd.Series(subject_ids[subjects].astype(str))
+    subject_data = '{"' + sid + '":{"retired":null,"Filename":"subject_' + sid + '.mp4"}}'
+
+    # Unreadable rows, to exercise the reducers' skip paths
+    if bad_fraction > 0:
+        for column in (annotations, metadata, subject_data):
+            column[rng.random(n) < bad_fraction / 3] = '[]'
+
+    name = user_names[users]
+    anonymous = pd.isna(name)
+    name[anonymous] = [f"not-logged-in-{h:08x}" for h in rng.integers(0, 16**8, size=int(anonymous.sum()))]
+    user_id = pd.array(2_000_000 + users, dtype='Int64')
+    user_id[anonymous] = pd.NA
+    return pd.DataFrame({
+        'classification_id': 600_000_000 + start + np.arange(n),
+        'user_name': name,
+        'user_id': user_id,
+        'user_ip': 'ip' + pd.Series(users.astype(str)),
+        'workflow_id': WORKFLOW_ID,
+        'workflow_name': 'Name that Neutrino',
+        'workflow_version': 12.34,
+        'created_at': pd.Series(np.datetime_as_string(created.astype('datetime64[s]'))).str.replace('T', ' ') + ' UTC',
+        'gold_standard': None,
+        'expert': None,
+        'metadata': metadata,
+        'annotations': annotations,
+        'subject_data': subject_data,
+        'subject_ids': subject_ids[subjects],
+    })
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Write a synthetic classification export, subjects export and matched data.")
+    parser.add_argument('--output-dir', required=True, help="directory for the three CSVs")
+    parser.add_argument('--classifications', type=int, required=True, help="number of classifications")
+    parser.add_argument('--subjects', type=int, default=None, help="number of subjects (default: classifications / 20)")
+    parser.add_argument('--users', type=int, default=None, help="number of users (default: classifications / 50)")
+    parser.add_argument('--skill', type=float, nargs=2, default=(4.0, 2.0), metavar=('ALPHA', 'BETA'),
+                        help="Beta distribution of user accuracy (default: 4 2)")
+    parser.add_argument('--activity', type=float, default=1.0,
+                        help="power law exponent of classifications per user rank (default: 1)")
+    parser.add_argument('--dnn-accuracy', type=float, default=0.8, help="fraction of subjects the DNN gets right")
+    parser.add_argument('--bad-fraction', type=float, default=0.0, help="fraction of classifications with unreadable JSON")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    paths = generate(args.output_dir, args.classifications, args.subjects, args.users, tuple(args.skill), args.activity,
+                     args.dnn_accuracy, args.bad_fraction, args.seed)
+    print("Synthetic data written to:\n" + "\n".join(paths))
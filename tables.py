@@ -0,0 +1,170 @@
+import os.path
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from importlib.util import find_spec
+
+import pandas as pd
+
+##############################################################################################
+#                                       tables.py
+##############################################################################################
+# Purpose: Declared schemas of the CSV files passed between the pipeline stages, and a loader
+#          that reads only the columns a stage needs with explicit, compact dtypes
+# Usage: from tables import read_table, load_concurrently, csv_path
+# Author: Jonathan Berkson
+#
+# Ids are int64 (Int64 where a missing value is possible), labels that repeat across many rows
+# are categorical and physics columns are float32. Scores and anything written back out by a
+# stage are kept at full precision so the outputs do not change. Columns declared as None are
+# left to pandas' inference. Columns not in a schema are read with inferred dtypes.
+# A stage with several inputs reads them at once on threads (load_concurrently): both CSV
+# engines release the GIL while parsing, and reads from network storage mostly wait on I/O.
+# Any of these files may be compressed (.gz, .bz2, .xz or a single-file .zip): pandas picks the
+# codec from the extension and decompresses while it parses, in chunks too, so an archived
+# export is read as it is, never unpacked to disk. Outputs named by csv_path are compressed the
+# same way when written.
+##############################################################################################
+
+SCHEMAS = {
+    # Zooniverse classification export
+    'classification': {
+        'classification_id': 'int64',
+        'user_name': 'str',
+        'user_id': 'Int64',  # missing for users who are not logged in
+        'user_ip': 'str',
+        'workflow_id': 'int64',
+        'workflow_name': 'category',
+        'workflow_version': 'float64',
+        'created_at': 'str',
+        'gold_standard': 'str',
+        'expert': 'str',
+        'metadata': 'str',
+        'annotations': 'str',
+        'subject_data': 'str',
+        'subject_ids': 'int64',
+    },
+    # Zooniverse subject export
+    'subjects': {
+        'subject_id': 'int64',
+        'project_id': 'int64',
+        'workflow_id': 'Int64',
+        'metadata': 'str',
+    },
+    # matched_sim_data: DNN scores, physics and truth labels per subject
+    'matched': {
+        'subject_id': 'int64',
+        'filename': 'str',
+        'run': 'Int64',
+        'event': 'Int64',
+        'truth_classification': 'Int64',
+        'pred_skim': 'float64',
+        'pred_cascade': 'float64',
+        'pred_tgtrack': 'float64',
+        'pred_starttrack': 'float64',
+        'pred_stoptrack': 'float64',
+        'energy': 'float32',
+        'zenith': 'float32',
+        'oneweight': 'float32',
+        'signal_charge': 'float32',
+        'bg_charge': 'float32',
+        'qratio': 'float32',
+        'qtot': 'float32',
+        'log10_max_charge': 'float32',
+        '#truth_classification_label': 'category',
+        'max_score_val': 'float64',
+        'idx_max_score': 'Int64',
+        'ntn_category': 'float64',  # 0-4, NaN when the DNN gave no category
+    },
+    # Reducer output
+    'reduced': {
+        'subject_id': 'int64',
+        'event_id': 'int64',
+        'data.num_votes': 'int64',
+        'data.most_likely': 'str',
+        'data.agreement': None,  # integer zeros when no subject has votes
+    },
+    # Consolidator output (3- and 5-category)
+    'consolidated': {
+        'subject_id': 'int64',
+        'data.num_votes': 'float64',  # NaN for subjects dropped by the retirement limit
+        'data.most_likely': 'str',
+        'data.agreement': 'float64',
+        'filename_y': 'str',
+        'truth_classification': 'Int64',
+        'pred_skim': 'float64',
+        'pred_cascade': 'float64',
+        'pred_track': 'float64',
+        'pred_tgtrack': 'float64',
+        'pred_starttrack': 'float64',
+        'pred_stoptrack': 'float64',
+        'energy': 'float32',
+        'zenith': 'float32',
+        'oneweight': 'float32',
+        'signal_charge': 'float32',
+        'bg_charge': 'float32',
+        'qratio': 'float32',
+        'qtot': 'float32',
+        'max_score_val': 'float64',
+        'idx_max_score': 'str',
+        'ntn_category': 'str',
+        'user_accuracy': 'int64',
+        'DNN_accuracy': 'int64',
+    },
+}
+
+# Output compressions and their file extensions
+COMPRESSIONS = {'gzip': '.gz', 'bz2': '.bz2', 'xz': '.xz', 'zip': '.zip'}
+
+# pyarrow's CSV reader is multithreaded; it is used when installed for pruned reads, except for
+# streamed reads (it has no chunked mode) and float columns (its float parsing can differ from
+# the C parser in the last digit, which would change the written outputs)
+HAVE_PYARROW = find_spec('pyarrow') is not None
+
+
+def read_table(path, kind, columns=None, compact=True, chunksize=None):
+    ''' Read a pipeline CSV of the given kind (a SCHEMAS key), keeping only columns if given.
+    With compact=False float32 physics columns are read as float64, e.g. to write them back out.
+    With chunksize an iterator of DataFrames is returned, as with pd.read_csv. '''
+    schema = SCHEMAS[kind]
+    dtype = {}
+    for name in (schema if columns is None else columns):
+        declared = schema.get(name)
+        if declared is not None:
+            dtype[name] = 'float64' if declared == 'float32' and not compact else declared
+
+    engine = 'c'
+    if HAVE_PYARROW and columns is not None and chunksize is None and not any(d.startswith('float') for d in dtype.values()):
+        engine = 'pyarrow'
+    return pd.read_csv(path, usecols=columns, dtype=dtype, engine=engine, chunksize=chunksize)
+
+
+def csv_path(directory, name, compression=None):
+    ''' Path of the CSV name (without .csv) in directory, with the extension of compression
+    (a COMPRESSIONS key, None for plain); to_csv compresses by the extension '''
+    return os.path.join(directory, f"{name}.csv{COMPRESSIONS[compression] if compression else ''}")
+
+
+def parse_compression(answer):
+    ''' Compression of a prompt answer: blank or n for none, else a COMPRESSIONS key or extension '''
+    answer = answer.strip().lower().lstrip('.')
+    if answer in ('', 'n', 'no', 'none'):
+        return None
+    for name, extension in COMPRESSIONS.items():
+        if answer in (name, extension[1:]):
+            return name
+    raise ValueError(f"Unknown compression '{answer}', expected one of: {', '.join(COMPRESSIONS)}")
+
+
+def load_concurrently(loaders):
+    ''' Run each loader of {name: function} on its own thread and return {name: result}. Each
+    loader reads one input and validates / prepares it, so whichever input is read first is
+    processed while the others are still loading. An exception of a loader is raised once
+    the loads still running have finished (threads cannot be interrupted). '''
+    results = {}
+    pool = ThreadPoolExecutor(max_workers=max(1, len(loaders)))
+    try:
+        futures = {pool.submit(loader): name for name, loader in loaders.items()}
+        for future in as_completed(futures):
+            results[futures[future]] = future.result()
+    finally:
+        pool.shutdown()
+    return results
@@ -0,0 +1,207 @@
+import numpy as np
+import pandas as pd
+
+##############################################################################################
+#                                       tally.py
+##############################################################################################
+# Purpose: Array-backed per-subject vote tally shared by the reducers and the sweep
+# Usage: from tally import VoteTally
+# Author: Jonathan Berkson
+#
+# Votes are kept in a dense (n_subjects, n_categories) integer matrix, with a precomputed
+# subject_id → row index. Votes are added in batches with a scatter-add and the reduced
+# columns (num_votes, most_likely, agreement) are whole-array operations on the matrix.
+# A tally can also keep who cast each vote. Its sparse_votes() are then a UserVotes matrix,
+# users × subjects × categories stored as (user, row, category, count) entries of the votes
+# actually cast: per-user counts are row sums, the subject tallies column sums, and a user
+# filter is a row mask. It feeds skill-weighted consensus (consensus.py) and per-user
+# diagnostics such as agreement with the consensus and leave-one-out agreement. SubjectLabels
+# looks up a label per subject (e.g. its truth category) through the same kind of row index,
+# as one array gather instead of a dict entry per subject.
+##############################################################################################
+##############################################################################################
+
+def subject_rows(index, subject_keys):
+    ''' Position of each subject key in index (a pd.Index of subject ids), -1 for missing keys or subjects not in it '''
+    keys = pd.Series(subject_keys)
+    rows = np.full(len(keys), -1, dtype=np.int64)
+    valid = keys.notna().to_numpy()
+    if valid.any():
+        rows[valid] = index.get_indexer(keys[valid].astype(np.int64))
+    return rows
+
+
+class SubjectLabels:
+    def __init__(self, index, labels, missing):
+        self.index = index      # pd.Index of the subject ids (e.g. a VoteTally's index)
+        self.labels = np.asarray(labels, dtype=object)  # label of each subject, in index order
+        self.missing = missing  # label of subjects not in the index
+
+    def rows(self, subject_keys):
+        return subject_rows(self.index, subject_keys)
+
+    def at(self, rows):
+        ''' Label of each row (from rows()), missing for -1 '''
+        labels = np.full(len(rows), self.missing, dtype=object)
+        found = rows >= 0
+        labels[found] = self.labels[rows[found]]
+        return labels
+
+    def lookup(self, subject_keys):
+        ''' Label of each subject key, missing for missing keys or subjects not in the index '''
+        return self.at(self.rows(subject_keys))
+
+
+class VoteTally:
+    def __init__(self, subj_ids, categories):
+        self.subj_ids = np.asarray(subj_ids)
+        self.categories = list(categories)  # column order; ties go to the first category
+        self.index = pd.Index(self.subj_ids)
+        self.counts = np.zeros((len(self.subj_ids), len(self.categories)), dtype=np.int64)
+        self.user_votes = None  # batches of (users, rows, codes, weights) once keep_user_votes() is called
+
+    def keep_user_votes(self):
+        ''' Also record the user of every vote added from now on (see sparse_votes) '''
+        self.user_votes = []
+
+    def rows(self, subject_keys):
+        ''' Row of each subject key, -1 for missing keys or subjects not in the tally '''
+        return subject_rows(self.index, subject_keys)
+
+    def codes(self, labels):
+        ''' Column of each category label, -1 for anything else (including None, and lists or dicts
+        decoded by the json.loads fallback, which cannot be looked up in an index) '''
+        labels = pd.Series(labels, dtype=object)
+        try:
+            return pd.Index(self.categories).get_indexer(labels)
+        except TypeError:
+            return pd.Index(self.categories).get_indexer(labels.where(labels.isin(self.categories)))
+
+    def add(self, rows, codes, weights=1, users=None):
+        ''' Scatter-add votes (or weighted vote counts) at (row, category code) pairs, cast by
+        users (names, needed when the tally keeps user votes) '''
+        np.add.at(self.counts, (rows, codes), weights)
+        if self.user_votes is not None:
+            self.user_votes.append((np.asarray(users, dtype=object), np.asarray(rows), np.asarray(codes),
+                                    np.broadcast_to(weights, np.shape(rows))))
+
+    def sparse_votes(self):
+        ''' UserVotes matrix of the kept user votes, with repeated (user, row, code) summed '''
+        votes = UserVotes(self.subj_ids, self.categories)
+        if not self.user_votes:
+            return votes
+        users, rows, codes, weights = (np.concatenate(parts) for parts in zip(*self.user_votes))
+        user_codes, names = pd.factorize(pd.Series(users, dtype=object), use_na_sentinel=False)
+        key = (user_codes * len(self.subj_ids) + rows) * len(self.categories) + codes
+        key, inverse = np.unique(key, return_inverse=True)
+        votes.weights = np.bincount(inverse, weights=weights).astype(np.int64)
+        key, votes.codes = np.divmod(key, len(self.categories))
+        votes.user_codes, votes.rows = np.divmod(key, len(self.subj_ids))
+        votes.users = np.asarray(names, dtype=object)
+        return votes
+
+    def collapse(self, categories, columns):
+        ''' Tally over coarser categories: column j is summed into categories[columns[j]] (-1 drops it) '''
+        collapsed = VoteTally(self.subj_ids, categories)
+        for j, column in enumerate(columns):
+            if column >= 0:
+                collapsed.counts[:, column] += self.counts[:, j]
+        if self.user_votes is not None:
+            columns = np.asarray(columns)
+            collapsed.user_votes = [(users[keep], rows[keep], columns[codes][keep], weights[keep])
+                                    for users, rows, codes, weights in self.user_votes
+                                    for keep in [columns[codes] >= 0]]
+        return collapsed
+
+    def reduced_frame(self, posteriors=None):
+        ''' Reduced DataFrame (subject_id, event_id, data.num_votes, data.most_likely, data.agreement).
+        With posteriors (n_subjects, n_categories class probabilities, e.g. from consensus.py),
+        most_likely and agreement are the most probable category and its probability. '''
+        max_votes = self.counts.max(axis=1, initial=0)
+        total_votes = self.counts.sum(axis=1)
+        labels = np.array(self.categories + [None], dtype=object)
+        if posteriors is None:
+            most_likely = labels[np.where(max_votes > 0, self.counts.argmax(axis=1), -1)]
+        else:
+            most_likely = labels[np.where(total_votes > 0, posteriors.argmax(axis=1), -1)]
+        if (total_votes > 0).any() and posteriors is not None:
+            agreement = np.where(total_votes > 0, posteriors.max(axis=1, initial=0), 0.0)
+        elif (total_votes > 0).any():
+            agreement = np.where(total_votes > 0, max_votes / np.maximum(total_votes, 1), 0.0)
+        else:
+            agreement = np.zeros(len(self.subj_ids), dtype=np.int64)  # no votes at all: integer zeros
+        return pd.DataFrame({
+            'subject_id': self.subj_ids,
+            'event_id': self.subj_ids,  # duplicate subject_id into event_id for now
+            'data.num_votes': max_votes,
+            'data.most_likely': pd.Series(most_likely, dtype=object),
+            'data.agreement': agreement
+        })
+
+
+class UserVotes:
+    def __init__(self, subj_ids, categories):
+        self.subj_ids = np.asarray(subj_ids)
+        self.categories = list(categories)
+        # Entries sorted by user, then row, then category code; users holds the name of each user code
+        self.users = np.array([], dtype=object)
+        self.user_codes = np.zeros(0, dtype=np.int64)
+        self.rows = np.zeros(0, dtype=np.int64)
+        self.codes = np.zeros(0, dtype=np.int64)
+        self.weights = np.zeros(0, dtype=np.int64)
+
+    def select_users(self, mask):
+        ''' UserVotes of the users where mask (one bool per user code) is set '''
+        selected = UserVotes(self.subj_ids, self.categories)
+        keep = np.asarray(mask)[self.user_codes]
+        remap = np.cumsum(mask) - 1
+        selected.users = self.users[np.asarray(mask)]
+        selected.user_codes = remap[self.user_codes[keep]]
+        selected.rows, selected.codes, selected.weights = self.rows[keep], self.codes[keep], self.weights[keep]
+        return selected
+
+    def user_mask(self, names):
+        ''' Row mask of the users in names '''
+        return pd.Index(self.users).isin(names)
+
+    def subject_counts(self):
+        ''' (n_subjects, n_categories) votes per subject, the column sums (as VoteTally.counts) '''
+        n = len(self.categories)
+        return np.bincount(self.rows * n + self.codes, weights=self.weights,
+                           minlength=len(self.subj_ids) * n).astype(np.int64).reshape(-1, n)
+
+    def user_counts(self):
+        ''' (n_users, n_categories) votes per user, the row sums '''
+        n = len(self.categories)
+        return np.bincount(self.user_codes * n + self.codes, weights=self.weights,
+                           minlength=len(self.users) * n).astype(np.int64).reshape(-1, n)
+
+    def user_sums(self, hits):
+        ''' Votes per user where the entry mask hits is set '''
+        return np.bincount(self.user_codes[hits], weights=self.weights[hits], minlength=len(self.users)).astype(np.int64)
+
+    def user_subjects(self):
+        ''' Number of distinct subjects each user voted on '''
+        first = np.ones(len(self.rows), dtype=bool)
+        first[1:] = (self.user_codes[1:] != self.user_codes[:-1]) | (self.rows[1:] != self.rows[:-1])
+        return np.bincount(self.user_codes[first], minlength=len(self.users))
+
+    def matches(self, labels):
+        ''' (votes per user whose category equals labels[row], votes per user on rows with a label).
+        labels is a category code per subject row, -1 for none. '''
+        labelled = labels[self.rows] >= 0
+        return self.user_sums(labelled & (self.codes == labels[self.rows])), self.user_sums(labelled)
+
+    def leave_one_out(self):
+        ''' Category code per entry that the other users' votes on its subject favour (ties to the
+        first category), -1 when nobody else voted on it. All of a user's votes on a subject are
+        left out together. '''
+        n = len(self.categories)
+        # Entries are sorted by (user, row), so each user's votes on a subject are consecutive
+        start = np.ones(len(self.rows), dtype=bool)
+        start[1:] = (self.user_codes[1:] != self.user_codes[:-1]) | (self.rows[1:] != self.rows[:-1])
+        group = np.cumsum(start) - 1
+        own = np.bincount(group * n + self.codes, weights=self.weights,
+                          minlength=(group[-1] + 1 if len(group) else 0) * n).reshape(-1, n)
+        others = self.subject_counts()[self.rows] - own[group]
+        return np.where(others.sum(axis=1) > 0, others.argmax(axis=1), -1)
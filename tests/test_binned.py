@@ -0,0 +1,72 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from binned import AXES, DEFAULT_EDGES, PREDICTIONS, TRUTH, binned_performance, curve_frame, event_weights
+
+CATEGORIES = ['SKIMMING', 'CASCADE', 'TRACK']
+
+
+def consolidated(seed, n):
+    ''' Consolidated-like subjects spanning the default edges, some outside them or NaN '''
+    rng = np.random.default_rng(seed)
+    labels = np.array(CATEGORIES + [None], dtype=object)
+    df = pd.DataFrame({column: rng.choice(labels, size=n, p=[0.31, 0.31, 0.31, 0.07])
+                       for column in [*PREDICTIONS.values(), TRUTH]})
+    df['energy'] = 10 ** rng.uniform(1.8, 7.2, n)
+    df['zenith'] = np.arccos(rng.uniform(-1, 1, n))
+    df['qtot'] = 10 ** rng.uniform(-0.2, 6.2, n)
+    df['oneweight'] = rng.exponential(1e3, n)
+    df.loc[rng.choice(n, 10, replace=False), 'energy'] = np.nan
+    df.loc[:4, 'energy'] = 10.0 ** 7  # on the last upper edge, which is included
+    return df
+
+
+def naive_bins(df, edges):
+    ''' Bin of each subject along each axis, the slow way: a mask per bin '''
+    values = {'energy': np.log10(df['energy']), 'cos_zenith': np.cos(df['zenith']), 'charge': np.log10(df['qtot'])}
+    bins = {}
+    for axis in AXES:
+        number = np.full(len(df), -1)
+        for b, (low, high) in enumerate(zip(edges[axis][:-1], edges[axis][1:])):
+            last = b == len(edges[axis]) - 2
+            number[((values[axis] >= low) & ((values[axis] <= high) if last else (values[axis] < high))).to_numpy()] = b
+        bins[axis] = number
+    return bins
+
+
+@pytest.mark.parametrize('weighted', [False, True])
+def test_matches_crosstab_per_bin(weighted):
+    df = consolidated(0, 3000)
+    edges = {'energy': np.arange(2, 7.01, 1.25), 'cos_zenith': np.linspace(-1, 1, 4), 'charge': np.arange(0, 6.01, 2)}
+    weights = event_weights(df) if weighted else None
+    result = binned_performance(df, CATEGORIES, edges=edges, weights=weights)
+
+    bins = naive_bins(df, edges)
+    w = pd.Series(weights if weighted else np.ones(len(df)), index=df.index)
+    inside = np.logical_and.reduce([bins[axis] >= 0 for axis in AXES])
+    assert result['outside'] == int((~inside).sum())
+    for key in np.ndindex(result['subjects'].shape):
+        in_bin = np.logical_and.reduce([bins[axis] == b for axis, b in zip(AXES, key)])
+        subjects = df[in_bin]
+        assert result['subjects'][key] == len(subjects)
+        assert result['totals'][key] == pytest.approx(w[in_bin].sum())
+        for who, column in PREDICTIONS.items():
+            expected = pd.crosstab(subjects[column], subjects[TRUTH], values=w[in_bin], aggfunc='sum')
+            expected = expected.reindex(index=CATEGORIES, columns=CATEGORIES).fillna(0)
+            np.testing.assert_allclose(result[who]['counts'][key], expected.to_numpy())
+            hits = (subjects[column] == subjects[TRUTH]).to_numpy()
+            assert result[who]['hits'][key] == pytest.approx(w[in_bin][hits].sum())
+
+
+def test_unweighted_curves_add_up_to_overall_accuracy():
+    df = consolidated(1, 2000)
+    result = binned_performance(df, CATEGORIES)
+    bins = naive_bins(df, DEFAULT_EDGES)
+    inside = df[np.logical_and.reduce([bins[axis] >= 0 for axis in AXES])]
+    for axis in AXES:
+        curve = curve_frame(result, axis)
+        assert curve['subjects'].sum() == len(inside)
+        for who, column in PREDICTIONS.items():
+            hits = (curve[f'{who}_accuracy'].fillna(0) * curve['total']).sum()
+            assert hits / curve['total'].sum() == pytest.approx((inside[column] == inside[TRUTH]).mean())
@@ -0,0 +1,54 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import bootstrap
+from bootstrap import PREDICTIONS, TRUTH, bootstrap_intervals, bootstrap_resamples
+from confusion import category_codes
+
+CATEGORIES = ['SKIMMING', 'CASCADE', 'TRACK']
+
+
+def consolidated(seed, n):
+    ''' Consolidated-like subjects, with some missing and unknown labels '''
+    rng = np.random.default_rng(seed)
+    labels = np.array(CATEGORIES + [None, 'STARTINGTRACK'], dtype=object)
+    p = [0.3, 0.3, 0.3, 0.05, 0.05]
+    return pd.DataFrame({column: rng.choice(labels, size=n, p=p) for column in [*PREDICTIONS.values(), TRUTH]})
+
+
+def resample_indices(seed, n_resamples, n_subjects):
+    ''' The subject indices bootstrap_resamples draws, chunk by chunk '''
+    per_chunk = max(1, bootstrap.CHUNK_ROWS // n_subjects)
+    sizes = [min(per_chunk, n_resamples - start) for start in range(0, n_resamples, per_chunk)]
+    return np.concatenate([np.random.default_rng(child).integers(0, n_subjects, size=(size, n_subjects))
+                           for child, size in zip(np.random.SeedSequence(seed).spawn(len(sizes)), sizes)])
+
+
+@pytest.mark.parametrize('chunk_rows', [1 << 20, 1000])
+def test_resample_counts_match_crosstab(monkeypatch, chunk_rows):
+    monkeypatch.setattr(bootstrap, 'CHUNK_ROWS', chunk_rows)
+    df = consolidated(1, 400)
+    truth = category_codes(df[TRUTH], CATEGORIES)
+    predicted = [category_codes(df[column], CATEGORIES) for column in PREDICTIONS.values()]
+    correct = [(df[column] == df[TRUTH]).to_numpy() for column in PREDICTIONS.values()]
+    counts, accuracy = bootstrap_resamples(predicted, truth, correct, len(CATEGORIES), n_resamples=25, seed=7)
+
+    for r, index in enumerate(resample_indices(7, 25, len(df))):
+        sample = df.iloc[index].reset_index(drop=True)
+        for m, column in enumerate(PREDICTIONS.values()):
+            expected = pd.crosstab(sample[column], sample[TRUTH]).reindex(index=CATEGORIES, columns=CATEGORIES, fill_value=0)
+            np.testing.assert_array_equal(counts[m, r], expected.to_numpy())
+            assert accuracy[m, r] == pytest.approx((sample[column] == sample[TRUTH]).mean())
+
+
+def test_intervals_do_not_depend_on_workers(monkeypatch):
+    monkeypatch.setattr(bootstrap, 'CHUNK_ROWS', 2000)  # several chunks
+    df = consolidated(2, 500)
+    serial = bootstrap_intervals(df, CATEGORIES, n_resamples=40, seed=3)
+    parallel = bootstrap_intervals(df, CATEGORIES, n_resamples=40, seed=3, workers=2)
+    for who in PREDICTIONS:
+        for key in ['low', 'high', 'counts']:
+            pd.testing.assert_frame_equal(serial[who][key], parallel[who][key])
+        assert (serial[who]['accuracy_low'], serial[who]['accuracy_high']) == \
+               (parallel[who]['accuracy_low'], parallel[who]['accuracy_high'])
@@ -0,0 +1,228 @@
+import json
+import random
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from classifications import PARSED_COLUMNS, _bulk_timestamps, parse_classifications, time_spent_seconds
+from metrics import Metrics
+
+##############################################################################################
+# Differential fuzz test of the regex fast path in parse_classifications against a plain
+# json.loads parser (the one it replaced): random JSON rows, plus escapes, repeated keys,
+# odd whitespace, deep nesting, non-string values and broken JSON, must parse the same.
+##############################################################################################
+
+def reference_parse(classif):
+    ''' parse_classifications as it was before the regex fast path: json.loads of every row '''
+    fields = {name: [] for name in ['subject_key', 'choice', 'track_type', 'started_at', 'finished_at', 'time_spent']}
+    for annot_str, meta_str, subj_str in zip(classif['annotations'], classif['metadata'], classif['subject_data']):
+        row = dict.fromkeys(fields)
+        row['time_spent'] = np.nan
+        try:
+            value = json.loads(annot_str)[0]['value'][0]
+            row['choice'] = value['choice']
+            row['track_type'] = value.get('answers', {}).get('WHATTYPEOFTRACKISIT')
+        except Exception:
+            row['choice'] = row['track_type'] = None
+        try:
+            meta = json.loads(meta_str)
+            row['started_at'], row['finished_at'] = meta.get('started_at'), meta.get('finished_at')
+            start = datetime.fromisoformat(row['started_at'].replace('Z', '+00:00'))
+            end = datetime.fromisoformat(row['finished_at'].replace('Z', '+00:00'))
+            row['time_spent'] = (end - start).total_seconds()
+        except Exception:
+            pass
+        try:
+            row['subject_key'] = int(list(json.loads(subj_str).keys())[0])
+        except Exception:
+            pass
+        for name, value in row.items():
+            fields[name].append(value)
+    return pd.DataFrame({
+        'user_name': classif['user_name'].to_numpy(),
+        'subject_ids': classif['subject_ids'].to_numpy(),
+        'subject_key': pd.array(fields['subject_key'], dtype='Int64'),
+        'choice': pd.Series(fields['choice'], dtype=object),
+        'track_type': pd.Series(fields['track_type'], dtype=object),
+        'started_at': pd.Series(fields['started_at'], dtype=object),
+        'finished_at': pd.Series(fields['finished_at'], dtype=object),
+        'time_spent': np.array(fields['time_spent'], dtype=float),
+    }, columns=PARSED_COLUMNS)
+
+
+CHOICES = ['TRACK', 'CASCADE', 'SKIMMING', 'TRACK', 'CASCADE', 'SKIMMING', '', 'träck']
+ESCAPED = ['a"b', 'a\\b', 'line\nbreak', 'tab\t', '\u2028']
+TRACK_TYPES = ['THROUGHGOINGTRACK', 'STARTINGTRACK', 'STOPPINGTRACK', '']
+STAMPS = ['2025-06-01T12:00:00.000Z', '2025-06-01T12:00:07.5Z', '2025-06-01T12:00:09+02:00', '2025-06-01T12:00:03',
+          '2024-02-29T23:59:59.999999Z', '2025-02-29T00:00:00Z', '2025-06-01 12:00:04Z', 'not a time', '']
+
+
+def random_value(rng, depth=0):
+    kind = rng.randrange(8 if depth < 4 else 5)
+    if kind == 0:
+        return rng.choice(CHOICES + ESCAPED[:1])
+    if kind == 1:
+        return rng.choice([0, -1, 2.5, 1e30, -0.0])
+    if kind == 2:
+        return rng.choice([True, False])
+    if kind == 3:
+        return None
+    if kind == 4:
+        return rng.choice(STAMPS)
+    if kind == 5:
+        return [random_value(rng, depth + 1) for _ in range(rng.randrange(3))]
+    return {rng.choice(['a', 'choice', 'value', 'answers', 'x y']): random_value(rng, depth + 1) for _ in range(rng.randrange(3))}
+
+
+def dumps(rng, obj):
+    # json.dumps with random separators and ASCII escaping (escaped strings go to the fallback)
+    item, key = rng.choice([(',', ':'), (', ', ': '), (' ,\n', ' :\t')])
+    return json.dumps(obj, separators=(item, key), ensure_ascii=rng.random() < 0.1)
+
+
+def mutate(rng, text):
+    ''' Hand-written JSON the serializer never produces: repeated keys, broken or truncated text '''
+    kind = rng.randrange(6)
+    if kind == 0 and text.endswith('}'):
+        return text[:-1] + (', ' if len(text) > 2 else '') + text[1:]  # every key repeated
+    if kind == 1:
+        return text[:rng.randrange(len(text) + 1)]
+    if kind == 2:
+        at = rng.randrange(len(text) + 1)
+        return text[:at] + rng.choice(['"', '\\', '\x00', ',', '}', ']', ' ', 'nul']) + text[at:]
+    if kind == 3:
+        return ' ' + text + '\n'
+    return text
+
+
+def random_annotations(rng):
+    value = {}
+    if rng.random() < 0.9:
+        value['choice'] = rng.choice(CHOICES) if rng.random() < 0.9 else rng.choice([rng.choice(ESCAPED), random_value(rng)])
+    if rng.random() < 0.7:
+        value['answers'] = {'WHATTYPEOFTRACKISIT': rng.choice(TRACK_TYPES)} if rng.random() < 0.8 else random_value(rng)
+    if rng.random() < 0.3:
+        value['filters'] = random_value(rng)
+    values = [value] + [random_value(rng) for _ in range(rng.randrange(2))]
+    task = {'task': 'T0', 'value': values if rng.random() < 0.95 else random_value(rng)}
+    if rng.random() < 0.2:
+        task['task_label'] = random_value(rng)
+    return [task] + [random_value(rng) for _ in range(rng.randrange(2))]
+
+
+def random_metadata(rng):
+    meta = {'source': 'api', 'session': random_value(rng)}
+    for key in ['started_at', 'finished_at']:
+        if rng.random() < 0.9:
+            meta[key] = rng.choice(STAMPS) if rng.random() < 0.9 else random_value(rng)
+    keys = list(meta)
+    rng.shuffle(keys)
+    return {key: meta[key] for key in keys}
+
+
+def random_subject_data(rng):
+    key = str(rng.randrange(10**8)) if rng.random() < 0.9 else rng.choice(['007', '-5', 'abc', '1e3', ''])
+    return {key: {'retired': random_value(rng), 'run': rng.randrange(100)}, **({'other': 1} if rng.random() < 0.3 else {})}
+
+
+def random_export(seed, n):
+    rng = random.Random(seed)
+    columns = {'annotations': random_annotations, 'metadata': random_metadata, 'subject_data': random_subject_data}
+    rows = {name: [] for name in columns}
+    for _ in range(n):
+        for name, make in columns.items():
+            if rng.random() < 0.03:
+                rows[name].append(None if rng.random() < 0.5 else rng.choice(['', 'null', '[]', '{}', '"x"', '0']))
+                continue
+            text = dumps(rng, make(rng))
+            rows[name].append(mutate(rng, text) if rng.random() < 0.1 else text)
+    return pd.DataFrame({'user_name': [f'user{i % 7}' for i in range(n)], 'subject_ids': np.arange(n), **rows})
+
+
+@pytest.mark.parametrize('seed', range(8))
+def test_matches_json_loads(seed):
+    classif = random_export(seed, 1500)
+    pd.testing.assert_frame_equal(parse_classifications(classif), reference_parse(classif))
+
+
+def test_row_by_row_matches_whole_column():
+    # Each row on its own (no neighbours joined into the column string) parses the same
+    classif = random_export(100, 300)
+    whole = parse_classifications(classif)
+    rows = pd.concat([parse_classifications(classif.iloc[[i]]) for i in range(len(classif))], ignore_index=True)
+    pd.testing.assert_frame_equal(rows, whole)
+
+
+def test_fallback_rows_counted_once():
+    classif = random_export(200, 1000)
+    metrics = Metrics()
+    parse_classifications(classif, metrics)
+    whole = metrics.counts['parse']
+
+    # Two passes as in streaming: annotations first, then the other columns of the same rows
+    metrics = Metrics()
+    parse_classifications(classif[['user_name', 'subject_ids', 'annotations']], metrics)
+    parse_classifications(classif, metrics, counted=('annotations',))
+    assert metrics.counts['parse'] == whole
+    assert 0 < whole['fallback_rows'] < whole['rows'] == len(classif)
+
+
+# Timestamps in the layout _bulk_timestamps reads: leap days, Z and +hh:mm / -hh:mm offsets,
+# 1 to 6 fraction digits, and the last moments of a day, month and year
+BULK_STAMPS = [
+    '2024-02-29T12:00:00Z', '2000-02-29T00:00:00Z', '2024-02-28T23:59:59.999999Z', '2024-03-01T00:00:00Z',
+    '2023-12-31T23:59:59.5Z', '2024-01-01T00:00:00.25+00:00', '2024-01-01T01:30:00+01:30', '2023-12-31T19:00:00-05:00',
+    '2025-06-01T12:00:00.1Z', '2025-06-01T12:00:00.12Z', '2025-06-01T12:00:00.123Z', '2025-06-01T12:00:00.1234Z',
+    '2025-06-01T12:00:00.12345Z', '2025-06-01T12:00:00.123456Z', '2025-06-01T12:00:00.000Z', '2025-06-01T23:59:59Z',
+    '2025-06-02T00:00:01-00:00', '2025-06-01T12:00:00+23:59', '2025-06-01T12:00:00-23:59', '0001-01-01T00:00:00Z',
+    '9999-12-31T23:59:59.999999+00:00', '1970-01-01T00:00:00', '1969-12-31T23:59:59.999', '2025-06-01T12:00:07.5',
+]
+# Stamps it leaves to datetime: impossible dates and times, other layouts, missing and non-string values
+OTHER_STAMPS = [
+    '2023-02-29T12:00:00Z', '1900-02-29T00:00:00Z', '2025-04-31T00:00:00Z', '2025-13-01T00:00:00Z',
+    '2025-00-10T00:00:00Z', '2025-06-00T00:00:00Z', '2025-06-01T24:00:00Z', '2025-06-01T12:60:00Z',
+    '2025-06-01T12:00:60Z', '0000-01-01T00:00:00Z', '2025-06-01T12:00:00+24:00', '2025-06-01T12:00:00+01:60',
+    '2025-06-01T12:00:00+0100', '2025-06-01T12:00:00.Z', '2025-06-01T12:00:00.1234567Z', '2025-06-01T12:00:00ZZ',
+    '2025-06-01T12:00:00Z ', ' 2025-06-01T12:00:00Z', '2025-06-01 12:00:00Z', '2025-06-01T12:00Z', '2025-06-01',
+    '2025-6-01T12:00:00Z', '2025-06-01T12:00:00z', '2025-06-01T1a:00:00Z', '2025-06-01T12:00:00\x00Z', '',
+    'not a time', None, np.nan, 1717243200, ['2025-06-01T12:00:00Z'],
+]
+
+
+def reference_time(stamp):
+    ''' datetime of a stamp as the json.loads reducers read it, None if unreadable '''
+    try:
+        return datetime.fromisoformat(stamp.replace('Z', '+00:00'))
+    except Exception:
+        return None
+
+
+def test_bulk_timestamps_match_fromisoformat():
+    stamps = np.array(BULK_STAMPS + OTHER_STAMPS, dtype=object)
+    micros, aware, readable = _bulk_timestamps(stamps)
+    assert readable[:len(BULK_STAMPS)].all()
+    for stamp, stamp_micros, stamp_aware, stamp_readable in zip(stamps, micros, aware, readable):
+        if stamp_readable:
+            expected = reference_time(stamp)
+            assert expected is not None, stamp
+            epoch = datetime(1970, 1, 1, tzinfo=timezone.utc if expected.tzinfo else None)
+            assert stamp_micros == (expected - epoch) // timedelta(microseconds=1), stamp
+            assert stamp_aware == (expected.tzinfo is not None), stamp
+
+
+def test_time_spent_matches_fromisoformat():
+    # Every pair of stamps, including pairs across a day, month or year and naive/aware pairs
+    stamps = BULK_STAMPS + OTHER_STAMPS
+    started = np.array([start for start in stamps for _ in stamps], dtype=object)
+    finished = np.array([finish for _ in stamps for finish in stamps], dtype=object)
+    seconds = time_spent_seconds(started, finished)
+    for start, finish, spent in zip(started, finished, seconds):
+        start_time, finish_time = reference_time(start), reference_time(finish)
+        try:
+            expected = (finish_time - start_time).total_seconds()
+        except TypeError:  # unreadable, or only one of them has an offset
+            expected = np.nan
+        np.testing.assert_equal(spent, expected, err_msg=f"{start!r} -> {finish!r}")
@@ -0,0 +1,83 @@
+import os, os.path
+
+import pandas as pd
+import pytest
+
+import matched_store
+import parse_cache
+from parse_cache import load_parsed_classifications
+from reducer import Reducer
+from synthetic import generate
+
+# Rows whose fields the json.loads fallback decodes to lists, dicts, numbers and booleans, each
+# with a row that has an unknown string in their place
+ODD_ANNOTATIONS = [
+    ('[{"task":"T0","value":[{"choice":"TRACK","answers":{"WHATTYPEOFTRACKISIT":["STARTINGTRACK"]}}]}]',
+     '[{"task":"T0","value":[{"choice":"TRACK","answers":{"WHATTYPEOFTRACKISIT":"UNKNOWN"}}]}]'),
+    ('[{"task":"T0","value":[{"choice":["TRACK"],"answers":{}}]}]', '[{"task":"T0","value":[{"choice":"UNKNOWN","answers":{}}]}]'),
+    ('[{"task":"T0","value":[{"choice":{"TRACK":1}}]}]', '[{"task":"T0","value":[{"choice":"UNKNOWN"}]}]'),
+    ('[{"task":"T0","value":[{"choice":5}]}]', '[{"task":"T0","value":[{"choice":"UNKNOWN"}]}]'),
+    ('[{"task":"T0","value":[{"choice":true}]}]', '[{"task":"T0","value":[{"choice":"UNKNOWN"}]}]'),
+]
+ODD_METADATA = [
+    ('{"started_at":["2025-06-01T00:00:00Z"]}', '{"started_at":"UNKNOWN"}'),
+    ('{"finished_at":{"at":0}}', '{"finished_at":"UNKNOWN"}'),
+    ('{"started_at":1}', '{"started_at":"UNKNOWN"}'),
+]
+
+
+@pytest.fixture
+def caches(tmp_path, monkeypatch):
+    ''' Default parsed-classification and matched store locations inside tmp_path '''
+    monkeypatch.setattr(parse_cache, 'DEFAULT_CACHE_DIR', str(tmp_path / 'parsed'))
+    monkeypatch.setattr(matched_store, 'DEFAULT_CACHE_DIR', str(tmp_path / 'matched'))
+    return tmp_path
+
+
+def odd_export(directory, odd=True):
+    ''' Synthetic export with some rows replaced by the odd rows of ODD_ANNOTATIONS and
+    ODD_METADATA, or by their unknown-string counterparts '''
+    classif_path, subjects_path, matched_path = generate(str(directory), 2000, n_subjects=80, n_users=30, seed=2)
+    classif = pd.read_csv(classif_path)
+    for i, rows in enumerate(ODD_ANNOTATIONS * 20):
+        classif.loc[i * 7, 'annotations'] = rows[0 if odd else 1]
+    for i, rows in enumerate(ODD_METADATA * 20):
+        classif.loc[i * 11 + 3, 'metadata'] = rows[0 if odd else 1]
+    classif.to_csv(classif_path, index=False)
+    return classif_path, subjects_path, matched_path
+
+
+def test_cached_table_matches_parsed(caches, tmp_path):
+    export = odd_export(tmp_path / 'export')
+    parsed = load_parsed_classifications(export[0], use_cache=False)
+    assert parsed['track_type'].map(lambda value: isinstance(value, list)).any()
+    written = load_parsed_classifications(export[0])
+    read = load_parsed_classifications(export[0])
+    assert len(os.listdir(caches / 'parsed')) == 1
+    pd.testing.assert_frame_equal(written, parsed)
+    # Cached strings come back as object columns
+    pd.testing.assert_frame_equal(read, parsed.astype({'user_name': object}))
+
+
+
+def reduce(export, output_dir, **options):
+    ''' Text of the 3- and 5-category reduced CSVs of a Reducer run with the given attributes '''
+    reducer = Reducer(os.path.dirname(export[0]), str(output_dir), 20)
+    reducer.classif_path, reducer.matched_path = export[0], export[2]
+    reducer.output_file = 'reduced'
+    reducer.output_file_5 = 'reduced-5'
+    reducer.accuracy_cut = 0.5
+    for name, value in options.items():
+        setattr(reducer, name, value)
+    return [open(path).read() for path in reducer.reduce()]
+
+
+def test_odd_values_reduce_like_unknown_strings(caches, tmp_path):
+    # As in the json.loads reducers, a list or other non-string answer is an unknown choice
+    # (or track type), and non-string times are unreadable; with or without the cache
+    expected = reduce(odd_export(tmp_path / 'plain', odd=False), tmp_path / 'expected', use_cache=False)
+    export = odd_export(tmp_path / 'odd')
+    assert reduce(export, tmp_path / 'uncached', use_cache=False) == expected
+    assert reduce(export, tmp_path / 'written') == expected  # parsed and written to the cache
+    assert reduce(export, tmp_path / 'read') == expected  # loaded from the cache
+    assert reduce(export, tmp_path / 'streamed', chunksize=500) == expected
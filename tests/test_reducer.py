@@ -0,0 +1,86 @@
+import importlib.util
+import os, os.path
+
+import pandas as pd
+import pytest
+
+from reducer import Reducer
+from synthetic import generate
+
+##############################################################################################
+# The streaming, parallel and incremental reductions must write the same reduced CSVs as the
+# serial in-memory reduce(), byte for byte, on a synthetic export with some unreadable rows;
+# so must a run writing only one taxonomy (reducer.py alone or 5option-reducer.py).
+##############################################################################################
+
+@pytest.fixture(scope='module')
+def export(tmp_path_factory):
+    ''' (classification, subjects, matched) paths of a small synthetic export '''
+    return generate(str(tmp_path_factory.mktemp('export')), 4000, n_subjects=150, n_users=60, bad_fraction=0.05, seed=1)
+
+
+def reduce(export, output_dir, **options):
+    ''' Text of the reduced CSVs (3-category, then 5-category) of a Reducer run with the given attributes '''
+    classif_path, _, matched_path = export
+    reducer = Reducer(os.path.dirname(classif_path), str(output_dir), 20)
+    reducer.classif_path = classif_path
+    reducer.matched_path = matched_path
+    reducer.output_file = 'reduced'
+    reducer.output_file_5 = 'reduced-5'
+    reducer.accuracy_cut = 0.6
+    reducer.use_cache = False
+    for name, value in options.items():
+        setattr(reducer, name, value)
+    paths = reducer.reduce()  # a single path when only one CSV is written
+    return [open(path).read() for path in ([paths] if isinstance(paths, str) else paths)]
+
+
+@pytest.fixture(scope='module')
+def serial(export, tmp_path_factory):
+    reduced = reduce(export, tmp_path_factory.mktemp('serial'))
+    assert all(len(text.splitlines()) > 100 for text in reduced)
+    return reduced
+
+
+@pytest.mark.parametrize('chunksize', [1000, 333])
+def test_streaming_matches_serial(export, serial, tmp_path, chunksize):
+    assert reduce(export, tmp_path, chunksize=chunksize) == serial
+
+
+@pytest.mark.parametrize('chunksize', [None, 700])
+def test_parallel_matches_serial(export, serial, tmp_path, chunksize):
+    assert reduce(export, tmp_path, workers=2, chunksize=chunksize) == serial
+
+
+def test_incremental_matches_serial(export, serial, tmp_path):
+    # A first run on the older rows, then one that appends the rows after its watermark
+    classif = pd.read_csv(export[0])
+    older_path = str(tmp_path / 'older.csv')
+    classif.iloc[:2500].to_csv(older_path, index=False)
+    state_path = str(tmp_path / 'state.pkl')
+
+    older = reduce(export, tmp_path / 'older', classif_path=older_path, state_path=state_path)
+    assert older == reduce(export, tmp_path / 'older-serial', classif_path=older_path)
+    assert reduce(export, tmp_path / 'appended', state_path=state_path, chunksize=600) == serial
+    assert pd.read_pickle(state_path)['last_classification_id'] == classif['classification_id'].max()
+    assert reduce(export, tmp_path / 'unchanged', state_path=state_path, workers=2) == serial
+
+
+def load_5option_reducer():
+    # 5option-reducer.py is not an importable module name
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), '5option-reducer.py')
+    spec = importlib.util.spec_from_file_location('five_option_reducer', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.Reducer
+
+
+@pytest.mark.parametrize('chunksize', [None, 1000])
+def test_each_taxonomy_alone_matches_single_pass(export, serial, tmp_path, chunksize):
+    assert reduce(export, tmp_path / '3', output_file_5=None, chunksize=chunksize) == serial[:1]
+
+    classif_path, _, matched_path = export
+    reducer = load_5option_reducer()(os.path.dirname(classif_path), str(tmp_path / '5'), 20, classif_path, None,
+                                     matched_path, 'reduced-5', 60, True, use_cache=False)
+    reducer.chunksize = chunksize
+    assert open(reducer.reduce()).read() == serial[1]
@@ -0,0 +1,133 @@
+import argparse
+import os, os.path
+
+import numpy as np
+import pandas as pd
+
+from confusion import category_codes
+from parse_cache import load_parsed_classifications
+from reducer import FINE_CATEGORIES, TIME_CUT, fine_choices
+
+##############################################################################################
+#                                       time_cuts.py
+##############################################################################################
+# Purpose: Histograms of the time spent on each classification, per user and per voted
+#          category, and the number of classifications kept by any number of time cuts
+# Usage: python time_cuts.py --input-dir <dir> --classifications <export CSV> --output <prefix>
+#        or from time_cuts import time_histogram, cut_counts
+# Author: Jonathan Berkson
+#
+# time_spent comes from the parsed classifications (and their cache, see parse_cache.py), so
+# trying another cut or bin layout does not re-read the export. A time cut keeps the
+# classifications with time_spent > cut, as in reducer.py and sweep.py. Histogram bins are
+# closed on the right, (edge, next edge], so the count kept by a cut at a bin edge is the sum
+# of the bins above it. Classifications with unreadable metadata (NaN) are counted separately.
+##############################################################################################
+
+DEFAULT_EDGES = [0, 2, 4, 6, 8, 10, 15, 20, 30, 60, 120, 300, 600]  # seconds
+DEFAULT_CUTS = [0, 2, 4, 6, 8, 10, 15, 20, 30]
+UNKNOWN = 'UNKNOWN'  # category of classifications without a usable choice
+
+
+def bin_labels(edges):
+    ''' Column names of the histogram bins of edges, plus the unreadable column '''
+    return ([f"<={edges[0]:g}s"] + [f"{low:g}-{high:g}s" for low, high in zip(edges[:-1], edges[1:])]
+            + [f">{edges[-1]:g}s", 'unreadable'])
+
+
+def time_histogram(time_spent, edges, groups=None, n_groups=1):
+    ''' (n_groups, len(edges) + 2) counts of time_spent in the bins of edges (closed on the right);
+    the last column counts NaN. groups gives each row's histogram (0..n_groups-1). '''
+    n_bins = len(edges) + 2
+    bins = np.searchsorted(np.asarray(edges, dtype=np.float64), time_spent, side='left')
+    bins[np.isnan(time_spent)] = n_bins - 1
+    if groups is not None:
+        bins = bins + groups * n_bins
+    return np.bincount(bins, minlength=n_groups * n_bins).reshape(n_groups, n_bins)
+
+
+def cut_counts(time_spent, cuts, groups=None, n_groups=1):
+    ''' (n_groups, len(cuts)) number of rows with time_spent > each cut, counted with one
+    bincount however many cuts there are. NaN passes no cut. '''
+    order = np.argsort(cuts, kind='stable')
+    sorted_cuts = np.asarray(cuts, dtype=np.float64)[order]
+    n = len(cuts) + 1
+    # Number of cuts each row passes (NaN sorts after every cut, so it is sent to 0)
+    passed = np.searchsorted(sorted_cuts, time_spent, side='left')
+    passed[np.isnan(time_spent)] = 0
+    if groups is not None:
+        passed = passed + groups * n
+    counts = np.bincount(passed, minlength=n_groups * n).reshape(n_groups, n)
+    # Rows passing the i-th smallest cut are those passing more than i cuts
+    kept = counts[:, ::-1].cumsum(axis=1)[:, ::-1][:, 1:]
+    result = np.empty_like(kept)
+    result[:, order] = kept
+    return result
+
+
+class TimeCuts:
+    def __init__(self, classif_path, output_dir, output_file):
+        self.classif_path = classif_path
+        self.output_dir = output_dir
+        self.output_file = output_file  # prefix of the three CSVs
+        self.edges = DEFAULT_EDGES      # histogram bin edges in seconds
+        self.cuts = DEFAULT_CUTS        # time cuts in seconds for the cut table
+        self.use_cache = True           # reuse the parsed-classification cache when available
+        self.cache_dir = None
+
+    def run(self):
+        ''' Write <output>-time-users.csv, -time-categories.csv and -time-cuts.csv. Returns their paths. '''
+        parsed = load_parsed_classifications(self.classif_path, use_cache=self.use_cache, cache_dir=self.cache_dir)
+        time_spent = parsed['time_spent'].to_numpy(np.float64)
+
+        user_codes, users = pd.factorize(parsed['user_name'], use_na_sentinel=False)
+        _, fine = fine_choices(parsed['choice'], parsed['track_type'])
+        categories = FINE_CATEGORIES + [UNKNOWN]
+        category = category_codes(fine, FINE_CATEGORIES)
+        category[category < 0] = len(FINE_CATEGORIES)
+
+        columns = bin_labels(self.edges)
+        by_user = pd.DataFrame(time_histogram(time_spent, self.edges, user_codes, len(users)), columns=columns)
+        by_user.insert(0, 'user_name', users)
+        by_user['classifications'] = by_user[columns].sum(axis=1)
+        by_user['median_time_spent'] = parsed['time_spent'].groupby(user_codes).median().reindex(range(len(users))).to_numpy()
+
+        by_category = pd.DataFrame(time_histogram(time_spent, self.edges, category, len(categories)), columns=columns)
+        by_category.insert(0, 'category', categories)
+        by_category['classifications'] = by_category[columns].sum(axis=1)
+
+        # One row per cut: classifications kept overall and per category
+        kept = cut_counts(time_spent, self.cuts, category, len(categories))
+        by_cut = pd.DataFrame(kept.T, columns=[f"kept_{name}" for name in categories])
+        by_cut.insert(0, 'time_cut', self.cuts)
+        by_cut.insert(1, 'kept', kept.sum(axis=0))
+        by_cut.insert(2, 'fraction_kept', by_cut['kept'] / max(len(time_spent), 1))
+        by_cut.insert(3, 'users_kept', (cut_counts(time_spent, self.cuts, user_codes, len(users)) > 0).sum(axis=0))
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        paths = []
+        for name, df in (('time-users', by_user), ('time-categories', by_category), ('time-cuts', by_cut)):
+            paths.append(os.path.join(self.output_dir, f"{self.output_file}-{name}.csv"))
+            df.to_csv(paths[-1], index=False)
+        return paths
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Time-spent histograms per user and category, and the classifications kept by each time cut.")
+    parser.add_argument('--input-dir', required=True, help="directory of the classification export")
+    parser.add_argument('--classifications', required=True, help="classification export CSV filename")
+    parser.add_argument('--output-dir', default='.', help="directory for the CSVs (default: current directory)")
+    parser.add_argument('--output', required=True, help="prefix of the output filenames")
+    parser.add_argument('--edges', type=float, nargs='+', default=DEFAULT_EDGES,
+                        help="histogram bin edges in seconds (default: %(default)s)")
+    parser.add_argument('--cuts', type=float, nargs='+', default=DEFAULT_CUTS,
+                        help=f"time cuts in seconds to count (default: %(default)s; reducer.py uses {TIME_CUT})")
+    parser.add_argument('--no-cache', action='store_true', help="do not use the parsed-classification cache")
+    args = parser.parse_args()
+
+    time_cuts = TimeCuts(os.path.join(args.input_dir, args.classifications), args.output_dir, args.output)
+    time_cuts.edges = sorted(args.edges)
+    time_cuts.cuts = args.cuts
+    time_cuts.use_cache = not args.no_cache
+    for path in time_cuts.run():
+        print(f"Saved: {path}")
@@ -0,0 +1,134 @@
+import argparse
+import os, os.path
+
+import numpy as np
+import pandas as pd
+
+from confusion import category_codes
+from matched_store import load_matched
+from reducer import AGGREGATIONS, CATEGORIES, CATEGORIES_5, MATCHED_COLUMNS, TIME_CUT, Reducer
+
+##############################################################################################
+#                                    user_diagnostics.py
+##############################################################################################
+# Purpose: Per-user diagnostics of a reduction: accuracy, votes per category, and how often
+#          each user agrees with the truth labels, the consensus and the other users
+# Usage: python user_diagnostics.py --input-dir <dir> --classifications <export CSV>
+#            --matched <matched CSV> --output <prefix> [options]
+#        or from user_diagnostics import UserDiagnostics
+# Author: Jonathan Berkson
+#
+# The export is reduced as in reducer.py (same cuts and modes), keeping who cast each vote.
+# The votes of each taxonomy are then a sparse users × subjects matrix (tally.UserVotes), and
+# every column here is a reduction over its rows. Only the votes that were counted (users
+# passing the accuracy cut, classifications passing the time cut) are in it. consensus_agreement
+# includes the user's own vote; leave_one_out_agreement compares each vote with the majority of
+# the other users on the same subject, skipping subjects nobody else voted on.
+##############################################################################################
+
+TAXONOMIES = {3: ('3', CATEGORIES), 5: ('5', CATEGORIES_5)}
+
+
+class UserDiagnostics:
+    def __init__(self, classif_path, matched_path, output_dir, output_file):
+        self.classif_path = classif_path
+        self.matched_path = matched_path
+        self.output_dir = output_dir
+        self.output_file = output_file  # prefix of <output>-users-<n>cat.csv
+        self.categories = [3]           # taxonomies to write: 3 and/or 5
+        self.accuracy_cut = 0           # minimum user accuracy as a fraction
+        self.apply_time_cut = True
+        self.time_cut = TIME_CUT
+        self.aggregation = 'votes'      # consensus the users are compared with (see reducer.py)
+        self.use_cache = True           # reducer options, see reducer.py
+        self.chunksize = None
+        self.workers = 1
+
+    def run(self):
+        ''' Write the per-user CSV of each taxonomy. Returns their paths. '''
+        reducer = Reducer(os.path.dirname(self.classif_path), self.output_dir, 0)
+        reducer.classif_path = self.classif_path
+        reducer.accuracy_cut = self.accuracy_cut
+        reducer.apply_time_cut = self.apply_time_cut
+        reducer.time_cut = self.time_cut
+        reducer.aggregation = self.aggregation
+        reducer.use_cache = self.use_cache
+        reducer.chunksize = self.chunksize
+        reducer.workers = self.workers
+        reducer.keep_user_votes = True
+
+        matched = load_matched(self.matched_path, columns=MATCHED_COLUMNS, use_cache=self.use_cache)
+        tallies, _ = reducer.tally_votes(matched)
+        collapsed = dict(zip((3, 5), reducer.collapsed_tallies(tallies)))
+        lookups = {3: reducer.build_truth_lookup(matched), 5: reducer.build_truth_lookup_5(matched)}
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        paths = []
+        for n in self.categories:
+            taxonomy, categories = TAXONOMIES[n]
+            tally = collapsed[n]
+            reduced = reducer.reduced_frame(tally, taxonomy)
+            truth = category_codes(lookups[n].lookup(tally.subj_ids), categories)
+            consensus = category_codes(reduced['data.most_likely'], categories)
+            df = self.user_frame(tally.sparse_votes(), reducer.user_stats, taxonomy, truth, consensus)
+            paths.append(os.path.join(self.output_dir, f"{self.output_file}-users-{n}cat.csv"))
+            df.to_csv(paths[-1], index=False)
+        return paths
+
+    def user_frame(self, votes, user_stats, taxonomy, truth, consensus):
+        ''' One row per user with counted votes, most votes first (then by name) '''
+        stats = user_stats.reindex(votes.users)
+        counts = votes.user_counts()
+        total = counts.sum(axis=1)
+        df = pd.DataFrame({
+            'user_name': votes.users,
+            'classifications': stats[f'total_{taxonomy}'].to_numpy(),
+            'accuracy': (stats[f'correct_{taxonomy}'] / stats[f'total_{taxonomy}'].where(stats[f'total_{taxonomy}'] > 0)).to_numpy(),
+            'votes': total,
+            'subjects': votes.user_subjects(),
+        })
+        for j, category in enumerate(votes.categories):
+            df[f'votes_{category}'] = counts[:, j]
+
+        for name, labels in (('truth', truth), ('consensus', consensus)):
+            hits, labelled = votes.matches(labels)
+            df[f'{name}_agreement'] = hits / np.where(labelled > 0, labelled, np.nan)
+        others = votes.leave_one_out()
+        compared = votes.user_sums(others >= 0)
+        df['leave_one_out_agreement'] = votes.user_sums(votes.codes == others) / np.where(compared > 0, compared, np.nan)
+        df['leave_one_out_votes'] = compared
+        return df.sort_values(['votes', 'user_name'], ascending=[False, True], kind='stable').reset_index(drop=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Per-user accuracy, votes and agreement with the truth, the consensus and the other users.")
+    parser.add_argument('--input-dir', required=True, help="directory of the input CSVs")
+    parser.add_argument('--classifications', required=True, help="classification export CSV filename")
+    parser.add_argument('--matched', required=True, help="matched_sim_data CSV filename")
+    parser.add_argument('--output-dir', default='.', help="directory for the CSVs (default: current directory)")
+    parser.add_argument('--output', required=True, help="prefix of the output filenames")
+    parser.add_argument('--categories', type=int, nargs='+', choices=sorted(TAXONOMIES), default=[3],
+                        help="taxonomies to write (default: 3)")
+    parser.add_argument('--accuracy-cut', type=int, default=0, help="minimum user accuracy in percent (default: 0)")
+    parser.add_argument('--time-cut', type=float, default=TIME_CUT,
+                        help="seconds a classification must take (default: %(default)s)")
+    parser.add_argument('--no-time-cut', action='store_true', help="do not apply the time cutoff")
+    parser.add_argument('--aggregation', choices=AGGREGATIONS, default='votes',
+                        help="consensus to compare the users with (default: %(default)s)")
+    parser.add_argument('--no-cache', action='store_true', help="do not use the parsed-classification cache or matched store")
+    parser.add_argument('--chunksize', type=int, default=None, help="stream the export in chunks of this many rows")
+    parser.add_argument('--workers', type=int, default=1, help="worker processes for the reduction (default: 1)")
+    args = parser.parse_args()
+
+    diagnostics = UserDiagnostics(os.path.join(args.input_dir, args.classifications),
+                                  os.path.join(args.input_dir, args.matched), args.output_dir, args.output)
+    diagnostics.categories = args.categories
+    diagnostics.accuracy_cut = args.accuracy_cut / 100
+    diagnostics.apply_time_cut = not args.no_time_cut
+    diagnostics.time_cut = args.time_cut
+    diagnostics.aggregation = args.aggregation
+    diagnostics.use_cache = not args.no_cache
+    diagnostics.chunksize = args.chunksize
+    diagnostics.workers = args.workers
+    for path in diagnostics.run():
+        print(f"Saved: {path}")